@@ -1,34 +1,18 @@
 from django.contrib import admin
-from django.db.models import Count, F
-from .models import BotAnalytics,LocationsAnalytics
-from django.utils.timezone import now
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from .models import BotAnalytics,LocationsAnalytics,UserLatencyStats
 from datetime import timedelta
-from django.db.models import Max, Min
 from django.http import JsonResponse
 from django.urls import path
 from unfold.admin import ModelAdmin
-import requests
-import os
 from django.contrib import messages
-from users.models import TelegramUser
+from users.usernames import get_username_resolver, group_by_username
 from .filters import UserStatusFilter
+from .dashboard import get_dashboard_stats
 
 
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-
-def get_username(user_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChat?chat_id={user_id}"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("ok"):
-            return data["result"].get("username", "hidden")  # Return None if no username
-        return "Not Active"
-    return "Not Active" 
-
-
 class LogData(BotAnalytics):
     class Meta:
         proxy = True
@@ -45,17 +29,19 @@ class LogAdmin(ModelAdmin):
     search_fields = ['user_name','user_id']
     compressed_fields = True
     def update_username(modeladmin, request, queryset):
-        users_to_update = []
-        for user in queryset:
-            # print(user.user_name)  # Only update users with no username
-            username = get_username(user.user_id)
-            if username:
-                user.user_name = username
-                users_to_update.append(user)
-
-        if users_to_update:
-            LogData.objects.bulk_update(users_to_update, ["user_name"])
-            messages.success(request, f"Updated {len(users_to_update)} usernames successfully.")
+        # One getChat per distinct user, then a single UPDATE for all of their rows
+        usernames = get_username_resolver().resolve(queryset.order_by().values_list('user_id', flat=True).distinct())
+        updated = 0
+        if usernames:
+            with transaction.atomic():
+                updated = BotAnalytics.objects.filter(user_id__in=usernames).update(user_name=Case(
+                    *(When(user_id__in=user_ids, then=Value(username[:40]))
+                      for username, user_ids in group_by_username(usernames).items()),
+                    default=F('user_name'),
+                ))
+
+        if updated:
+            messages.success(request, f"Updated {updated} log rows for {len(usernames)} users successfully.")
         else:
             messages.info(request, "No usernames needed updating.")
     
@@ -72,78 +58,10 @@ class BotAnalyticsAdmin(ModelAdmin):
     # compressed_fields = True
     
     def changelist_view(self, request, extra_context=None):
-        def get_min_response_time():
-            min_response_time = BotAnalytics.objects.aggregate(Min('response_time'))['response_time__min']
-            return round(min_response_time, 3) if min_response_time is not None else 'N/A'
-        
-
-        # Method to get the maximum response time
-        def get_max_response_time():
-            max_response_time = BotAnalytics.objects.aggregate(Max('response_time'))['response_time__max']
-            return round(max_response_time, 3) if max_response_time is not None else 'N/A'
-        # Total users
-        total_users = TelegramUser.objects.values('telegram_id').distinct().count()
-        all_users = BotAnalytics.objects.values('user_id','user_name').distinct()
-        
-
-        # Active users (last 7 days)
-        active_users = all_users.filter(timestamp__gte=now() - timedelta(days=3)).values('user_id','user_name').distinct()
-
-        # New users (last 7 days)
-        new_users = (
-            TelegramUser.objects.filter(joined_at__gte=now() - timedelta(days=3))
-            .values('telegram_id')
-            .distinct()
-            .count()
-        )
-
-        # Inactive users (last 30 days)
-        print(f"all users : {all_users} \n new Users : {new_users} \n active users { active_users}")
-        inactive_users = all_users.exclude(
-            user_id__in=BotAnalytics.objects.filter(
-                timestamp__gte=now() - timedelta(days=3)
-            ).values('user_id')
-        )
-        
-        # Engagement rate
-        engagement_rate = (len( active_users) / total_users) * 100 if total_users > 0 else 0
-
-        # Total commands
-        total_commands = BotAnalytics.objects.count()
-        
-        max_res_time = get_max_response_time()
-        min_res_time = get_min_response_time()
-
-        # Command usage
-        command_usage = (
-            BotAnalytics.objects.values('command')
-            .annotate(total=Count('command'))
-            .order_by('-total')
-        )
-
-        # ClimateNet-specific analytics
-        popular_devices = (
-            BotAnalytics.objects.values('device_location')
-            .annotate(total=Count('id'))
-            .order_by('-total')
-        )
-
-        # Add data to the context
+        # Statistics are computed together and cached, so opening the
+        # dashboard doesn't run a dozen queries against the bot's database
         extra_context = extra_context or {}
-        extra_context.update({
-            'total_users': total_users,
-            'active_users':  active_users,
-            'active_users_len': len(active_users),
-            'new_users': new_users,
-            'inactive_users': inactive_users,
-            'inactive_users_len': len(inactive_users),
-            'engagement_rate': engagement_rate,
-            'total_commands': total_commands,
-            'command_usage': list(command_usage),
-            'popular_devices': list(popular_devices),
-            'minimum_respone_time':min_res_time,
-            'maximum_response_time':max_res_time,
-        })
+        extra_context.update(get_dashboard_stats())
         return super().changelist_view(request, extra_context=extra_context)
 
 
@@ -151,12 +69,12 @@ class BotAnalyticsAdmin(ModelAdmin):
 from datetime import datetime, timedelta
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware
-from django.db.models import Count
 from django.http import JsonResponse
 from django.urls import path
 from django.contrib import admin
 from .models import LocationsAnalytics
 from django.template.response import TemplateResponse
+from .rollups import location_counts
 
 @admin.register(LocationsAnalytics)
 class LocationsAnalyticsAdmin(ModelAdmin):
@@ -210,26 +128,24 @@ class LocationsAnalyticsAdmin(ModelAdmin):
                 start_date = make_aware(datetime.combine(datetime(today.year, 1, 1), datetime.min.time()))
                 end_date = make_aware(datetime.combine(datetime(today.year, 12, 31), datetime.max.time()))
 
-        # Fetch province usage data with date range filtering
-        query = LocationsAnalytics.objects.filter(timestamp__range=(start_date, end_date)) \
-            .values('device_province').annotate(count=Count('device_province')).order_by('-count')
+        # Whole days come from the daily rollups, partial days from raw rows
+        province_data = location_counts(start_date, end_date, 'device_province')
 
         # If a specific province is selected, fetch device data for it
         selected_province = request.GET.get('province')
         device_data = []
         if selected_province:
-            device_query = LocationsAnalytics.objects.filter(
-                device_province=selected_province,
-                timestamp__range=(start_date, end_date)
-            )
-
-            device_data = (
-                device_query.values('device_name')
-                .annotate(count=Count('device_name'))
-                .order_by('-count')
-            )
-
-        return JsonResponse({'province_data': list(query), 'device_data': list(device_data)})
+            device_data = location_counts(start_date, end_date, 'device_name', province=selected_province)
+
+        return JsonResponse({'province_data': province_data, 'device_data': device_data})
+
+
+
+@admin.register(UserLatencyStats)
+class UserLatencyStatsAdmin(ModelAdmin):
+    list_display = ('user_id', 'count', 'min_response_time', 'max_response_time', 'updated_at')
+    search_fields = ['user_id']
+    readonly_fields = ('user_id', 'count', 'total_response_time', 'min_response_time', 'max_response_time', 'histogram', 'updated_at')
 
     
 # admin.site.register(BotAnalytics, BotAnalyticsAdmin)
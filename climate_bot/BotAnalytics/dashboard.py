@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils.timezone import now
+
+from .filters import ACTIVE_WINDOW
+from .latency import latency_summary
+from .models import BotAnalytics, UserActivity, UserLatencyStats
+from users.models import TelegramUser
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_PREFIX = 'botanalytics:dashboard'
+
+
+def _round_latency(value):
+    return round(value, 3) if value is not None else 'N/A'
+
+
+def compute_dashboard_stats():
+    """All changelist statistics in seven queries, two of them in latency_summary."""
+    active_since = now() - ACTIVE_WINDOW
+
+    users = TelegramUser.objects.aggregate(
+        total=Count('id'),
+        new=Count('id', filter=Q(joined_at__gte=active_since)),
+    )
+    activity = UserActivity.objects.aggregate(
+        active=Count('id', filter=Q(last_seen__gte=active_since)),
+        inactive=Count('id', filter=Q(last_seen__lt=active_since)),
+    )
+    latency = UserLatencyStats.objects.aggregate(
+        min_latency=Min('min_response_time'),
+        max_latency=Max('max_response_time'),
+        total_latency=Sum('total_response_time'),
+        total_count=Sum('count'),
+    )
+    command_usage = list(
+        BotAnalytics.objects.values('command')
+        .annotate(total=Count('id'))
+        .order_by('-total')
+    )
+    popular_devices = list(
+        BotAnalytics.objects.values('device_location')
+        .annotate(total=Count('id'))
+        .order_by('-total')
+    )
+
+    total_users = users['total']
+    average = (
+        latency['total_latency'] / latency['total_count'] if latency['total_count'] else None
+    )
+    return {
+        'total_users': total_users,
+        'active_users_len': activity['active'],
+        'new_users': users['new'],
+        'inactive_users_len': activity['inactive'],
+        'engagement_rate': (activity['active'] / total_users) * 100 if total_users > 0 else 0,
+        'total_commands': sum(row['total'] for row in command_usage),
+        'command_usage': command_usage,
+        'popular_devices': popular_devices,
+        'minimum_respone_time': _round_latency(latency['min_latency']),
+        'maximum_response_time': _round_latency(latency['max_latency']),
+        'average_response_time': _round_latency(average),
+        'latency_summary': latency_summary(),
+    }
+
+
+# The statistics are global, changelist filters only narrow the rows listed below them
+CACHE_KEY = f"{CACHE_PREFIX}:stats"
+
+
+def _refresh(window):
+    try:
+        close_old_connections()
+        stats = compute_dashboard_stats()
+        cache.set(CACHE_KEY, {'stats': stats, 'computed_at': time.time()}, timeout=window * 10)
+    except Exception as e:
+        logger.error(f"Dashboard statistics refresh failed: {e}")
+    finally:
+        cache.delete(f"{CACHE_KEY}:refreshing")
+        close_old_connections()
+
+
+def get_dashboard_stats():
+    """Cached statistics; stale entries are served while a thread recomputes them."""
+    window = getattr(settings, 'ANALYTICS_DASHBOARD_CACHE_SECONDS', 60)
+    entry = cache.get(CACHE_KEY)
+    if entry is None:
+        stats = compute_dashboard_stats()
+        cache.set(CACHE_KEY, {'stats': stats, 'computed_at': time.time()}, timeout=window * 10)
+        return stats
+
+    if time.time() - entry['computed_at'] > window:
+        # cache.add is atomic, so only one refresh runs at a time
+        if cache.add(f"{CACHE_KEY}:refreshing", True, timeout=window):
+            threading.Thread(target=_refresh, args=(window,), daemon=True).start()
+    return entry['stats']
@@ -1,8 +1,11 @@
 from django.contrib.admin import SimpleListFilter
-from django.db.models import Max
 from datetime import timedelta
 from django.utils.timezone import now
-from .models import BotAnalytics
+from .models import UserActivity
+
+
+# Users with a command within this window count as active
+ACTIVE_WINDOW = timedelta(days=3)
 
 
 
@@ -19,21 +22,11 @@ class UserStatusFilter(SimpleListFilter):
         )
 
     def queryset(self, request, queryset):
-        # Get the latest activity for each user (latest timestamp)
-        latest_activities = BotAnalytics.objects.values('user_id').annotate(last_activity=Max('timestamp'))
-        print(f"==============:{latest_activities}")
-        # Get the most recent activity logs for active users (last activity more than 3 days ago)
+        # Each user's latest log row is kept in the UserActivity table,
+        # so this is an indexed lookup instead of a group-by over the log
+        activity = UserActivity.objects.all()
         if self.value() == 'inactive':
-            active_user_ids = latest_activities.filter(last_activity__lt=now() - timedelta(days=3)).values_list('user_id', flat=True)
-            # Now filter the queryset to get only the last activity for these active users
-            return queryset.filter(user_id__in=active_user_ids, timestamp__in=latest_activities.filter(user_id__in=active_user_ids).values('last_activity'))
-
-        # Get the most recent activity logs for inactive users (last activity within the last 3 days)
-        if self.value() == 'active':
-            inactive_user_ids = latest_activities.filter(last_activity__gte=now() - timedelta(days=3)).values_list('user_id', flat=True)
-            # Now filter the queryset to get only the last activity for these inactive users
-            return queryset.filter(user_id__in=inactive_user_ids, timestamp__in=latest_activities.filter(user_id__in=inactive_user_ids).values('last_activity'))
-
-        return queryset.filter(timestamp__in=latest_activities.values('last_activity'))
-
-
+            activity = activity.filter(last_seen__lt=now() - ACTIVE_WINDOW)
+        elif self.value() == 'active':
+            activity = activity.filter(last_seen__gte=now() - ACTIVE_WINDOW)
+        return queryset.filter(id__in=activity.values('last_log_id'))
@@ -0,0 +1,65 @@
+import math
+
+
+class LatencyHistogram:
+    """Log-bucketed latency histogram.
+
+    Bucket ``i`` holds values in ``[MIN_VALUE * GROWTH**i, MIN_VALUE * GROWTH**(i+1))``,
+    which keeps the relative error of any percentile under ``GROWTH - 1``.
+    Histograms with the same layout merge by adding bucket counts, so they
+    can be combined across processes and time ranges.
+    """
+
+    MIN_VALUE = 0.001  # 1 ms, everything below lands in bucket 0
+    GROWTH = 1.1
+
+    __slots__ = ('counts',)
+
+    def __init__(self, counts=None):
+        self.counts = {}
+        for key, count in (counts or {}).items():
+            self.counts[int(key)] = int(count)
+
+    @classmethod
+    def bucket_for(cls, value):
+        if value is None or value <= cls.MIN_VALUE:
+            return 0
+        return int(math.log(value / cls.MIN_VALUE) / math.log(cls.GROWTH))
+
+    @classmethod
+    def bucket_upper(cls, index):
+        return cls.MIN_VALUE * cls.GROWTH ** (index + 1)
+
+    def record(self, value, count=1):
+        index = self.bucket_for(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the ``p``-th percentile (0-100)."""
+        total = self.total
+        if not total:
+            return None
+        rank = max(1, math.ceil(total * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.bucket_upper(index)
+        return self.bucket_upper(max(self.counts))
+
+    def to_json(self):
+        # JSON object keys are strings
+        return {str(index): count for index, count in self.counts.items()}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data or {})
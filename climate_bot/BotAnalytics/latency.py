@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from .histogram import LatencyHistogram
+from .models import CommandLatencyHistogram
+
+
+BUCKET = timedelta(hours=1)
+PERCENTILES = (50, 95, 99)
+
+
+# Commands the bot registers handlers for, see bot/views.py; anything
+# else a user types is grouped under OTHER so labels stay a fixed set
+KNOWN_COMMANDS = frozenset((
+    '/start', '/Compare', '/One_More', '/Start_Comparing', '/Current', '/Help', '/Change_device',
+    '/Change_location', '/Website', '/Map', '/Cancel_Compare', '/Share_location', '/back',
+))
+OTHER = '(other)'
+
+
+def normalize_command(text):
+    """Group free-form message text into a small set of command labels."""
+    if not text:
+        return '(media)'
+    if text.startswith('/'):
+        # Buttons carry decorations, e.g. "/Current 📍Berd" or "/Compare 🆚"
+        command = text.split()[0].split('@')[0]
+        return command if command in KNOWN_COMMANDS else OTHER
+    return '(selection)'
+
+
+def bucket_start(timestamp):
+    moment = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def record_latency_samples(samples):
+    """Merge ``(command, stage, created_at, latency)`` samples into hourly histograms."""
+    grouped = defaultdict(LatencyHistogram)
+    for command, stage, created_at, latency in samples:
+        grouped[(command, stage, bucket_start(created_at))].record(latency)
+    if not grouped:
+        return
+
+    commands = {key[0] for key in grouped}
+    stages = {key[1] for key in grouped}
+    starts = {key[2] for key in grouped}
+    with transaction.atomic():
+        # Create missing rows, then lock them all so concurrent writers merge in turn
+        CommandLatencyHistogram.objects.bulk_create(
+            [
+                CommandLatencyHistogram(command=command, stage=stage, bucket_start=start, histogram={})
+                for command, stage, start in sorted(grouped)
+            ],
+            ignore_conflicts=True,
+        )
+        rows = CommandLatencyHistogram.objects.select_for_update().filter(
+            command__in=commands, stage__in=stages, bucket_start__in=starts,
+        ).order_by('pk')
+        to_update = []
+        for row in rows:
+            histogram = grouped.get((row.command, row.stage, row.bucket_start))
+            if histogram is None:
+                continue
+            row.count = F('count') + histogram.total
+            row.histogram = LatencyHistogram.from_json(row.histogram).merge(histogram).to_json()
+            to_update.append(row)
+        CommandLatencyHistogram.objects.bulk_update(to_update, ['count', 'histogram'])
+
+
+def _percentiles(histogram):
+    values = {}
+    for p in PERCENTILES:
+        value = histogram.percentile(p)
+        values[f"p{p}"] = round(value, 3) if value is not None else None
+    values['count'] = histogram.total
+    return values
+
+
+def stage_summary(hours=24):
+    """Percentiles per (command, stage) for every stage other than the total."""
+    since = now() - timedelta(hours=hours)
+    rows = CommandLatencyHistogram.objects.filter(bucket_start__gte=since).exclude(stage='total') \
+        .values_list('command', 'stage', 'histogram')
+
+    merged = defaultdict(LatencyHistogram)
+    for command, stage, data in rows:
+        merged[(command, stage)].merge(LatencyHistogram.from_json(data))
+    return [
+        dict(command=command, stage=stage, **_percentiles(histogram))
+        for (command, stage), histogram in sorted(merged.items())
+    ]
+
+
+ALL_COMMANDS = '(all)'
+
+
+def latency_summary(hours=24, stage='total'):
+    """Percentiles per command and an hourly trend per command, plus one over all commands."""
+    since = now() - timedelta(hours=hours)
+    rows = CommandLatencyHistogram.objects.filter(stage=stage, bucket_start__gte=since) \
+        .values_list('command', 'bucket_start', 'histogram')
+
+    by_command = defaultdict(LatencyHistogram)
+    by_hour = defaultdict(lambda: defaultdict(LatencyHistogram))
+    for command, start, data in rows:
+        histogram = LatencyHistogram.from_json(data)
+        by_command[command].merge(histogram)
+        by_hour[command][start].merge(histogram)
+        by_hour[ALL_COMMANDS][start].merge(histogram)
+
+    commands = [
+        dict(command=command, **_percentiles(histogram))
+        for command, histogram in sorted(by_command.items(), key=lambda item: -item[1].total)
+    ]
+    trend = {
+        command: [
+            dict(hour=start.isoformat(), **_percentiles(histogram))
+            for start, histogram in sorted(buckets.items())
+        ]
+        for command, buckets in by_hour.items()
+    }
+    return {'commands': commands, 'trend': trend, 'stages': stage_summary(hours)}
@@ -0,0 +1,77 @@
+# BotAnalytics/management/commands/link_analytics_users.py
+
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from BotAnalytics.models import BotAnalytics
+from users.models import TelegramUser
+
+
+DEFAULT_CHECKPOINT = os.path.join(settings.BASE_DIR, 'link_analytics_users.checkpoint')
+
+
+class Command(BaseCommand):
+    help = 'Links BotAnalytics rows to their TelegramUser, in primary-key chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help='File holding the last linked primary key')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and start from the first row')
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)['last_pk']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def write_checkpoint(self, path, last_pk):
+        # Written next to the target first so a crash never leaves a torn file
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'last_pk': last_pk}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+        last_pk = 0 if options['restart'] else self.read_checkpoint(checkpoint)
+        if last_pk:
+            self.stdout.write(f'Resuming after row {last_pk}')
+
+        user_pks = {str(telegram_id): pk for telegram_id, pk in TelegramUser.objects.values_list('telegram_id', 'pk')}
+        scanned = linked = 0
+        start = time.perf_counter()
+        while True:
+            rows = list(
+                BotAnalytics.objects.filter(pk__gt=last_pk).order_by('pk')
+                .only('pk', 'user_id', 'telegram_user_id')[:chunk_size]
+            )
+            if not rows:
+                break
+            changed = []
+            for row in rows:
+                user_pk = user_pks.get(row.user_id)
+                if row.telegram_user_id != user_pk:
+                    row.telegram_user_id = user_pk
+                    changed.append(row)
+            with transaction.atomic():
+                BotAnalytics.objects.bulk_update(changed, ['telegram_user'], batch_size=500)
+            last_pk = rows[-1].pk
+            self.write_checkpoint(checkpoint, last_pk)
+
+            scanned += len(rows)
+            linked += len(changed)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{scanned} rows scanned, {linked} updated, {scanned / elapsed:.0f} rows/s (last pk {last_pk})')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {scanned} rows scanned, {linked} updated in {elapsed:.2f}s'
+            f' ({scanned / elapsed if elapsed else 0:.0f} rows/s)'
+        ))
@@ -0,0 +1,27 @@
+# BotAnalytics/management/commands/rebuild_location_rollups.py
+
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from BotAnalytics.rollups import rebuild_location_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the daily location rollups from raw LocationsAnalytics rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='First day to rebuild (YYYY-MM-DD), default: all history')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format')
+
+        start = time.perf_counter()
+        created = rebuild_location_rollups(since=since)
+        self.stdout.write(f'Rebuilt {created} rollup rows in {time.perf_counter() - start:.2f}s')
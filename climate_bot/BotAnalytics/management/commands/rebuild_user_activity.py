@@ -0,0 +1,16 @@
+# BotAnalytics/management/commands/rebuild_user_activity.py
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from BotAnalytics.rollups import rebuild_user_activity
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the UserActivity table from the BotAnalytics command log'
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        created = rebuild_user_activity()
+        self.stdout.write(f'Rebuilt activity for {created} users in {time.perf_counter() - start:.2f}s')
@@ -5,14 +5,30 @@ import pytz
 
 class BotAnalytics(models.Model):
     user_id = models.CharField(max_length=50)  # Telegram user ID
+    # Named telegram_user because a `user` FK's user_id column would clash with the field above
+    telegram_user = models.ForeignKey('users.TelegramUser', null=True, blank=True, on_delete=models.SET_NULL,
+                                      related_name='analytics')
     user_name = models.CharField(max_length=40,blank=True)
     command = models.CharField(max_length=100)  # Command or action
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)  # Set by the writer to when the command ran
     success = models.BooleanField(default=True)  # Track errors if needed
     device_location = models.CharField(max_length=255, blank=True, null=True)  # For ClimateNet-specific devices
     response_time = models.FloatField(null=True, blank=True)  # New field for response latency
     min_response_time = models.FloatField(null=True, blank=True)  # Minimum latency
     max_response_time = models.FloatField(null=True, blank=True)
+    correlation_id = models.CharField(max_length=32, blank=True)  # One id per handled update
+    stages = models.JSONField(null=True, blank=True)  # Stage name -> seconds, when sampled
+
+    class Meta:
+        indexes = [
+            # Per-user history and the user_id/timestamp group-by in rebuild_user_activity
+            models.Index(fields=['user_id', 'timestamp'], name='botanalytics_user_time_idx'),
+            # Changelist date filter and default ordering
+            models.Index(fields=['timestamp'], name='botanalytics_time_idx'),
+            # Dashboard group-bys, covered by the index
+            models.Index(fields=['command'], name='botanalytics_command_idx'),
+            models.Index(fields=['device_location'], name='botanalytics_location_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user_id} - {self.user_name} - {self.command} - {self.timestamp}"
@@ -44,6 +60,79 @@ class LocationsAnalytics(models.Model):
     device_name = models.CharField(blank=True,max_length=50)
     device_province = models.CharField(blank=True,max_length=50)
 
+    class Meta:
+        indexes = [
+            # Raw tails of location_counts and rebuild_location_rollups: a range
+            # on timestamp grouped by name or province, covered by the index
+            models.Index(fields=['timestamp', 'device_province', 'device_name'], name='locations_time_place_idx'),
+            # The same with a province selected
+            models.Index(fields=['device_province', 'timestamp', 'device_name'], name='locations_province_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}  - {self.timestamp} - {self.device_id}"
+
+class UserLatencyStats(models.Model):
+    # Running latency totals per user, updated once per analytics batch
+    user_id = models.CharField(max_length=50, unique=True)  # Telegram user ID
+    count = models.PositiveIntegerField(default=0)
+    total_response_time = models.FloatField(default=0)
+    min_response_time = models.FloatField(null=True, blank=True)
+    max_response_time = models.FloatField(null=True, blank=True)
+    histogram = models.JSONField(default=dict, blank=True)  # LatencyHistogram buckets
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def avg_response_time(self):
+        return self.total_response_time / self.count if self.count else None
+
+    def __str__(self):
+        return f"{self.user_id} - {self.count} commands"
+
+
+class CommandLatencyHistogram(models.Model):
+    # Latency histogram per command, stage and hour; rows merge by adding buckets
+    command = models.CharField(max_length=100)
+    stage = models.CharField(max_length=50, default='total')
+    bucket_start = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+    histogram = models.JSONField(default=dict, blank=True)  # LatencyHistogram buckets
+
+    class Meta:
+        unique_together = ('command', 'stage', 'bucket_start')
+        # latency_summary reads one stage over a time range, across commands
+        indexes = [models.Index(fields=['stage', 'bucket_start'], name='latency_stage_bucket_idx')]
+
+    def __str__(self):
+        return f"{self.command} [{self.stage}] - {self.bucket_start}"
+
+
+class LocationsDailyRollup(models.Model):
+    # Device selections per local day, maintained on write next to LocationsAnalytics
+    day = models.DateField()
+    device_province = models.CharField(blank=True, max_length=50)
+    device_name = models.CharField(blank=True, max_length=50)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'device_province', 'device_name')
+
+    def __str__(self):
+        return f"{self.day} - {self.device_province} - {self.device_name}: {self.count}"
+
+
+class UserActivity(models.Model):
+    # One row per user, upserted by the analytics writer
+    user_id = models.CharField(max_length=50, unique=True)  # Telegram user ID
+    user_name = models.CharField(max_length=40, blank=True)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+    command_count = models.PositiveIntegerField(default=0)
+    last_command = models.CharField(max_length=100, blank=True)
+    last_log_id = models.BigIntegerField(null=True, blank=True)  # BotAnalytics row of the last command
+
+    class Meta:
+        verbose_name_plural = "User activity"
 
     def __str__(self):
-        return f"{self.user_id}  - {self.timestamp} - {self.device_id}"
\ No newline at end of file
+        return f"{self.user_id} - {self.user_name} - {self.last_seen}"
@@ -0,0 +1,146 @@
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, Sum
+from django.db.models.functions import TruncDate
+from django.utils.timezone import get_current_timezone, is_naive, localtime, make_aware
+
+from .models import BotAnalytics, LocationsAnalytics, LocationsDailyRollup, UserActivity
+
+
+def _day_start(day):
+    return make_aware(datetime.combine(day, time.min), get_current_timezone())
+
+
+def _aware(value):
+    # Admin query strings may carry datetimes without an offset
+    return make_aware(value) if is_naive(value) else value
+
+
+def increment_location_rollup(timestamp, province, device_name):
+    day = localtime(timestamp).date()
+    lookup = dict(day=day, device_province=province or '', device_name=device_name or '')
+    updated = LocationsDailyRollup.objects.filter(**lookup).update(count=F('count') + 1)
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            LocationsDailyRollup.objects.create(count=1, **lookup)
+    except IntegrityError:
+        # Created concurrently by another writer
+        LocationsDailyRollup.objects.filter(**lookup).update(count=F('count') + 1)
+
+
+def split_range(start, end):
+    """Split an inclusive datetime range into whole local days and raw tails.
+
+    Returns ``(first_day, last_day, raw_ranges)``; ``first_day`` is None
+    when the range does not cover a single whole day.
+    """
+    start, end = _aware(start), _aware(end)
+    start_local = localtime(start)
+    end_local = localtime(end)
+    first_day = start_local.date()
+    if start_local > _day_start(first_day):
+        first_day += timedelta(days=1)
+    last_day = end_local.date()
+    # The range is inclusive, so a day ending at 23:59:59.999999 counts as whole
+    if end_local < _day_start(last_day + timedelta(days=1)) - timedelta(microseconds=1):
+        last_day -= timedelta(days=1)
+
+    if first_day > last_day:
+        return None, None, [(start, end)]
+    raw_ranges = []
+    if start < _day_start(first_day):
+        raw_ranges.append((start, _day_start(first_day) - timedelta(microseconds=1)))
+    if end >= _day_start(last_day + timedelta(days=1)):
+        raw_ranges.append((_day_start(last_day + timedelta(days=1)), end))
+    return first_day, last_day, raw_ranges
+
+
+def location_counts(start, end, group_by, province=None):
+    """Selections per ``group_by`` field: rollups for whole days, raw rows for the tails."""
+    start, end = _aware(start), _aware(end)
+    first_day, last_day, raw_ranges = split_range(start, end)
+    counts = Counter()
+
+    if first_day is not None:
+        rollups = LocationsDailyRollup.objects.filter(day__range=(first_day, last_day))
+        if province is not None:
+            rollups = rollups.filter(device_province=province)
+        for row in rollups.values(group_by).annotate(count=Sum('count')):
+            counts[row[group_by]] += row['count']
+
+    for raw_start, raw_end in raw_ranges:
+        raw = LocationsAnalytics.objects.filter(timestamp__range=(raw_start, raw_end))
+        if province is not None:
+            raw = raw.filter(device_province=province)
+        for row in raw.values(group_by).annotate(count=Count(group_by)):
+            counts[row[group_by]] += row['count']
+
+    return [{group_by: key, 'count': count} for key, count in counts.most_common() if count]
+
+
+def rebuild_location_rollups(since=None):
+    """Recompute rollups from raw rows, from ``since`` (a date) onwards."""
+    raw = LocationsAnalytics.objects.all()
+    rollups = LocationsDailyRollup.objects.all()
+    if since is not None:
+        raw = raw.filter(timestamp__gte=_day_start(since))
+        rollups = rollups.filter(day__gte=since)
+    grouped = (
+        raw.annotate(day=TruncDate('timestamp', tzinfo=get_current_timezone()))
+        .values('day', 'device_province', 'device_name')
+        .annotate(count=Count('id'))
+    )
+    with transaction.atomic():
+        rollups.delete()
+        created = LocationsDailyRollup.objects.bulk_create(
+            [
+                LocationsDailyRollup(
+                    day=row['day'],
+                    device_province=row['device_province'] or '',
+                    device_name=row['device_name'] or '',
+                    count=row['count'],
+                )
+                for row in grouped.iterator()
+            ],
+            batch_size=500,
+        )
+    return len(created)
+
+
+def rebuild_user_activity():
+    """Recompute UserActivity from the full command log (backfill)."""
+    grouped = list(
+        BotAnalytics.objects.values('user_id').annotate(
+            first_seen=Min('timestamp'),
+            last_seen=Max('timestamp'),
+            command_count=Count('id'),
+            last_log_id=Max('id'),
+        )
+    )
+    last_rows = {
+        row['id']: row
+        for row in BotAnalytics.objects.filter(id__in=[row['last_log_id'] for row in grouped])
+        .values('id', 'user_name', 'command')
+    }
+    with transaction.atomic():
+        UserActivity.objects.all().delete()
+        created = UserActivity.objects.bulk_create(
+            [
+                UserActivity(
+                    user_id=row['user_id'],
+                    user_name=last_rows.get(row['last_log_id'], {}).get('user_name') or '',
+                    first_seen=row['first_seen'],
+                    last_seen=row['last_seen'],
+                    command_count=row['command_count'],
+                    last_command=last_rows.get(row['last_log_id'], {}).get('command') or '',
+                    last_log_id=row['last_log_id'],
+                )
+                for row in grouped
+            ],
+            batch_size=500,
+        )
+    return len(created)
@@ -1,3 +1,403 @@
-from django.test import TestCase
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+from datetime import datetime, timedelta
 
-# Create your tests here.
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import Count
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import make_aware, now
+
+from .admin import BotAnalyticsAdmin
+from .dashboard import compute_dashboard_stats, get_dashboard_stats
+from .filters import UserStatusFilter
+from .histogram import LatencyHistogram
+from .latency import latency_summary, normalize_command, record_latency_samples
+from .models import BotAnalytics, CommandLatencyHistogram, LocationsAnalytics, UserActivity, UserLatencyStats
+from .rollups import location_counts, split_range
+from .tracing import NULL_SPAN, current_trace, end_trace, stage, start_trace
+from .writer import AnalyticsEvent, AnalyticsWriter
+from users.models import TelegramUser
+
+
+def query_plan(queryset):
+    """Rows of SQLite's EXPLAIN QUERY PLAN for a queryset."""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+class QueryPlanTestCase(TestCase):
+    """Guards the analytics indexes against admin changes that bring back full scans."""
+
+    @classmethod
+    def setUpTestData(cls):
+        if connection.vendor != 'sqlite':
+            return
+        base = now() - timedelta(days=10)
+        BotAnalytics.objects.bulk_create([
+            BotAnalytics(user_id=str(i % 20), user_name=f"user{i % 20}", command=f"/cmd{i % 5}",
+                         device_location=f"Device {i % 7}", response_time=0.1)
+            for i in range(200)
+        ])
+        LocationsAnalytics.objects.bulk_create([
+            LocationsAnalytics(user_id=str(i % 20), device_id=i % 7, device_name=f"Device {i % 7}",
+                               device_province=f"Region {i % 3}")
+            for i in range(200)
+        ])
+        UserActivity.objects.bulk_create([
+            UserActivity(user_id=str(i), first_seen=base, last_seen=base + timedelta(days=i % 10),
+                         command_count=10, last_log_id=i + 1)
+            for i in range(20)
+        ])
+        with connection.cursor() as cursor:
+            # Give the planner statistics, as a production database would have
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN is SQLite specific')
+
+    def assertNoFullScan(self, queryset):
+        plan = query_plan(queryset)
+        table = queryset.model._meta.db_table
+        full_scans = [line for line in plan if re.fullmatch(rf"SCAN (TABLE )?{table}", line.strip())]
+        self.assertFalse(full_scans, f"Full table scan of {table}:\n" + "\n".join(plan))
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = query_plan(queryset)
+        self.assertTrue(any(index_name in line for line in plan), f"{index_name} not used:\n" + "\n".join(plan))
+
+    def test_dashboard_group_bys_use_covering_indexes(self):
+        commands = BotAnalytics.objects.values('command').annotate(total=Count('id'))
+        devices = BotAnalytics.objects.values('device_location').annotate(total=Count('id'))
+        self.assertUsesIndex(commands, 'botanalytics_command_idx')
+        self.assertUsesIndex(devices, 'botanalytics_location_idx')
+
+    def test_timestamp_filter_uses_index(self):
+        queryset = BotAnalytics.objects.filter(timestamp__gte=now() - timedelta(days=1))
+        self.assertNoFullScan(queryset)
+
+    def test_user_history_uses_index(self):
+        queryset = BotAnalytics.objects.filter(user_id='3').order_by('-timestamp')
+        self.assertUsesIndex(queryset, 'botanalytics_user_time_idx')
+
+    def test_status_filter_avoids_log_scan(self):
+        request = RequestFactory().get('/', {'status': 'active'})
+        for value in ('active', 'inactive'):
+            status = UserStatusFilter(request, {'status': value}, BotAnalytics, BotAnalyticsAdmin)
+            self.assertNoFullScan(status.queryset(request, BotAnalytics.objects.all()))
+
+    def test_location_tail_uses_covering_index(self):
+        end = now()
+        raw = LocationsAnalytics.objects.filter(timestamp__range=(end - timedelta(hours=6), end))
+        self.assertUsesIndex(raw.values('device_name').annotate(count=Count('device_name')),
+                             'locations_time_place_idx')
+        by_province = raw.filter(device_province='Region 1')
+        self.assertNoFullScan(by_province.values('device_name').annotate(count=Count('device_name')))
+
+    def test_latency_summary_uses_stage_index(self):
+        queryset = CommandLatencyHistogram.objects.filter(stage='total', bucket_start__gte=now() - timedelta(hours=24))
+        self.assertNoFullScan(queryset)
+
+
+class QueryCountTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        TelegramUser.objects.create(telegram_id=1, user_name='one')
+        UserActivity.objects.create(user_id='1', first_seen=now(), last_seen=now(), command_count=1)
+        BotAnalytics.objects.create(user_id='1', user_name='one', command='/Current', device_location='Yerevan')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_latency_summary_queries(self):
+        with self.assertNumQueries(2):
+            latency_summary()
+
+    def test_dashboard_stats_queries(self):
+        # Five aggregates here plus the two latency summary reads
+        with self.assertNumQueries(7):
+            stats = compute_dashboard_stats()
+        self.assertEqual(stats['total_users'], 1)
+        self.assertEqual(stats['active_users_len'], 1)
+        self.assertEqual(stats['total_commands'], 1)
+
+    def test_total_commands_counts_every_log(self):
+        # Logs from before UserActivity existed have no activity row yet
+        BotAnalytics.objects.create(user_id='2', user_name='two', command='/Help')
+        self.assertEqual(compute_dashboard_stats()['total_commands'], 2)
+
+    def test_cached_dashboard_runs_no_queries(self):
+        get_dashboard_stats()
+        with self.assertNumQueries(0):
+            get_dashboard_stats()
+
+    def test_location_counts_queries(self):
+        end = now()
+        # Whole days come from one rollup query, each raw tail is one more
+        first_day, last_day, raw_ranges = split_range(end - timedelta(days=3), end)
+        with self.assertNumQueries(1 + len(raw_ranges)):
+            location_counts(end - timedelta(days=3), end, 'device_name')
+
+    def test_location_counts_accepts_naive_datetimes(self):
+        # Admin query strings like ?startDate=2025-01-01T00:00:00 parse to naive datetimes
+        start = datetime(2025, 1, 1)
+        self.assertEqual(split_range(start, start + timedelta(days=2)), split_range(
+            make_aware(start), make_aware(start + timedelta(days=2))))
+        location_counts(start, start + timedelta(days=2), 'device_name')
+
+
+class AnalyticsWriterTestCase(TransactionTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spill_path = os.path.join(directory, 'spill.jsonl')
+        self.writer = AnalyticsWriter(batch_size=2, spill_path=self.spill_path)
+
+    def events(self, *commands):
+        return [
+            AnalyticsEvent(user_id=1, user_name='one', first_name='', last_name='', command=command,
+                           success=True, response_time=0.1, created_at=time.time())
+            for command in commands
+        ]
+
+    def spill(self, path, events):
+        with open(path, 'a', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(asdict(event)) + '\n')
+
+    def commands(self):
+        return sorted(BotAnalytics.objects.values_list('command', flat=True))
+
+    def failing_writes(self, *failures):
+        """Make the listed calls of write (1-based) fail as a locked database would."""
+        write, calls = self.writer.write, []
+
+        def flaky(events):
+            calls.append(len(calls) + 1)
+            if calls[-1] in failures:
+                raise OperationalError('database is locked')
+            write(events)
+
+        self.writer.write = flaky
+
+    def test_failed_batch_is_spilled_and_replayed(self):
+        self.failing_writes(1)
+        self.assertFalse(self.writer._write_or_spill(self.events('/a', '/b')))
+        self.assertEqual(self.writer.stats()['spilled'], 2)
+        self.assertEqual(self.commands(), [])
+
+        self.writer._replay_spill()
+        self.assertEqual(self.commands(), ['/a', '/b'])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_failed_replay_keeps_the_rest(self):
+        self.spill(self.spill_path, self.events('/a', '/b', '/c', '/d', '/e'))
+        self.failing_writes(2)
+        self.writer._replay_spill()
+        self.assertEqual(self.commands(), ['/a', '/b'])
+        self.assertFalse(os.path.exists(f"{self.spill_path}.replay"))
+
+        self.writer._replay_spill()
+        self.assertEqual(self.commands(), ['/a', '/b', '/c', '/d', '/e'])
+
+    def test_leftover_replay_file_goes_first(self):
+        # Left by a process that died mid-replay
+        self.spill(f"{self.spill_path}.replay", self.events('/old'))
+        self.spill(self.spill_path, self.events('/new'))
+        self.writer._replay_spill()
+        self.assertEqual(self.commands(), ['/old'])
+        self.writer._replay_spill()
+        self.assertEqual(self.commands(), ['/new', '/old'])
+
+    def test_full_queue_spills(self):
+        writer = AnalyticsWriter(max_queue=1, overflow='spill', spill_path=self.spill_path)
+        # Not started, so nothing drains the queue
+        writer.start = lambda: None
+        for event in self.events('/a', '/b', '/c'):
+            writer.submit(event)
+        self.assertEqual(writer.stats(), {'queued': 1, 'written': 0, 'dropped': 0, 'spilled': 2})
+
+
+class LatencyHistogramTestCase(SimpleTestCase):
+
+    def test_merge_matches_recording_everything_in_one(self):
+        first, second, both = LatencyHistogram(), LatencyHistogram(), LatencyHistogram()
+        for value in (0.01, 0.2, 0.2, 3):
+            first.record(value)
+            both.record(value)
+        for value in (0.0001, 0.5, None):
+            second.record(value)
+            both.record(value)
+        self.assertEqual(first.merge(second).counts, both.counts)
+        self.assertEqual(first.total, 7)
+
+    def test_survives_a_json_round_trip(self):
+        histogram = LatencyHistogram()
+        histogram.record(0.25, count=3)
+        data = json.loads(json.dumps(histogram.to_json()))
+        self.assertEqual(LatencyHistogram.from_json(data).counts, histogram.counts)
+        self.assertEqual(LatencyHistogram.from_json(None).total, 0)
+
+
+class UserLatencyStatsTestCase(TransactionTestCase):
+
+    def event(self, user_id, response_time):
+        return AnalyticsEvent(user_id=user_id, user_name='', first_name='', last_name='', command='/Current',
+                              success=True, response_time=response_time, created_at=time.time())
+
+    def test_batches_fold_into_running_totals(self):
+        writer = AnalyticsWriter()
+        writer.write([self.event(1, 0.5), self.event(1, 0.1), self.event(2, 2.0)])
+        writer.write([self.event(1, 0.9)])
+
+        stats = UserLatencyStats.objects.get(user_id='1')
+        self.assertEqual(stats.count, 3)
+        self.assertAlmostEqual(stats.avg_response_time, 0.5)
+        self.assertEqual((stats.min_response_time, stats.max_response_time), (0.1, 0.9))
+        self.assertEqual(LatencyHistogram.from_json(stats.histogram).total, 3)
+        self.assertEqual(UserLatencyStats.objects.get(user_id='2').count, 1)
+
+        # Each log row carries the user's running min and max as of its batch
+        last = BotAnalytics.objects.filter(user_id='1').latest('id')
+        self.assertEqual((last.min_response_time, last.max_response_time), (0.1, 0.9))
+
+
+class LatencyPercentileTestCase(TestCase):
+
+    def test_percentiles_are_within_one_bucket(self):
+        histogram = LatencyHistogram()
+        values = [i / 100 for i in range(1, 101)]
+        for value in values:
+            histogram.record(value)
+        for p, exact in ((50, 0.5), (95, 0.95), (99, 0.99)):
+            estimate = histogram.percentile(p)
+            self.assertGreaterEqual(estimate, exact)
+            self.assertLessEqual(estimate, exact * LatencyHistogram.GROWTH * LatencyHistogram.GROWTH)
+        self.assertIsNone(LatencyHistogram().percentile(50))
+
+    def test_commands_are_a_fixed_set_of_labels(self):
+        self.assertEqual(normalize_command('/Current 📍Berd'), '/Current')
+        self.assertEqual(normalize_command('/start@climate_bot'), '/start')
+        self.assertEqual(normalize_command('/whatever'), '(other)')
+        self.assertEqual(normalize_command('Yerevan'), '(selection)')
+        self.assertEqual(normalize_command(None), '(media)')
+
+    def test_samples_merge_into_hourly_rows(self):
+        created_at = now().timestamp()
+        record_latency_samples([('/Current', 'total', created_at, 0.1), ('/Current', 'fetch', created_at, 0.05)])
+        record_latency_samples([('/Current', 'total', created_at, 2.0)])
+        row = CommandLatencyHistogram.objects.get(command='/Current', stage='total')
+        self.assertEqual(row.count, 2)
+        self.assertEqual(LatencyHistogram.from_json(row.histogram).total, 2)
+
+        summary = latency_summary()
+        self.assertEqual([(c['command'], c['count']) for c in summary['commands']], [('/Current', 2)])
+        self.assertGreaterEqual(summary['commands'][0]['p99'], 2.0)
+        self.assertEqual(len(summary['trend']['(all)']), 1)
+        self.assertEqual([(s['stage'], s['count']) for s in summary['stages']], [('fetch', 1)])
+
+
+class TracingTestCase(SimpleTestCase):
+
+    def tearDown(self):
+        end_trace()
+
+    def test_stages_nest_and_add_up(self):
+        trace = start_trace()
+        with stage('fetch'):
+            with stage('http'):
+                time.sleep(0.01)
+        with stage('fetch'):
+            pass
+        self.assertIs(end_trace(), trace)
+        self.assertEqual(sorted(trace.stages), ['fetch', 'fetch/http'])
+        self.assertGreaterEqual(trace.stages['fetch'], trace.stages['fetch/http'])
+        self.assertGreaterEqual(trace.stages['fetch/http'], 0.01)
+        self.assertIsNone(current_trace())
+
+    def test_failing_stage_is_still_timed(self):
+        trace = start_trace()
+        with self.assertRaises(ValueError):
+            with stage('render'):
+                raise ValueError('broken template')
+        with stage('send'):
+            pass
+        self.assertEqual(sorted(trace.stages), ['render', 'send'])
+
+    @override_settings(ANALYTICS_TRACING={'SAMPLE_RATE': 0})
+    def test_unsampled_updates_get_the_shared_no_op(self):
+        self.assertIsNone(start_trace())
+        self.assertIs(stage('fetch'), NULL_SPAN)
+
+    def test_traces_are_per_thread(self):
+        start_trace()
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(current_trace()))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+
+
+class LinkAnalyticsUsersTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {
+            telegram_id: TelegramUser.objects.create(telegram_id=telegram_id, user_name=f"user{telegram_id}")
+            for telegram_id in (1, 2)
+        }
+        BotAnalytics.objects.bulk_create([
+            BotAnalytics(user_id=str(i % 3 + 1), user_name='', command='/Current') for i in range(7)
+        ])
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.checkpoint = os.path.join(directory, 'checkpoint')
+
+    def link(self, *args):
+        call_command('link_analytics_users', '--chunk-size', '3', '--checkpoint', self.checkpoint, *args,
+                     stdout=StringIO())
+
+    def links(self):
+        return dict(BotAnalytics.objects.values_list('pk', 'telegram_user_id'))
+
+    def test_links_every_row_in_chunks(self):
+        self.link()
+        for row in BotAnalytics.objects.all():
+            user = self.users.get(int(row.user_id))
+            self.assertEqual(row.telegram_user_id, user.pk if user else None)
+        with open(self.checkpoint, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['last_pk'], BotAnalytics.objects.latest('pk').pk)
+
+    def test_resumes_after_the_checkpoint(self):
+        first = BotAnalytics.objects.order_by('pk')[3]
+        with open(self.checkpoint, 'w', encoding='utf-8') as f:
+            json.dump({'last_pk': first.pk}, f)
+        self.link()
+        linked = {pk for pk, user_pk in self.links().items() if user_pk is not None}
+        self.assertTrue(linked)
+        self.assertTrue(all(pk > first.pk for pk in linked))
+
+        self.link('--restart')
+        self.assertTrue(any(pk <= first.pk and user_pk for pk, user_pk in self.links().items()))
+
+    def test_queries_per_chunk_stay_flat(self):
+        # Users, then per chunk of 3 one read and one bulk update in its own
+        # transaction (a savepoint pair inside the test case), then the empty read
+        with self.assertNumQueries(1 + 3 * 4 + 1):
+            self.link()
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+
+_local = threading.local()
+
+
+class Trace:
+    """Stage timings collected while one update is handled."""
+
+    __slots__ = ('correlation_id', 'stages', '_stack')
+
+    def __init__(self, correlation_id=None):
+        self.correlation_id = correlation_id or uuid.uuid4().hex
+        self.stages = {}
+        self._stack = []
+
+    def add(self, name, duration):
+        self.stages[name] = self.stages.get(name, 0.0) + duration
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        stack = self.trace._stack
+        # Nested stages are recorded as "outer/inner"
+        self.name = f"{stack[-1]}/{self.name}" if stack else self.name
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, time.perf_counter() - self.start)
+        self.trace._stack.pop()
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def sample_rate():
+    return getattr(settings, 'ANALYTICS_TRACING', {}).get('SAMPLE_RATE', 1.0)
+
+
+def start_trace():
+    """Begin a trace for the current update, or none if it is not sampled."""
+    rate = sample_rate()
+    trace = Trace() if rate >= 1 or (rate > 0 and random.random() < rate) else None
+    _local.trace = trace
+    return trace
+
+
+def end_trace():
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    return trace
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def stage(name):
+    """Time a named stage of the current update::
+
+        with stage('render'):
+            image = render_html_to_image(html)
+
+    Without a sampled trace this returns a shared no-op context manager.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return NULL_SPAN
+    return _Span(trace, name)
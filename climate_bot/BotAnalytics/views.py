@@ -1,41 +1,40 @@
 import time
-from django.db import models  # Import models for aggregation
+from django.db import transaction
 from django.utils import timezone  # For accurate timestamping
-from .models import BotAnalytics,LocationsAnalytics
-from users.utils import save_telegram_user
+from .models import LocationsAnalytics
+from .writer import AnalyticsEvent, get_analytics_writer
+from .tracing import start_trace, end_trace
+from .rollups import increment_location_rollup
 
 def log_command_decorator(func):
     def wrapper(message):
         start_time = time.perf_counter()  # Start timing
+        trace = start_trace()  # Stage timings, when this update is sampled
         try:
             func(message)
             success = True
         except Exception as e:
             success = False
+        finally:
+            end_trace()
         end_time = time.perf_counter()  # End timing
         latency = end_time - start_time
 
-        # Save analytics data
-        # print(message.from_user)
-        
-        save_telegram_user(message.from_user)
-        BotAnalytics.objects.create(
-            user_id=message.from_user.id,
-            user_name=message.from_user.username,
+        # Analytics are written in batches by a background thread,
+        # so the handler returns without touching the database
+        from_user = message.from_user
+        get_analytics_writer().submit(AnalyticsEvent(
+            user_id=from_user.id,
+            user_name=from_user.username,
+            first_name=from_user.first_name,
+            last_name=from_user.last_name,
             command=message.text,
             success=success,
             response_time=latency,
-        )
-
-        # Update min/max response times
-        analytics = BotAnalytics.objects.filter(user_id=message.from_user.id)
-        min_latency = analytics.aggregate(models.Min('response_time'))['response_time__min']
-        max_latency = analytics.aggregate(models.Max('response_time'))['response_time__max']
-
-        BotAnalytics.objects.filter(id=analytics.latest('timestamp').id).update(
-            min_response_time=min_latency,
-            max_response_time=max_latency,
-        )
+            created_at=time.time(),
+            correlation_id=trace.correlation_id if trace else '',
+            stages=trace.stages if trace else None,
+        ))
 
     return wrapper
 
@@ -45,12 +44,15 @@ def save_selected_device_to_db(user_id=None, context=None,device_id = None):
     print(f"save_selected_device_to_db called with user_id={user_id} and context={context}")
     if user_id is not None and context is not None and device_id is not None:
         try:
-            LocationsAnalytics.objects.create(
-                user_id=user_id,
-                device_id=context.get('device_id'),
-                device_name=context.get('selected_device'),
-                device_province=context.get('selected_country')
-            )
+            # Together, so the daily rollup never drifts from the raw rows
+            with transaction.atomic():
+                selection = LocationsAnalytics.objects.create(
+                    user_id=user_id,
+                    device_id=context.get('device_id'),
+                    device_name=context.get('selected_device'),
+                    device_province=context.get('selected_country')
+                )
+                increment_location_rollup(selection.timestamp, selection.device_province, selection.device_name)
             print("Device saved successfully!")
         except Exception as e:
             print(f"Failed to save device: {e}")
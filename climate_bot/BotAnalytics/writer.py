@@ -0,0 +1,333 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .histogram import LatencyHistogram
+from .latency import normalize_command, record_latency_samples
+from .models import BotAnalytics, UserActivity, UserLatencyStats
+from users.models import TelegramUser
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AnalyticsEvent:
+    user_id: int
+    user_name: str
+    first_name: str
+    last_name: str
+    command: str
+    success: bool
+    response_time: float
+    created_at: float
+    correlation_id: str = ''
+    stages: dict = None
+
+
+class AnalyticsWriter:
+    """Background writer for command analytics.
+
+    Handlers only put an event on a bounded in-memory queue; a writer
+    thread flushes with ``bulk_create`` every ``batch_size`` events or
+    ``flush_interval`` seconds. When the queue is full, events are either
+    dropped or spilled to a JSON-lines file that is replayed once the
+    backlog clears. Batches the database rejects are spilled the same way.
+    """
+
+    def __init__(self, batch_size=100, flush_interval=0.5, max_queue=10000, overflow='drop', spill_path=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.dropped = 0
+        self.spilled = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        # Not restarted once shut down, atexit already ran
+        if self._thread is not None or self._stop.is_set():
+            return
+        self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def submit(self, event):
+        if self._stop.is_set():
+            # Nothing drains the queue after shutdown
+            self._overflow(event)
+            return
+        self.start()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._overflow(event)
+
+    def _overflow(self, event):
+        if self.overflow == 'spill' and self.spill_path:
+            self._spill(event)
+        else:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Analytics queue full, {self.dropped} events dropped so far")
+
+    def _spill(self, event):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(asdict(event)) + '\n')
+            self.spilled += 1
+
+    def _replay_spill(self):
+        if not self.spill_path:
+            return
+        replay_path = f"{self.spill_path}.replay"
+        # A leftover replay file is from a process that died mid-replay and goes first
+        if not os.path.exists(replay_path):
+            with self._spill_lock:
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, replay_path)
+        with open(replay_path, 'r', encoding='utf-8') as f:
+            batch = []
+            for line in f:
+                try:
+                    batch.append(AnalyticsEvent(**json.loads(line)))
+                except (ValueError, TypeError):
+                    continue
+                if len(batch) >= self.batch_size:
+                    if not self._write_or_spill(batch):
+                        # The database is still failing, keep the rest for the next replay
+                        self._spill_lines(f)
+                        break
+                    batch = []
+            else:
+                if batch:
+                    self._write_or_spill(batch)
+        os.remove(replay_path)
+        logger.info(f"Replayed spilled analytics events from {self.spill_path}")
+
+    def _spill_lines(self, lines):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(line)
+                    self.spilled += 1
+
+    def _write_or_spill(self, batch):
+        """Write a batch; if that fails, spill it to be replayed later instead of losing it."""
+        try:
+            self.write(batch)
+            return True
+        except Exception as e:
+            logger.error(f"Analytics writer error: {e}")
+        if self.spill_path:
+            for event in batch:
+                self._spill(event)
+        else:
+            self.dropped += len(batch)
+        return False
+
+    def _run(self):
+        self._safe(self._replay_spill)
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self._stop.is_set() and self._queue.empty()):
+            timeout = max(0, deadline - time.monotonic())
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                if batch:
+                    written = self._write_or_spill(batch)
+                    batch = []
+                    if written and self._queue.empty():
+                        self._safe(self._replay_spill)
+                deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self._write_or_spill(batch)
+
+    def _safe(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error(f"Analytics writer error: {e}")
+
+    def write(self, events):
+        close_old_connections()
+        users = {}
+        for event in events:
+            users[event.user_id] = event
+
+        with transaction.atomic():
+            TelegramUser.objects.bulk_create(
+                [
+                    TelegramUser(
+                        telegram_id=event.user_id,
+                        user_name=event.user_name,
+                        first_name=event.first_name,
+                        last_name=event.last_name,
+                    )
+                    for event in users.values()
+                ],
+                update_conflicts=True,
+                unique_fields=['telegram_id'],
+                update_fields=['user_name', 'first_name', 'last_name'],
+            )
+
+            user_pks = {
+                str(telegram_id): pk
+                for telegram_id, pk in TelegramUser.objects.filter(telegram_id__in=users).values_list('telegram_id', 'pk')
+            }
+            stats = self._update_user_stats(events)
+            rows = []
+            for event in events:
+                user_stats = stats[str(event.user_id)]
+                rows.append(BotAnalytics(
+                    user_id=str(event.user_id),
+                    telegram_user_id=user_pks.get(str(event.user_id)),
+                    user_name=event.user_name or '',
+                    command=(event.command or '')[:100],
+                    # When the command ran, not when this batch (or a spill replay) is written
+                    timestamp=datetime.fromtimestamp(event.created_at, tz=dt_timezone.utc),
+                    success=event.success,
+                    response_time=event.response_time,
+                    min_response_time=user_stats.min_response_time,
+                    max_response_time=user_stats.max_response_time,
+                    correlation_id=event.correlation_id or '',
+                    stages=event.stages,
+                ))
+            BotAnalytics.objects.bulk_create(rows)
+            self._update_user_activity(rows)
+            record_latency_samples(self._latency_samples(events))
+        self.written += len(events)
+
+    def _latency_samples(self, events):
+        for event in events:
+            command = normalize_command(event.command)
+            yield command, 'total', event.created_at, event.response_time
+            for stage, duration in (event.stages or {}).items():
+                yield command, stage[:50], event.created_at, duration
+
+    def _update_user_stats(self, events):
+        """Fold the batch into the per-user running totals, O(1) per event.
+
+        Rows are created if missing and then locked, so writers in other
+        processes merge one after another instead of overwriting each other.
+        """
+        batches = {}
+        for event in events:
+            batches.setdefault(str(event.user_id), []).append(event.response_time)
+        UserLatencyStats.objects.bulk_create(
+            [UserLatencyStats(user_id=user_id, histogram={}) for user_id in sorted(batches)],
+            ignore_conflicts=True,
+        )
+        stats = {
+            row.user_id: row
+            for row in UserLatencyStats.objects.select_for_update().filter(user_id__in=batches).order_by('user_id')
+        }
+        now = timezone.now()
+        for user_id, latencies in batches.items():
+            row = stats[user_id]
+            histogram = LatencyHistogram.from_json(row.histogram)
+            for latency in latencies:
+                histogram.record(latency)
+            row.count = F('count') + len(latencies)
+            row.total_response_time = F('total_response_time') + sum(latencies)
+            row.min_response_time = min(latencies if row.min_response_time is None else [row.min_response_time, *latencies])
+            row.max_response_time = max(latencies if row.max_response_time is None else [row.max_response_time, *latencies])
+            row.histogram = histogram.to_json()
+            # bulk_update does not touch auto_now fields
+            row.updated_at = now
+        UserLatencyStats.objects.bulk_update(
+            stats.values(),
+            ['count', 'total_response_time', 'min_response_time', 'max_response_time', 'histogram', 'updated_at'],
+        )
+        return stats
+
+    def _update_user_activity(self, rows):
+        """Upsert first/last seen, command count and last command per user."""
+        batches = {}
+        for log in rows:
+            batches.setdefault(log.user_id, []).append(log)
+        UserActivity.objects.bulk_create(
+            [
+                UserActivity(user_id=user_id, first_seen=logs[0].timestamp, last_seen=logs[0].timestamp)
+                for user_id, logs in sorted(batches.items())
+            ],
+            ignore_conflicts=True,
+        )
+        activity = UserActivity.objects.select_for_update().filter(user_id__in=batches).order_by('user_id')
+        to_update = []
+        for row in activity:
+            logs = batches[row.user_id]
+            row.command_count = F('command_count') + len(logs)
+            row.first_seen = min(row.first_seen, *(log.timestamp for log in logs))
+            last = max(logs, key=lambda log: log.timestamp)
+            if last.timestamp >= row.last_seen:
+                # Replayed events can be older than what another writer already stored
+                row.user_name = last.user_name
+                row.last_seen = last.timestamp
+                row.last_command = last.command
+                row.last_log_id = last.pk
+            to_update.append(row)
+        UserActivity.objects.bulk_update(
+            to_update,
+            ['user_name', 'first_seen', 'last_seen', 'command_count', 'last_command', 'last_log_id'],
+        )
+
+    def shutdown(self, timeout=10):
+        self._stop.set()
+        if self._thread is None:
+            return
+        self._thread.join(timeout=timeout)
+        self._thread = None
+        logger.info(f"Analytics writer stopped ({self.written} written, {self.dropped} dropped)")
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_analytics_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                config = getattr(settings, 'ANALYTICS_WRITER', {})
+                _writer = AnalyticsWriter(
+                    batch_size=config.get('BATCH_SIZE', 100),
+                    flush_interval=config.get('FLUSH_INTERVAL_MS', 500) / 1000,
+                    max_queue=config.get('MAX_QUEUE', 10000),
+                    overflow=config.get('OVERFLOW', 'drop'),
+                    spill_path=config.get('SPILL_PATH'),
+                )
+    return _writer
+
+
+def shutdown_analytics_writer():
+    if _writer is not None:
+        _writer.shutdown()
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bot'
+
+    def ready(self):
+        # Telegram API calls made through telebot share the pooled HTTP client
+        from climate_bot.http_client import install_telebot_sender
+        install_telebot_sender()
@@ -0,0 +1,368 @@
+import hashlib
+import threading
+import time
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+
+# ClimateNet stations report once every quarter of the hour
+MEASUREMENT_INTERVAL = 15 * 60
+
+
+def next_measurement_boundary(now=None, interval=MEASUREMENT_INTERVAL, grace=0):
+    """Timestamp of the next quarter-hour boundary, shifted by ``grace`` seconds.
+
+    Upstream needs a little time to ingest a fresh measurement, so the
+    boundary is pushed forward by ``grace``; requests landing inside that
+    window still expire at ``boundary + grace`` rather than 15 minutes later.
+    """
+    now = time.time() if now is None else now
+    shifted = now - grace
+    return (shifted // interval + 1) * interval + grace
+
+
+class LocalMeasurementBackend:
+    """In-process LRU store, suitable for a single bot worker."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoMeasurementBackend:
+    """Store backed by Django's cache framework, shared between processes.
+
+    Size bounds and eviction are those of the configured cache
+    (``MAX_ENTRIES`` / ``CULL_FREQUENCY`` for locmem and file caches,
+    ``maxmemory-policy`` for redis).
+    """
+
+    def __init__(self, alias='default', key_prefix='measurement'):
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, key):
+        return f"{self.key_prefix}:{key}"
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, expires_at):
+        timeout = max(1, int(expires_at - time.time()))
+        self.cache.set(self._key(key), value, timeout=timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+    def clear(self):
+        # Other keys may live in the same cache, so nothing is wiped here
+        pass
+
+
+class MeasurementCache:
+    """Latest-measurement cache keyed by device id.
+
+    Entries expire at the next expected measurement boundary instead of
+    after a fixed TTL. Concurrent misses for the same device are collapsed
+    into a single upstream request.
+    """
+
+    def __init__(self, backend, interval=MEASUREMENT_INTERVAL, grace=90):
+        self.backend = backend
+        self.interval = interval
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._fetch_locks = {}
+        self._fetch_locks_guard = threading.Lock()
+
+    def expires_at(self, now=None):
+        return next_measurement_boundary(now, interval=self.interval, grace=self.grace)
+
+    def _fetch_lock(self, device_id):
+        with self._fetch_locks_guard:
+            lock = self._fetch_locks.get(device_id)
+            if lock is None:
+                lock = self._fetch_locks[device_id] = threading.Lock()
+            return lock
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, device_id):
+        value = self.backend.get(device_id)
+        self._count(value is not None)
+        return value
+
+    def set(self, device_id, measurement, expires_at=None):
+        if measurement is None:
+            return
+        self.backend.set(device_id, measurement, expires_at or self.expires_at())
+
+    def get_or_fetch(self, device_id, fetch):
+        value = self.backend.get(device_id)
+        if value is not None:
+            self._count(True)
+            return value
+
+        with self._fetch_lock(device_id):
+            # Another thread may have filled the entry while we waited
+            value = self.backend.get(device_id)
+            if value is not None:
+                self._count(True)
+                return value
+            self._count(False)
+            value = fetch(device_id)
+            # Failures are not cached so the next request retries upstream
+            self.set(device_id, value)
+            return value
+
+    def invalidate(self, device_id):
+        self.backend.delete(device_id)
+
+    def stats(self):
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+class ComparisonImageCache:
+    """Rendered comparison images keyed by a hash of the generated HTML.
+
+    Each entry keeps the PNG bytes and, once uploaded, the Telegram
+    ``file_id`` so repeat requests can be re-sent without rendering or
+    uploading. While the first upload is in flight its future is kept in
+    ``upload`` so other chats can wait for the ``file_id`` instead of
+    uploading the same picture again. Entries expire at the next measurement boundary, and are
+    dropped as soon as the same set of devices is compared with newer
+    measurement timestamps.
+    """
+
+    def __init__(self, max_entries=128, interval=MEASUREMENT_INTERVAL, grace=90):
+        self.max_entries = max_entries
+        self.interval = interval
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # (device ids) -> (timestamps, key) of the latest rendered comparison
+        self._by_devices = {}
+        self._lock = threading.Lock()
+        # key -> (lock, number of threads holding or waiting for it)
+        self._render_locks = {}
+
+    @staticmethod
+    def make_key(html_content):
+        return hashlib.sha256(html_content.encode('utf-8')).hexdigest()
+
+    def _evict(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            devices = entry['devices']
+            if self._by_devices.get(devices, (None, None))[1] == key:
+                del self._by_devices[devices]
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry['expires_at'] <= time.time():
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(entry)
+
+    def peek(self, key):
+        """Like get, but not counted: for a second look within the same request."""
+        with self._lock:
+            entry = self._get(key)
+            return dict(entry) if entry is not None else None
+
+    def set(self, key, image, device_ids=(), timestamps=()):
+        devices = tuple(device_ids)
+        timestamps = tuple(timestamps)
+        with self._lock:
+            previous = self._by_devices.get(devices)
+            if previous is not None and previous[0] != timestamps:
+                # Measurements changed, so the old picture is stale
+                self._evict(previous[1])
+            self._entries[key] = {
+                'image': image,
+                'file_id': None,
+                'upload': None,
+                'devices': devices,
+                'expires_at': next_measurement_boundary(interval=self.interval, grace=self.grace),
+            }
+            self._entries.move_to_end(key)
+            if devices:
+                self._by_devices[devices] = (timestamps, key)
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def set_file_id(self, key, file_id):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['file_id'] = file_id
+
+    def forget_file_id(self, key):
+        self.set_file_id(key, None)
+
+    def set_upload(self, key, future):
+        """Remember the in-flight upload of ``key`` and its file_id once it is sent."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['upload'] = future
+        future.add_done_callback(lambda done: self._upload_done(key, done))
+
+    def _upload_done(self, key, future):
+        file_id = None
+        if not future.cancelled() and future.exception() is None:
+            sent = future.result()
+            if sent and sent.photo:
+                file_id = sent.photo[-1].file_id
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['upload'] is not future:
+                return
+            entry['upload'] = None
+            if file_id:
+                entry['file_id'] = file_id
+
+    @contextmanager
+    def render_lock(self, key):
+        with self._lock:
+            lock, users = self._render_locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._render_locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._render_locks[key]
+                # Dropped with its last user, so the table only holds keys in use
+                if users == 1:
+                    del self._render_locks[key]
+                else:
+                    self._render_locks[key] = (lock, users - 1)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+def build_measurement_cache():
+    config = getattr(settings, 'MEASUREMENT_CACHE', {})
+    backend_name = config.get('BACKEND', 'local')
+    if backend_name == 'django':
+        backend = DjangoMeasurementBackend(alias=config.get('CACHE_ALIAS', 'default'))
+    elif backend_name == 'local':
+        backend = LocalMeasurementBackend(max_entries=config.get('MAX_ENTRIES', 512))
+    else:
+        raise ValueError(f"Unknown MEASUREMENT_CACHE backend: {backend_name}")
+    logger.debug(f"Measurement cache backend: {backend_name}")
+    return MeasurementCache(
+        backend,
+        interval=config.get('INTERVAL_SECONDS', MEASUREMENT_INTERVAL),
+        grace=config.get('GRACE_SECONDS', 90),
+    )
+
+
+_measurement_cache = None
+_measurement_cache_lock = threading.Lock()
+
+
+def get_measurement_cache():
+    global _measurement_cache
+    if _measurement_cache is None:
+        with _measurement_cache_lock:
+            if _measurement_cache is None:
+                _measurement_cache = build_measurement_cache()
+    return _measurement_cache
+
+
+_image_cache = None
+
+
+def get_image_cache():
+    global _image_cache
+    if _image_cache is None:
+        with _measurement_cache_lock:
+            if _image_cache is None:
+                config = getattr(settings, 'COMPARISON_IMAGE_CACHE', {})
+                measurement_config = getattr(settings, 'MEASUREMENT_CACHE', {})
+                _image_cache = ComparisonImageCache(
+                    max_entries=config.get('MAX_ENTRIES', 128),
+                    interval=measurement_config.get('INTERVAL_SECONDS', MEASUREMENT_INTERVAL),
+                    grace=measurement_config.get('GRACE_SECONDS', 90),
+                )
+    return _image_cache
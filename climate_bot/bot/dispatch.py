@@ -0,0 +1,59 @@
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+REGION = 'region'
+DEVICE = 'device'
+
+
+def build_dispatch_index(catalog):
+    """Map exact keyboard button text to ``(kind, entity)``."""
+    index = {}
+    for region, devices in catalog.locations.items():
+        for device in devices:
+            index[device] = (DEVICE, device)
+    # Region buttons win over a device with the same name, as with the old filter order
+    for region in catalog.locations:
+        index[region] = (REGION, region)
+    return index
+
+
+class CatalogRouter:
+    """Routes region and device button presses with one dict lookup.
+
+    The index is rebuilt only when the registry publishes a new catalog.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._handlers = {}
+        self._catalog = None
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    @property
+    def index(self):
+        catalog = self.registry.catalog
+        if catalog is not self._catalog:
+            with self._lock:
+                if catalog is not self._catalog:
+                    self._index = build_dispatch_index(catalog)
+                    self._catalog = catalog
+                    logger.debug(f"Dispatch index rebuilt with {len(self._index)} entries (catalog v{catalog.version})")
+        return self._index
+
+    def resolve(self, text):
+        return self.index.get(text)
+
+    def matches(self, message):
+        return message.text is not None and message.text in self.index
+
+    def dispatch(self, message):
+        kind, entity = self.index[message.text]
+        return self._handlers[kind](message)
@@ -0,0 +1,324 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+_STOP = object()
+
+
+def chat_key(args):
+    """Chat id of the update a telebot task was queued for, if there is one."""
+    if not args:
+        return None
+    update = args[0]
+    chat = getattr(update, 'chat', None)
+    if chat is None:
+        # Callback queries carry the message they belong to
+        message = getattr(update, 'message', None)
+        chat = getattr(message, 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'from_user', None)
+    return getattr(user, 'id', None)
+
+
+class Lane:
+    __slots__ = ('index', 'queue', 'thread', 'processed', 'total_latency', 'max_latency', 'total_wait')
+
+    def __init__(self, index, max_queue):
+        self.index = index
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.processed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_wait = 0.0
+
+    def as_dict(self):
+        return {
+            'depth': self.queue.qsize(),
+            'processed': self.processed,
+            'avg_latency': round(self.total_latency / self.processed, 4) if self.processed else 0.0,
+            'max_latency': round(self.max_latency, 4),
+            'avg_wait': round(self.total_wait / self.processed, 4) if self.processed else 0.0,
+        }
+
+
+class LaneExecutor:
+    """Runs telebot tasks on lanes sharded by chat id.
+
+    Every chat always lands on the same lane, so its messages are handled
+    one at a time and in order, while different chats run in parallel.
+    Tasks without a chat go round-robin. Implements the part of
+    ``telebot.util.ThreadPool`` that TeleBot uses, so it can replace
+    ``bot.worker_pool``.
+    """
+
+    def __init__(self, telebot=None, lanes=8, max_queue=0, name='bot-lane', on_exception=None):
+        self.telebot = telebot
+        self.name = name
+        self._on_exception = on_exception or self.on_exception
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self._lanes = [Lane(index, max_queue) for index in range(lanes)]
+        self._next = 0
+        for lane in self._lanes:
+            lane.thread = threading.Thread(target=self._run, args=(lane,), name=f"{name}-{lane.index}", daemon=True)
+            lane.thread.start()
+
+    def lane_for(self, key):
+        if key is None:
+            self._next = (self._next + 1) % len(self._lanes)
+            return self._lanes[self._next]
+        return self._lanes[hash(key) % len(self._lanes)]
+
+    def put(self, func, *args, **kwargs):
+        self.lane_for(chat_key(args)).queue.put((func, args, kwargs, time.perf_counter()))
+
+    def try_put(self, func, *args, **kwargs):
+        """Like put, but returns False instead of waiting when the lane is full."""
+        try:
+            self.lane_for(chat_key(args)).queue.put_nowait((func, args, kwargs, time.perf_counter()))
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self, lane):
+        while True:
+            item = lane.queue.get()
+            if item is _STOP:
+                return
+            func, args, kwargs, queued_at = item
+            start = time.perf_counter()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                self._on_exception(sys.exc_info()[1])
+            finally:
+                latency = time.perf_counter() - start
+                lane.processed += 1
+                lane.total_wait += start - queued_at
+                lane.total_latency += latency
+                lane.max_latency = max(lane.max_latency, latency)
+
+    def on_exception(self, exc):
+        # Same contract as telebot's ThreadPool: unhandled errors stop the polling loop
+        handler = getattr(self.telebot, 'exception_handler', None)
+        if handler is not None and handler.handle(exc):
+            return
+        logger.error(f"{self.name} task failed: {exc}")
+        self.exception_info = exc
+        self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        for lane in self._lanes:
+            lane.queue.put(_STOP)
+        for lane in self._lanes:
+            if lane.thread is not threading.current_thread():
+                lane.thread.join()
+
+    def depth(self):
+        return sum(lane.queue.qsize() for lane in self._lanes)
+
+    def stats(self):
+        return {'queued': self.depth(), 'lanes': [lane.as_dict() for lane in self._lanes]}
+
+
+class PriorityExecutor:
+    """Per-chat ordering in front of one bounded worker pool per priority class.
+
+    A chat's updates run one at a time and in order: the next one is handed
+    to the pool of its class only once the previous one finished, so a chat
+    only ever waits for its own earlier updates and light commands never
+    queue behind another chat's render. ``classify`` maps an update to a
+    class name. Each class has ``WORKERS`` threads and admits at most
+    ``MAX_PENDING`` updates queued or running (0 = unbounded); past that
+    ``on_rejected`` is called with the update instead. ``chat_context``,
+    if given, is entered with the chat id around each of its updates, e.g.
+    to hold a lock shared with other processes.
+    """
+
+    def __init__(self, telebot, classify, classes, default='light', on_rejected=None, chat_context=None):
+        self.telebot = telebot
+        self.chat_context = chat_context
+        self.classify = classify
+        self.default = default
+        self.on_rejected = on_rejected
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.limits = {name: config.get('MAX_PENDING', 0) for name, config in classes.items()}
+        self.pending = {name: 0 for name in classes}
+        self.rejected = {name: 0 for name in classes}
+        self.processed = {name: 0 for name in classes}
+        self._pools = {
+            name: ThreadPoolExecutor(max_workers=config.get('WORKERS', 1), thread_name_prefix=f"bot-{name}")
+            for name, config in classes.items()
+        }
+        self._chats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def put(self, func, *args, **kwargs):
+        update = args[0] if args else None
+        try:
+            name = self.classify(update) if args else self.default
+        except Exception as e:
+            logger.error(f"Failed to classify update: {e}")
+            name = self.default
+        if name not in self._pools:
+            name = self.default
+        if not self._admit(name):
+            self._reject(name, update)
+            return
+        task = (name, func, args, kwargs)
+        key = chat_key(args)
+        if key is not None:
+            with self._lock:
+                # A chat in _chats has its first task running or handed to a pool
+                pending = self._chats.get(key)
+                if pending is not None:
+                    pending.append(task)
+                    return
+                self._chats[key] = deque([task])
+        self._submit(key, task)
+
+    def _submit(self, key, task):
+        try:
+            self._pools[task[0]].submit(self._run, key, task)
+        except RuntimeError:
+            logger.warning(f"Executor closed, dropped a {task[0]} update")
+
+    def _run(self, key, task):
+        name, func, args, kwargs = task
+        self._local.claims = [name]
+        try:
+            if key is not None and self.chat_context is not None:
+                with self.chat_context(key):
+                    func(*args, **kwargs)
+            else:
+                func(*args, **kwargs)
+        except Exception:
+            self.on_exception(sys.exc_info()[1])
+        finally:
+            claims, self._local.claims = self._local.claims, None
+            with self._lock:
+                self.processed[name] += 1
+                for claimed in claims:
+                    self.pending[claimed] -= 1
+                following = None
+                if key is not None:
+                    pending = self._chats[key]
+                    pending.popleft()
+                    if pending:
+                        following = pending[0]
+                    else:
+                        del self._chats[key]
+            if following is not None:
+                self._submit(key, following)
+
+    def _admit(self, name):
+        with self._lock:
+            limit = self.limits.get(name)
+            if limit and self.pending[name] >= limit:
+                self.rejected[name] += 1
+                return False
+            self.pending[name] += 1
+            return True
+
+    def claim(self, name):
+        """Count the running update against class ``name`` too, e.g. once it turns out to render.
+
+        False if that class is full. The claim ends with the update; outside
+        of an executor thread there is nothing to cap and it always succeeds.
+        """
+        claims = getattr(self._local, 'claims', None)
+        if claims is None or name in claims:
+            return True
+        if not self._admit(name):
+            return False
+        claims.append(name)
+        return True
+
+    def _reject(self, name, update):
+        logger.warning(f"Too many {name} updates pending, rejected one ({self.rejected[name]} so far)")
+        if self.on_rejected is not None:
+            try:
+                self.on_rejected(update)
+            except Exception as e:
+                logger.error(f"Failed to notify rejected update: {e}")
+
+    def on_exception(self, exc):
+        # Same contract as telebot's ThreadPool: unhandled errors stop the polling loop
+        handler = getattr(self.telebot, 'exception_handler', None)
+        if handler is not None and handler.handle(exc):
+            return
+        logger.error(f"Update handler failed: {exc}")
+        self.exception_info = exc
+        self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        for pool in self._pools.values():
+            # Not waiting: close may be called from one of the pool's own threads
+            pool.shutdown(wait=False)
+
+    def depth(self):
+        with self._lock:
+            return sum(self.pending.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': sum(self.pending.values()),
+                'chats': len(self._chats),
+                'classes': {
+                    name: {
+                        'pending': self.pending[name],
+                        'limit': self.limits[name],
+                        'rejected': self.rejected[name],
+                        'processed': self.processed[name],
+                    }
+                    for name in self._pools
+                },
+            }
+
+
+def install_priority_executor(bot, classify, on_rejected=None, chat_context=None):
+    """Swap the bot's unordered thread pool for per-chat ordering over per-class pools."""
+    config = getattr(settings, 'BOT_EXECUTOR', {})
+    default = config.get('DEFAULT_CLASS', 'light')
+    executor = PriorityExecutor(
+        bot,
+        classify,
+        config.get('CLASSES') or {default: {'WORKERS': 8}},
+        default=default,
+        on_rejected=on_rejected,
+        chat_context=chat_context,
+    )
+    old_pool, bot.worker_pool = getattr(bot, 'worker_pool', None), executor
+    if old_pool is not None:
+        old_pool.close()
+    bot.threaded = True
+    return executor
@@ -0,0 +1,55 @@
+# bot/management/commands/benchmark_dispatch.py
+
+import timeit
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from bot.dispatch import CatalogRouter
+from bot.registry import DeviceCatalog, get_device_registry
+
+
+class Command(BaseCommand):
+    help = 'Compares the catalog dispatch index with the old per-message filter chain'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=10000, help='Messages per measurement')
+        parser.add_argument('--synthetic', type=int, default=0,
+                            help='Use a generated catalog with this many devices instead of the database')
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            rows = [(f"Device {i}", f"id-{i}", f"Region {i % 10}") for i in range(options['synthetic'])]
+            catalog = DeviceCatalog(rows, version=1)
+            registry = SimpleNamespace(catalog=catalog)
+        else:
+            registry = get_device_registry()
+            catalog = registry.catalog
+        locations = catalog.locations
+        if not locations:
+            self.stderr.write('The device catalog is empty, use --synthetic N')
+            return
+
+        router = CatalogRouter(registry)
+        devices = [device for names in locations.values() for device in names]
+        # Worst case for the old chain: last device, a region, and free text
+        samples = [devices[-1], next(iter(locations)), 'hello there']
+        messages = [SimpleNamespace(text=text) for text in samples]
+
+        def old_filters():
+            for message in messages:
+                if message.text in locations.keys():
+                    continue
+                if message.text in [device for names in locations.values() for device in names]:
+                    continue
+
+        def new_router():
+            for message in messages:
+                router.matches(message)
+
+        number = options['number']
+        self.stdout.write(f"{len(devices)} devices in {len(locations)} regions, {number} x {len(messages)} messages")
+        for name, func in (('filter chain', old_filters), ('dispatch index', new_router)):
+            seconds = min(timeit.repeat(func, number=number, repeat=3))
+            per_message = seconds / (number * len(messages)) * 1e6
+            self.stdout.write(f"{name:>15}: {seconds:.4f}s total, {per_message:.3f} µs/message")
@@ -1,7 +1,12 @@
 # bot/management/commands/start_bot.py
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from bot.views import start_bot_thread
+from bot.views import bot, start_bot_thread, start_background_services
+from bot.webhook import register_webhook
+from bot.renderer import shutdown_renderer
+from BotAnalytics.writer import shutdown_analytics_writer
+from bot.sessions import get_session_store
 import threading
 import time
 
@@ -9,20 +14,37 @@ class Command(BaseCommand):
     help = 'Starts the bot'
 
     def handle(self, *args, **kwargs):
-        self.stdout.write('Starting bot...')
+        if settings.BOT_MODE == 'webhook':
+            # Updates are handled by the ASGI workers; this process tells Telegram
+            # where to send them and runs the catalog sync and measurement sweep once
+            url = register_webhook(bot)
+            self.stdout.write(f'Webhook registered at {url}, updates are served by climate_bot.asgi')
+            start_background_services()
+        else:
+            self.stdout.write('Starting bot...')
 
-        # Start the bot in a separate thread
-        bot_thread = threading.Thread(target=self.start_bot_in_thread)
-        bot_thread.daemon = True  # Daemon thread will end when the main program ends
-        bot_thread.start()
+            # Start the bot in a separate thread
+            bot_thread = threading.Thread(target=self.start_bot_in_thread)
+            bot_thread.daemon = True  # Daemon thread will end when the main program ends
+            bot_thread.start()
 
-        self.stdout.write('Bot started.')
+            self.stdout.write('Bot started.')
 
         # Keep the process alive
-        while True:
-            time.sleep(1)  # Add a small sleep to reduce CPU usage
-            # The loop is needed to keep the management command running
-            # The bot runs in the background thread
+        try:
+            while True:
+                time.sleep(1)  # Add a small sleep to reduce CPU usage
+                # The loop is needed to keep the management command running
+                # The bot runs in the background thread
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping bot...')
+        finally:
+            # Close the shared Chromium used for comparison images
+            shutdown_renderer()
+            # Flush analytics events still waiting in memory
+            shutdown_analytics_writer()
+            # Write selections made since the last session flush
+            get_session_store().shutdown()
 
     def start_bot_in_thread(self):
         """ Wrapper to start the bot in a new thread """
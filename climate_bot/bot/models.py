@@ -6,9 +6,28 @@ class Device(models.Model):
     parent_name = models.CharField(max_length=200)
     latitude = models.DecimalField(max_digits=18, decimal_places=15)
     longitude = models.DecimalField(max_digits=18, decimal_places=15)
+    # Set by the upstream sync, so every process leaves the station out of the catalog
+    missing_upstream = models.BooleanField(default=False)
 
     def __str__(self):
         return f"{self.generated_id}"
 
     class Meta:
         db_table = 'backend_device'
+
+
+class ChatSessionRecord(models.Model):
+    # Persisted part of bot.sessions.ChatSession, written behind by the session store
+    chat_id = models.BigIntegerField(unique=True)
+    selected_country = models.CharField(max_length=200, blank=True)
+    selected_device = models.CharField(max_length=200, blank=True)
+    device_id = models.CharField(max_length=200, blank=True)
+    compare_mode = models.BooleanField(default=False)
+    compare_devices = models.JSONField(default=list, blank=True)  # [{'name': ..., 'id': ...}]
+    updated_at = models.DateTimeField(auto_now=True)
+    # Lease held while a process handles an update of the chat in shared mode
+    locked_until = models.DateTimeField(null=True, blank=True)
+    lock_token = models.CharField(max_length=32, blank=True)
+
+    def __str__(self):
+        return f"{self.chat_id} - {self.selected_device}"
@@ -0,0 +1,226 @@
+import atexit
+import html
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+from django.conf import settings
+from telebot.apihelper import ApiTelegramException
+
+from climate_bot.ratelimit import KeyedTokenBuckets, TokenBucket, get_telegram_bucket, telegram_retry_after
+
+
+logger = logging.getLogger(__name__)
+
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Outgoing:
+    __slots__ = ('method', 'chat_id', 'payload', 'kwargs', 'futures', 'queued_at')
+
+    def __init__(self, method, chat_id, payload, kwargs):
+        self.method = method
+        self.chat_id = chat_id
+        self.payload = payload
+        self.kwargs = kwargs
+        self.futures = [Future()]
+        self.queued_at = time.perf_counter()
+
+
+def _as_html(text, parse_mode):
+    return text if parse_mode == 'HTML' else html.escape(text, quote=False)
+
+
+def coalesce(first, second):
+    """Merge two consecutive text messages into one, or return None if the API can't."""
+    if first.method != 'send_message' or second.method != 'send_message':
+        return None
+    a, b = dict(first.kwargs), dict(second.kwargs)
+    markups = [markup for markup in (a.pop('reply_markup', None), b.pop('reply_markup', None)) if markup is not None]
+    modes = {a.pop('parse_mode', None), b.pop('parse_mode', None)}
+    if len(markups) > 1 or a != b or not modes <= {None, 'HTML'}:
+        return None
+    if modes == {None}:
+        text = f"{first.payload}\n\n{second.payload}"
+    else:
+        # Plain text is escaped so it reads the same inside an HTML message
+        text = f"{_as_html(first.payload, first.kwargs.get('parse_mode'))}\n\n" \
+               f"{_as_html(second.payload, second.kwargs.get('parse_mode'))}"
+        a['parse_mode'] = 'HTML'
+    if len(text) > MAX_MESSAGE_LENGTH:
+        return None
+    if markups:
+        a['reply_markup'] = markups[0]
+    merged = Outgoing('send_message', first.chat_id, text, a)
+    merged.futures = first.futures + second.futures
+    merged.queued_at = first.queued_at
+    return merged
+
+
+class Outbox:
+    """Central queue for everything the bot sends.
+
+    Messages to one chat go out in order, one at a time, paced by a
+    per-chat and a global token bucket (``global_bucket``, shared with
+    anything else in the process that sends, or private at ``global_rate``). A 429 pauses both for Telegram's
+    ``retry_after``; connection errors, where nothing reached Telegram,
+    are retried, other failures are not, so nothing is sent twice.
+    Consecutive text messages to a chat that arrive within
+    ``coalesce_window`` seconds are sent as one when the API allows.
+    Every call returns a Future with the sent Message.
+    """
+
+    def __init__(self, bot, workers=8, global_rate=25, per_chat_rate=1, per_chat_burst=3,
+                 max_attempts=3, coalesce_window=0.02, global_bucket=None):
+        self.bot = bot
+        self.max_attempts = max_attempts
+        self.coalesce_window = coalesce_window
+        self.metrics = {'sent': 0, 'failed': 0, 'throttled': 0, 'retried': 0, 'coalesced': 0}
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._global = global_bucket or TokenBucket(global_rate)
+        self._per_chat = KeyedTokenBuckets(per_chat_rate, per_chat_burst)
+        self._chats = {}
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        for index in range(workers):
+            thread = threading.Thread(target=self._run, name=f"outbox-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._enqueue(Outgoing('send_message', chat_id, text, kwargs))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        return self._enqueue(Outgoing('send_photo', chat_id, photo, kwargs))
+
+    def _enqueue(self, item):
+        with self._lock:
+            # A chat in _chats is either waiting in _ready or being sent by a worker
+            pending = self._chats.get(item.chat_id)
+            schedule = pending is None
+            if schedule:
+                pending = self._chats[item.chat_id] = deque()
+            pending.append(item)
+        if schedule:
+            self._ready.put(item.chat_id)
+        return item.futures[0]
+
+    def _run(self):
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                pending = self._chats[chat_id]
+                wait = pending[0].queued_at + self.coalesce_window - time.perf_counter()
+            if wait > 0:
+                # Give the handler a moment to queue its follow-up message
+                time.sleep(wait)
+            with self._lock:
+                item = pending.popleft()
+                while pending:
+                    merged = coalesce(item, pending[0])
+                    if merged is None:
+                        break
+                    pending.popleft()
+                    item = merged
+                    self.metrics['coalesced'] += 1  # Under the lock already
+            self._send(item)
+            with self._lock:
+                if pending:
+                    self._ready.put(chat_id)
+                else:
+                    del self._chats[chat_id]
+
+    def _send(self, item):
+        attempts = 0
+        while True:
+            self._per_chat.acquire(item.chat_id)
+            self._global.acquire()
+            try:
+                result = getattr(self.bot, item.method)(item.chat_id, item.payload, **item.kwargs)
+            except ApiTelegramException as e:
+                retry_after = telegram_retry_after(e)
+                if retry_after is None:
+                    return self._fail(item, e)
+                self._count('throttled')
+                logger.warning(f"Telegram flood control for chat {item.chat_id}, waiting {retry_after}s")
+                self._per_chat.pause(item.chat_id, retry_after)
+                self._global.pause(retry_after)
+            except requests.ConnectionError as e:
+                # Telegram never saw the request; read timeouts are not caught here
+                # because the message may have been delivered
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    return self._fail(item, e)
+                self._count('retried')
+                time.sleep(0.5 * attempts)
+            except Exception as e:
+                return self._fail(item, e)
+            else:
+                latency = time.perf_counter() - item.queued_at
+                with self._lock:
+                    self.metrics['sent'] += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                for future in item.futures:
+                    future.set_result(result)
+                return
+
+    def _count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+
+    def _fail(self, item, exc):
+        self._count('failed')
+        logger.error(f"{item.method} to chat {item.chat_id} failed: {exc}")
+        for future in item.futures:
+            future.set_exception(exc)
+
+    def depth(self):
+        with self._lock:
+            return sum(len(pending) for pending in self._chats.values())
+
+    def flush(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def stats(self):
+        queued = self.depth()
+        with self._lock:
+            sent = self.metrics['sent']
+            return dict(
+                self.metrics,
+                queued=queued,
+                avg_latency=round(self.total_latency / sent, 4) if sent else 0.0,
+                max_latency=round(self.max_latency, 4),
+            )
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox(bot):
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                config = getattr(settings, 'BOT_OUTBOX', {})
+                _outbox = Outbox(
+                    bot,
+                    workers=config.get('WORKERS', 8),
+                    per_chat_rate=config.get('PER_CHAT_RATE', 1),
+                    per_chat_burst=config.get('PER_CHAT_BURST', 3),
+                    max_attempts=config.get('MAX_ATTEMPTS', 3),
+                    coalesce_window=config.get('COALESCE_WINDOW_MS', 20) / 1000,
+                    global_bucket=get_telegram_bucket(),
+                )
+                atexit.register(_outbox.flush)
+    return _outbox
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+from django.conf import settings
+
+from bot.cache import MEASUREMENT_INTERVAL, next_measurement_boundary
+
+
+logger = logging.getLogger(__name__)
+
+
+class MeasurementSnapshot:
+    """Immutable view of the latest measurement of every station."""
+
+    __slots__ = ('measurements', 'taken_at', 'duration', 'failed')
+
+    def __init__(self, measurements, taken_at, duration, failed):
+        self.measurements = MappingProxyType(dict(measurements))
+        self.taken_at = taken_at
+        self.duration = duration
+        self.failed = frozenset(failed)
+
+    @property
+    def age(self):
+        return time.time() - self.taken_at
+
+
+class SnapshotPoller:
+    """Sweeps every station shortly after each quarter-hour boundary.
+
+    Handlers read the published snapshot in O(1) through ``get``; when the
+    snapshot is older than ``max_age`` it is ignored and callers fall back
+    to a direct fetch.
+    """
+
+    def __init__(self, get_device_ids, fetch, concurrency=8, offset=60,
+                 interval=MEASUREMENT_INTERVAL, max_age=None, on_measurement=None):
+        self.get_device_ids = get_device_ids
+        self.fetch = fetch
+        self.concurrency = concurrency
+        self.offset = offset
+        self.interval = interval
+        self.max_age = max_age if max_age is not None else interval + 2 * offset
+        self.on_measurement = on_measurement
+        self.snapshot = None
+        self.sweeps = 0
+        self.failures = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="measurement-poller", daemon=True)
+        self._thread.start()
+        logger.info(f"Measurement poller started (concurrency={self.concurrency})")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Warm the snapshot straight away, then follow the device cadence
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Measurement sweep failed: {e}")
+            wake_at = next_measurement_boundary(interval=self.interval, grace=self.offset)
+            self._stop.wait(max(1, wake_at - time.time()))
+
+    def sweep(self):
+        device_ids = list(dict.fromkeys(self.get_device_ids()))
+        start = time.perf_counter()
+        measurements = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="measurement-sweep") as pool:
+            for device_id, measurement in zip(device_ids, pool.map(self._fetch_one, device_ids)):
+                if measurement:
+                    measurements[device_id] = measurement
+                    if self.on_measurement is not None:
+                        self.on_measurement(device_id, measurement)
+                else:
+                    failed.append(device_id)
+                    self.failures[device_id] += 1
+        duration = time.perf_counter() - start
+        self.snapshot = MeasurementSnapshot(measurements, time.time(), duration, failed)
+        self.sweeps += 1
+        logger.info(
+            f"Measurement sweep: {len(measurements)}/{len(device_ids)} devices in {duration:.2f}s, "
+            f"{len(failed)} failed"
+        )
+        return self.snapshot
+
+    def _fetch_one(self, device_id):
+        try:
+            return self.fetch(device_id)
+        except Exception as e:
+            logger.error(f"Sweep fetch failed for device {device_id}: {e}")
+            return None
+
+    def get(self, device_id):
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.age > self.max_age:
+            return None
+        return snapshot.measurements.get(device_id)
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            'sweeps': self.sweeps,
+            'devices': len(snapshot.measurements) if snapshot else 0,
+            'last_sweep_duration': round(snapshot.duration, 3) if snapshot else None,
+            'snapshot_age': round(snapshot.age, 1) if snapshot else None,
+            'stale': snapshot is None or snapshot.age > self.max_age,
+            'last_failed': sorted(snapshot.failed) if snapshot else [],
+            'failures': dict(self.failures),
+        }
+
+
+_poller = None
+
+
+def get_poller():
+    return _poller
+
+
+def start_poller(get_device_ids, fetch, on_measurement=None):
+    global _poller
+    config = getattr(settings, 'MEASUREMENT_POLLER', {})
+    if not config.get('ENABLED', True):
+        logger.info("Measurement poller disabled")
+        return None
+    if _poller is None:
+        _poller = SnapshotPoller(
+            get_device_ids,
+            fetch,
+            concurrency=config.get('CONCURRENCY', 8),
+            offset=config.get('OFFSET_SECONDS', 60),
+            on_measurement=on_measurement,
+        )
+        _poller.start()
+    return _poller
@@ -0,0 +1,203 @@
+import logging
+import threading
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+
+import requests
+from django.conf import settings
+from django.db import transaction
+
+from bot.models import Device
+from climate_bot.http_client import get_http_client
+
+
+logger = logging.getLogger(__name__)
+
+
+DEVICE_LIST_URL = "https://climatenet.am/device_inner/list/"
+# Device.latitude / longitude are stored with 15 decimal places
+COORDINATE_PLACES = Decimal(1).scaleb(-15)
+
+
+def fetch_device_list():
+    logger.debug(f"Fetching device data from {DEVICE_LIST_URL}")
+    response = get_http_client().get(DEVICE_LIST_URL)
+    response.raise_for_status()
+    return response.json()
+
+
+def _coordinate(value):
+    # Quantized like the column, so unchanged stations compare equal to their row
+    try:
+        return Decimal(str(value)).quantize(COORDINATE_PLACES) if value is not None else Decimal(0)
+    except InvalidOperation:
+        return Decimal(0)
+
+
+class DeviceCatalog:
+    """Immutable station catalog published by the registry."""
+
+    __slots__ = ('locations', 'device_ids', 'version')
+
+    def __init__(self, devices, version):
+        locations = defaultdict(list)
+        device_ids = {}
+        for name, generated_id, parent_name in devices:
+            device_ids[name] = generated_id
+            locations[parent_name or "Unknown"].append(name)
+        self.locations = dict(locations)
+        self.device_ids = device_ids
+        self.version = version
+
+
+class DeviceRegistry:
+    """Station catalog backed by the ``backend_device`` table.
+
+    The first access loads the catalog from the database; a background
+    thread then periodically pulls the upstream device list, upserts the
+    differences and republishes the catalog, so new stations show up
+    without a restart. The table belongs to the ClimateNet backend, so
+    nothing is ever deleted from it: stations missing upstream are flagged
+    ``missing_upstream`` and left out of the catalog of every process.
+    """
+
+    def __init__(self, refresh_interval=3600):
+        self.refresh_interval = refresh_interval
+        self._catalog = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            with self._lock:
+                if self._catalog is None:
+                    self._publish(self._load_from_db())
+        return self._catalog
+
+    @property
+    def locations(self):
+        return self.catalog.locations
+
+    @property
+    def device_ids(self):
+        return self.catalog.device_ids
+
+    @property
+    def version(self):
+        return self.catalog.version
+
+    def _load_from_db(self):
+        try:
+            rows = list(
+                Device.objects.filter(missing_upstream=False).order_by('parent_name', 'name')
+                .values_list('name', 'generated_id', 'parent_name')
+            )
+        except Exception as e:
+            logger.error(f"Error loading devices from the database: {e}")
+            rows = []
+        logger.debug(f"Loaded {len(rows)} devices from the database")
+        return rows
+
+    def _publish(self, rows):
+        version = self._catalog.version + 1 if self._catalog is not None else 1
+        self._catalog = DeviceCatalog(rows, version)
+
+    def refresh(self):
+        """Sync the table with upstream and republish; returns True on change."""
+        try:
+            devices = fetch_device_list()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Error fetching device data: {e}")
+            return False
+        if not devices:
+            logger.warning("Upstream returned an empty device list, keeping the current catalog")
+            return False
+
+        upstream = {}
+        for device in devices:
+            upstream[device["generated_id"]] = {
+                'name': device["name"],
+                'parent_name': device.get("parent_name") or "Unknown",
+                'latitude': _coordinate(device.get("latitude")),
+                'longitude': _coordinate(device.get("longitude")),
+                'missing_upstream': False,
+            }
+
+        with transaction.atomic():
+            existing = {device.generated_id: device for device in Device.objects.all()}
+            to_create = []
+            to_update = []
+            for generated_id, fields in upstream.items():
+                device = existing.get(generated_id)
+                if device is None:
+                    to_create.append(Device(generated_id=generated_id, **fields))
+                elif any(getattr(device, field) != value for field, value in fields.items()):
+                    for field, value in fields.items():
+                        setattr(device, field, value)
+                    to_update.append(device)
+
+            hidden = [
+                generated_id for generated_id, device in existing.items()
+                if generated_id not in upstream and not device.missing_upstream
+            ]
+
+            if to_create:
+                Device.objects.bulk_create(to_create)
+            if to_update:
+                Device.objects.bulk_update(
+                    to_update, ['name', 'parent_name', 'latitude', 'longitude', 'missing_upstream'])
+            if hidden:
+                Device.objects.filter(generated_id__in=hidden).update(missing_upstream=True)
+
+        changed = bool(to_create or to_update or hidden)
+        logger.info(
+            f"Device catalog synced: {len(to_create)} added, {len(to_update)} updated, "
+            f"{len(hidden)} newly missing upstream and hidden"
+        )
+        if changed or self._catalog is None:
+            with self._lock:
+                self._publish(self._load_from_db())
+        return changed
+
+    def reload(self):
+        """Republish the catalog from the table, without asking upstream."""
+        rows = self._load_from_db()
+        with self._lock:
+            self._publish(rows)
+
+    def start(self, sync_upstream=True):
+        """Refresh in the background; only one process should sync with upstream."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(self.refresh if sync_upstream else self.reload,),
+            name="device-registry", daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, refresh):
+        while not self._stop.is_set():
+            try:
+                refresh()
+            except Exception as e:
+                logger.error(f"Device catalog refresh failed: {e}")
+            self._stop.wait(self.refresh_interval)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_device_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                config = getattr(settings, 'DEVICE_REGISTRY', {})
+                _registry = DeviceRegistry(refresh_interval=config.get('REFRESH_SECONDS', 3600))
+    return _registry
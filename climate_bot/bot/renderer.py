@@ -0,0 +1,198 @@
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import threading
+
+from django.conf import settings
+from playwright.async_api import async_playwright
+
+
+logger = logging.getLogger(__name__)
+
+
+VIEWPORT = {"width": 1000, "height": 800}
+
+
+class ComparisonRenderer:
+    """Long-lived Chromium used to turn comparison HTML into PNG screenshots.
+
+    The browser and a pool of warm pages live on a dedicated event loop
+    thread; bot handler threads submit work through ``render`` and block on
+    the result. The browser is relaunched after ``max_renders`` screenshots
+    or as soon as it is found disconnected.
+    """
+
+    def __init__(self, max_concurrency=2, max_renders=200, render_timeout=30):
+        self.max_concurrency = max_concurrency
+        self.max_renders = max_renders
+        self.render_timeout = render_timeout
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._playwright = None
+        self._browser = None
+        self._pages = []
+        self._active = 0
+        self._renders = 0
+        self._restarting = False
+        self._semaphore = None
+        self._cond = None
+
+    # Lifecycle
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._loop = asyncio.new_event_loop()
+
+            def run():
+                asyncio.set_event_loop(self._loop)
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._cond = asyncio.Condition()
+                ready.set()
+                self._loop.run_forever()
+
+            self._thread = threading.Thread(target=run, name="comparison-renderer", daemon=True)
+            self._thread.start()
+            ready.wait()
+            logger.info(f"Comparison renderer started (concurrency={self.max_concurrency})")
+
+    def shutdown(self, timeout=10):
+        with self._start_lock:
+            if self._thread is None:
+                return
+            try:
+                future = asyncio.run_coroutine_threadsafe(self._close_browser(), self._loop)
+                future.result(timeout=timeout)
+            except Exception as e:
+                logger.error(f"Error closing renderer browser: {e}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=timeout)
+            self._loop.close()
+            self._thread = None
+            self._loop = None
+            logger.info("Comparison renderer stopped")
+
+    def render(self, html_content):
+        """Render ``html_content`` and return the PNG screenshot as bytes."""
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._render(html_content), self._loop)
+        try:
+            return future.result(timeout=self.render_timeout)
+        except concurrent.futures.TimeoutError:
+            # Otherwise the coroutine keeps its page busy long after we gave up
+            future.cancel()
+            raise
+
+    # Event loop side
+
+    def _needs_restart(self):
+        if self._browser is None or not self._browser.is_connected():
+            return True
+        return self.max_renders and self._renders >= self.max_renders
+
+    async def _launch_browser(self):
+        await self._close_browser()
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=True)
+        self._renders = 0
+        logger.info("Chromium launched for comparison rendering")
+
+    async def _close_browser(self):
+        pages, self._pages = self._pages, []
+        for page in pages:
+            try:
+                await page.close()
+            except Exception:
+                pass
+        if self._browser is not None:
+            try:
+                await self._browser.close()
+            except Exception:
+                pass
+            self._browser = None
+        if self._playwright is not None:
+            try:
+                await self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+
+    async def _acquire_page(self):
+        async with self._cond:
+            while self._restarting:
+                await self._cond.wait()
+            if self._needs_restart():
+                self._restarting = True
+                try:
+                    # Let in-flight renders on the old browser finish first
+                    while self._active:
+                        await self._cond.wait()
+                    await self._launch_browser()
+                finally:
+                    self._restarting = False
+                    self._cond.notify_all()
+            self._active += 1
+            try:
+                if self._pages:
+                    return self._pages.pop()
+                return await self._browser.new_page(viewport=VIEWPORT)
+            except BaseException:
+                # Including CancelledError when the caller timed out, or the
+                # next restart waits forever for this slot
+                self._active -= 1
+                self._cond.notify_all()
+                raise
+
+    async def _release_page(self, page, healthy):
+        async with self._cond:
+            self._active -= 1
+            if healthy and not page.is_closed():
+                self._pages.append(page)
+            else:
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+            self._cond.notify_all()
+
+    async def _render(self, html_content):
+        async with self._semaphore:
+            page = await self._acquire_page()
+            healthy = False
+            try:
+                # The stylesheet is inlined, so nothing has to be loaded from disk
+                await page.set_content(html_content, wait_until="load")
+                image = await page.screenshot(full_page=True, type="png")
+                healthy = True
+                self._renders += 1
+                return image
+            finally:
+                await self._release_page(page, healthy)
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                config = getattr(settings, 'COMPARISON_RENDERER', {})
+                _renderer = ComparisonRenderer(
+                    max_concurrency=config.get('MAX_CONCURRENCY', 2),
+                    max_renders=config.get('MAX_RENDERS_PER_BROWSER', 200),
+                    render_timeout=config.get('RENDER_TIMEOUT', 30),
+                )
+                atexit.register(_renderer.shutdown)
+    return _renderer
+
+
+def shutdown_renderer():
+    if _renderer is not None:
+        _renderer.shutdown()
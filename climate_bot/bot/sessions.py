@@ -0,0 +1,309 @@
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSession:
+    """What the bot remembers about one chat between messages."""
+
+    __slots__ = ('chat_id', 'selected_country', 'selected_device', 'device_id',
+                 'compare_mode', 'compare_devices', 'touched_at')
+
+    # Fields stored in ChatSessionRecord when persistence is on
+    PERSISTENT_FIELDS = ('selected_country', 'selected_device', 'device_id', 'compare_mode', 'compare_devices')
+
+    def __init__(self, chat_id, selected_country=None, selected_device=None, device_id=None):
+        self.chat_id = chat_id
+        self.selected_country = selected_country
+        self.selected_device = selected_device
+        self.device_id = device_id
+        self.compare_mode = False
+        self.compare_devices = []
+        self.touched_at = time.monotonic()
+
+    def start_compare(self):
+        self.compare_mode = True
+        self.compare_devices = []
+
+    def clear_compare(self):
+        self.compare_mode = False
+        self.compare_devices = []
+
+    def select_country(self, country):
+        self.selected_country = country
+        self.selected_device = None
+        self.device_id = None
+
+    def select_device(self, name, device_id):
+        self.selected_device = name
+        self.device_id = device_id
+
+    def clear_device(self):
+        self.selected_device = None
+        self.device_id = None
+
+    def as_record(self):
+        from bot.models import ChatSessionRecord
+        return ChatSessionRecord(
+            chat_id=self.chat_id,
+            selected_country=self.selected_country or '',
+            selected_device=self.selected_device or '',
+            device_id=self.device_id or '',
+            compare_mode=self.compare_mode,
+            compare_devices=list(self.compare_devices),
+        )
+
+    @classmethod
+    def from_record(cls, record):
+        session = cls(
+            record.chat_id,
+            selected_country=record.selected_country or None,
+            selected_device=record.selected_device or None,
+            device_id=record.device_id or None,
+        )
+        session.compare_mode = record.compare_mode
+        session.compare_devices = list(record.compare_devices or [])
+        return session
+
+    def as_context(self):
+        # Shape expected by save_selected_device_to_db
+        return {
+            'selected_country': self.selected_country,
+            'selected_device': self.selected_device,
+            'device_id': self.device_id,
+        }
+
+    def __repr__(self):
+        return (f"ChatSession({self.chat_id}, device={self.selected_device!r}, "
+                f"compare={self.compare_mode}, {len(self.compare_devices)} devices)")
+
+
+class SessionStore:
+    """Per-chat sessions with idle expiry and LRU eviction.
+
+    Sessions untouched for ``idle_ttl`` seconds are dropped, as are the
+    least recently used ones beyond ``max_sessions``. With ``persist`` on,
+    ``save`` marks a session dirty and a background thread writes dirty
+    sessions to ChatSessionRecord every ``flush_interval`` seconds; a
+    session missing from memory is loaded from there once.
+
+    With ``shared`` on, for several processes serving the same bot, nothing
+    is kept in memory: ``get`` reads ChatSessionRecord on every update and
+    ``save`` writes it straight away, so the next update of the chat sees
+    it whichever process handles it. Handlers must ``save`` after every
+    change in either mode. Two processes could still handle updates of one
+    chat at once and overwrite each other's changes, so updates run inside
+    ``locked``, a per-chat lease on the record: held for at most
+    ``lock_timeout`` seconds, in case its process dies, and waited for at
+    most ``lock_wait`` seconds before going ahead without it.
+    """
+
+    def __init__(self, idle_ttl=86400, max_sessions=10000, persist=False, flush_interval=5, shared=False,
+                 lock_timeout=120, lock_wait=30):
+        self.idle_ttl = idle_ttl
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.max_sessions = max_sessions
+        self.shared = shared
+        self.persist = persist or shared
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, chat_id):
+        if self.shared:
+            return self._load(chat_id)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is not None:
+                self._sessions.move_to_end(chat_id)
+                session.touched_at = now
+                self.hits += 1
+                return session
+            # Evicted before its changes were written, which makes it newer than the database
+            session = self._dirty.get(chat_id)
+        if session is None:
+            # Loaded outside the lock, another thread may race us to it
+            session = self._load(chat_id)
+        session.touched_at = now
+        with self._lock:
+            existing = self._sessions.get(chat_id)
+            if existing is not None:
+                return existing
+            self._sessions[chat_id] = session
+            self._evict(now)
+        return session
+
+    def save(self, session):
+        if self.shared:
+            try:
+                self._write([session])
+            except Exception as e:
+                logger.error(f"Failed to save session for {session.chat_id}: {e}")
+        elif self.persist:
+            with self._lock:
+                self._dirty[session.chat_id] = session
+
+    @contextmanager
+    def locked(self, chat_id):
+        """Hold the chat's lease while handling one of its updates; a no-op unless shared."""
+        if not self.shared:
+            yield
+            return
+        token = self._acquire(chat_id)
+        try:
+            yield
+        finally:
+            if token is not None:
+                self._release(chat_id, token)
+
+    def _acquire(self, chat_id):
+        from bot.models import ChatSessionRecord
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_wait
+        try:
+            ChatSessionRecord.objects.bulk_create([ChatSessionRecord(chat_id=chat_id)], ignore_conflicts=True)
+            while True:
+                now = timezone.now()
+                taken = ChatSessionRecord.objects.filter(
+                    Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+                    chat_id=chat_id,
+                ).update(locked_until=now + timedelta(seconds=self.lock_timeout), lock_token=token)
+                if taken:
+                    return token
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)
+        except Exception as e:
+            logger.error(f"Failed to lock session for {chat_id}: {e}")
+            return None
+        logger.warning(f"Session for {chat_id} still locked after {self.lock_wait}s, going ahead")
+        return None
+
+    def _release(self, chat_id, token):
+        from bot.models import ChatSessionRecord
+        try:
+            ChatSessionRecord.objects.filter(chat_id=chat_id, lock_token=token).update(
+                locked_until=None, lock_token='')
+        except Exception as e:
+            logger.error(f"Failed to unlock session for {chat_id}: {e}")
+
+    def _evict(self, now):
+        deadline = now - self.idle_ttl
+        while self._sessions:
+            chat_id, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and oldest.touched_at >= deadline:
+                break
+            # A dirty session stays referenced from _dirty until it is flushed
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, chat_id):
+        if not self.persist:
+            return ChatSession(chat_id)
+        from bot.models import ChatSessionRecord
+        self.loads += 1
+        try:
+            record = ChatSessionRecord.objects.filter(chat_id=chat_id).first()
+        except Exception as e:
+            logger.error(f"Failed to load session for {chat_id}: {e}")
+            record = None
+        if record is None:
+            return ChatSession(chat_id)
+        return ChatSession.from_record(record)
+
+    def _write(self, sessions):
+        from bot.models import ChatSessionRecord
+        ChatSessionRecord.objects.bulk_create(
+            [session.as_record() for session in sessions],
+            update_conflicts=True,
+            unique_fields=['chat_id'],
+            update_fields=[*ChatSession.PERSISTENT_FIELDS, 'updated_at'],
+        )
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        close_old_connections()
+        try:
+            self._write(dirty.values())
+        except Exception as e:
+            logger.error(f"Failed to persist {len(dirty)} sessions: {e}")
+            with self._lock:
+                # Keep newer changes made while we were writing
+                for chat_id, session in dirty.items():
+                    self._dirty.setdefault(chat_id, session)
+            return 0
+        return len(dirty)
+
+    def start(self):
+        if not self.persist or self.shared or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        close_old_connections()
+
+    def shutdown(self):
+        self._stop.set()
+        if self.persist:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'dirty': len(self._dirty),
+                'hits': self.hits,
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_session_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = getattr(settings, 'CHAT_SESSIONS', {})
+                _store = SessionStore(
+                    idle_ttl=config.get('IDLE_TTL', 86400),
+                    max_sessions=config.get('MAX_SESSIONS', 10000),
+                    persist=config.get('PERSIST', False),
+                    flush_interval=config.get('FLUSH_INTERVAL', 5),
+                    # Webhook workers can each get the next update of a chat
+                    shared=config.get('SHARED', getattr(settings, 'BOT_MODE', 'polling') == 'webhook'),
+                    lock_timeout=config.get('LOCK_TIMEOUT', 120),
+                    lock_wait=config.get('LOCK_WAIT', 30),
+                )
+    return _store
@@ -1,3 +1,923 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from telebot.apihelper import ApiTelegramException
+
+from . import views
+from .cache import (
+    ComparisonImageCache, DjangoMeasurementBackend, LocalMeasurementBackend, MeasurementCache,
+    next_measurement_boundary,
+)
+from .dispatch import DEVICE, REGION, CatalogRouter
+from .executor import LaneExecutor, PriorityExecutor
+from .models import ChatSessionRecord, Device
+from .outbox import MAX_MESSAGE_LENGTH, Outbox, Outgoing, coalesce
+from .poller import SnapshotPoller
+from .registry import DeviceCatalog, DeviceRegistry
+from .renderer import ComparisonRenderer
+from .sessions import SessionStore
+from .webhook import MAX_BODY_SIZE, SECRET_HEADER, WebhookApplication
+
+
+def update(chat_id, **fields):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), **fields)
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class PriorityExecutorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.rejected = []
+        self.executor = PriorityExecutor(
+            None,
+            lambda message: message.kind,
+            {
+                'light': {'WORKERS': 2},
+                'compare': {'WORKERS': 1, 'MAX_PENDING': 2},
+            },
+            on_rejected=self.rejected.append,
+        )
+        self.release = threading.Event()
+        self.handled = []
+        self.addCleanup(self.release.set)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def handle(self, message):
+        if message.kind == 'compare':
+            self.release.wait(5)
+        self.handled.append((message.chat.id, message.seq))
+
+    def test_light_updates_do_not_wait_behind_other_chats(self):
+        self.executor.put(self.handle, update(1, kind='compare', seq=0))
+        for chat_id in range(2, 6):
+            self.executor.put(self.handle, update(chat_id, kind='light', seq=0))
+        self.assertTrue(wait_for(lambda: len(self.handled) == 4))
+        self.assertNotIn((1, 0), self.handled)
+
+    def test_chat_order_is_kept_across_classes(self):
+        self.executor.put(self.handle, update(1, kind='compare', seq=0))
+        self.executor.put(self.handle, update(1, kind='light', seq=1))
+        time.sleep(0.05)
+        # The chat's light update waits for its own comparison
+        self.assertEqual(self.handled, [])
+        self.release.set()
+        self.assertTrue(wait_for(lambda: len(self.handled) == 2))
+        self.assertEqual(self.handled, [(1, 0), (1, 1)])
+
+    def test_heavy_class_is_capped(self):
+        for chat_id in range(4):
+            self.executor.put(self.handle, update(chat_id, kind='compare', seq=0))
+        self.assertEqual([message.chat.id for message in self.rejected], [2, 3])
+        self.release.set()
+        self.assertTrue(wait_for(lambda: self.executor.depth() == 0))
+        stats = self.executor.stats()['classes']['compare']
+        self.assertEqual((stats['processed'], stats['rejected']), (2, 2))
+        # Admitted again once the earlier ones finished
+        self.executor.put(self.handle, update(5, kind='compare', seq=0))
+        self.assertTrue(wait_for(lambda: (5, 0) in self.handled))
+
+    def test_claim_counts_running_update_against_another_class(self):
+        claims = []
+
+        def escalate(message):
+            claims.append(self.executor.claim('compare'))
+            self.release.wait(5)
+
+        self.executor.put(self.handle, update(1, kind='compare', seq=0))
+        self.executor.put(escalate, update(2, kind='light'))
+        self.executor.put(escalate, update(3, kind='light'))
+        self.assertTrue(wait_for(lambda: len(claims) == 2))
+        self.assertEqual(sorted(claims), [False, True])
+        self.release.set()
+        self.assertTrue(wait_for(lambda: self.executor.depth() == 0))
+        # Outside the executor there is nothing to cap
+        self.assertTrue(self.executor.claim('compare'))
+
+    def test_chat_context_wraps_each_update(self):
+        events = []
+
+        @contextmanager
+        def chat_context(chat_id):
+            events.append(('enter', chat_id))
+            yield
+            events.append(('exit', chat_id))
+
+        self.executor.chat_context = chat_context
+        self.executor.put(lambda message: events.append(('handle', message.chat.id)), update(4, kind='light'))
+        self.assertTrue(wait_for(lambda: len(events) == 3))
+        self.assertEqual(events, [('enter', 4), ('handle', 4), ('exit', 4)])
+
+    def test_failing_handler_sets_exception_event(self):
+        def fail(message):
+            raise ValueError('boom')
+
+        self.executor.put(fail, update(1, kind='light'))
+        self.assertTrue(self.executor.exception_event.wait(1))
+        with self.assertRaises(ValueError):
+            self.executor.raise_exceptions()
+        self.executor.clear_exceptions()
+        # The chat is not stuck behind the failed update
+        self.executor.put(self.handle, update(1, kind='light', seq=1))
+        self.assertTrue(wait_for(lambda: self.handled == [(1, 1)]))
+
+
+class FakePage:
+
+    def __init__(self):
+        self.closed = False
+
+    async def set_content(self, html, wait_until=None):
+        pass
+
+    async def screenshot(self, full_page=False, type=None):
+        return b'png'
+
+    def is_closed(self):
+        return self.closed
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+
+    def __init__(self, hang=False):
+        self.hang = hang
+        self.pages = 0
+
+    def is_connected(self):
+        return True
+
+    async def new_page(self, viewport=None):
+        if self.hang:
+            await asyncio.sleep(60)
+        self.pages += 1
+        return FakePage()
+
+    async def close(self):
+        pass
+
+
+class ComparisonRendererTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.launches = 0
+
+    def renderer(self, **kwargs):
+        renderer = ComparisonRenderer(**kwargs)
+        renderer._launch_browser = self.launcher(renderer)
+        renderer.start()
+        self.addCleanup(renderer.shutdown)
+        return renderer
+
+    def launcher(self, renderer, hang=False):
+        async def launch():
+            self.launches += 1
+            renderer._pages = []
+            renderer._browser = FakeBrowser(hang=hang)
+            renderer._renders = 0
+        return launch
+
+    def test_pages_are_reused(self):
+        renderer = self.renderer()
+        self.assertEqual(renderer.render('<html></html>'), b'png')
+        self.assertEqual(renderer.render('<html></html>'), b'png')
+        self.assertEqual(self.launches, 1)
+        self.assertEqual(renderer._browser.pages, 1)
+
+    def test_browser_is_relaunched_after_max_renders(self):
+        renderer = self.renderer(max_renders=2)
+        for _ in range(5):
+            renderer.render('<html></html>')
+        self.assertEqual(self.launches, 3)
+
+    def test_timed_out_render_gives_its_slot_back(self):
+        renderer = self.renderer(render_timeout=0.2, max_renders=1)
+        renderer._launch_browser = self.launcher(renderer, hang=True)
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            renderer.render('<html></html>')
+        self.assertTrue(wait_for(lambda: renderer._active == 0))
+
+        # The next render restarts the browser, which waits for active
+        # renders to finish and would hang on a leaked slot
+        renderer._launch_browser = self.launcher(renderer)
+        renderer._renders = renderer.max_renders
+        self.assertEqual(renderer.render('<html></html>'), b'png')
+
+
+class SharedSessionStoreTestCase(TransactionTestCase):
+
+    def store(self, **kwargs):
+        return SessionStore(shared=True, **kwargs)
+
+    def test_changes_are_visible_to_other_processes(self):
+        first, second = self.store(), self.store()
+        session = first.get(7)
+        session.start_compare()
+        session.compare_devices.append({'name': 'Gyumri', 'id': '3'})
+        first.save(session)
+        self.assertEqual(second.get(7).compare_devices, [{'name': 'Gyumri', 'id': '3'}])
+
+    def test_updates_of_a_chat_take_turns(self):
+        first, second = self.store(), self.store()
+        order = []
+        entered = threading.Event()
+
+        def hold():
+            with first.locked(7):
+                entered.set()
+                time.sleep(0.3)
+                order.append('first')
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.assertTrue(entered.wait(2))
+        with second.locked(7):
+            order.append('second')
+        thread.join()
+        self.assertEqual(order, ['first', 'second'])
+        # Other chats are not held up
+        with second.locked(8):
+            pass
+
+    def test_abandoned_lease_expires(self):
+        first, second = self.store(lock_timeout=0.2), self.store(lock_wait=2)
+        # Taken by a process that died before releasing it
+        first._acquire(7)
+        started = time.monotonic()
+        with second.locked(7):
+            waited = time.monotonic() - started
+        self.assertGreater(waited, 0.1)
+        self.assertLess(waited, 1.5)
+        self.assertEqual(ChatSessionRecord.objects.get(chat_id=7).lock_token, '')
+
+    def test_lock_wait_is_bounded(self):
+        first, second = self.store(), self.store(lock_wait=0.2)
+        token = first._acquire(7)
+        with second.locked(7):
+            pass
+        # Going ahead without the lease doesn't release the holder's
+        self.assertEqual(ChatSessionRecord.objects.get(chat_id=7).lock_token, token)
+
+
+class FakeUpdates:
+
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.received = []
+
+    def put(self, update):
+        if self.accept:
+            self.received.append(update)
+        return self.accept
+
+
+class WebhookApplicationTestCase(SimpleTestCase):
+
+    def call(self, app, path='/telegram/webhook/', method='POST', token=b'secret', body=None):
+        if body is None:
+            body = json.dumps({'update_id': 1, 'message': {
+                'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'text': '/Help',
+            }}).encode()
+        scope = {'type': 'http', 'path': path, 'method': method, 'headers': [(SECRET_HEADER, token)]}
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(app(scope, receive, send))
+        return sent[0]['status']
+
+    def app(self, updates=None, secret='secret'):
+        async def django_app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 299})
+
+        return WebhookApplication(django_app, updates or FakeUpdates(), '/telegram/webhook/', secret)
+
+    def test_update_is_queued(self):
+        updates = FakeUpdates()
+        self.assertEqual(self.call(self.app(updates)), 200)
+        self.assertEqual(updates.received[0].message.chat.id, 5)
+
+    def test_wrong_or_missing_secret_is_rejected(self):
+        updates = FakeUpdates()
+        self.assertEqual(self.call(self.app(updates), token=b'guess'), 403)
+        self.assertEqual(self.call(self.app(updates), token=b''), 403)
+        # No secret configured means no update is trusted
+        self.assertEqual(self.call(self.app(updates, secret=None), token=b''), 403)
+        self.assertEqual(updates.received, [])
+
+    def test_full_queue_asks_telegram_to_retry(self):
+        self.assertEqual(self.call(self.app(FakeUpdates(accept=False))), 503)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.call(self.app(), method='GET'), 405)
+        self.assertEqual(self.call(self.app(), body=b'not json'), 400)
+        self.assertEqual(self.call(self.app(), body=b'x' * (MAX_BODY_SIZE + 1)), 413)
+
+    def test_other_paths_go_to_django(self):
+        self.assertEqual(self.call(self.app(), path='/bot/'), 299)
+
+
+class ComparisonTemplateTestCase(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = directory
+        patcher = mock.patch.object(views, 'COMPARISON_TEMPLATE_DIR', directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cached, views._comparison_template = views._comparison_template, None
+        self.addCleanup(setattr, views, '_comparison_template', cached)
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory, name), 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def test_missing_template_is_tried_again(self):
+        self.assertIsNone(views.load_comparison_template())
+        self.write('comparison.html', f"<html>{views.CSS_PLACEHOLDER}$rows</html>")
+        self.write('comparison.css', 'td {}')
+        template = views.load_comparison_template()
+        self.assertEqual(template.substitute(rows='x'), '<html><style>td {}</style>x</html>')
+
+        os.remove(os.path.join(self.directory, 'comparison.css'))
+        # Kept once loaded
+        self.assertIs(views.load_comparison_template(), template)
+
+
+def sent_photo(file_id):
+    return SimpleNamespace(photo=[SimpleNamespace(file_id=f"{file_id}-small"), SimpleNamespace(file_id=file_id)])
+
+
+class ComparisonImageCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ComparisonImageCache()
+
+    def test_upload_fills_in_file_id(self):
+        self.cache.set('k', b'png')
+        upload = concurrent.futures.Future()
+        self.cache.set_upload('k', upload)
+        self.assertIs(self.cache.peek('k')['upload'], upload)
+        upload.set_result(sent_photo('FID'))
+        entry = self.cache.peek('k')
+        self.assertEqual((entry['file_id'], entry['upload']), ('FID', None))
+
+    def test_failed_upload_leaves_no_file_id(self):
+        self.cache.set('k', b'png')
+        upload = concurrent.futures.Future()
+        self.cache.set_upload('k', upload)
+        upload.set_exception(RuntimeError('network'))
+        entry = self.cache.peek('k')
+        self.assertEqual((entry['file_id'], entry['upload']), (None, None))
+
+    def test_newer_measurements_replace_the_picture(self):
+        self.cache.set('old', b'png', device_ids=['1', '2'], timestamps=['10:00', '10:00'])
+        self.cache.set('new', b'png', device_ids=['1', '2'], timestamps=['10:15', '10:00'])
+        self.assertIsNone(self.cache.peek('old'))
+        self.assertIsNotNone(self.cache.peek('new'))
+
+    def test_peek_is_not_counted(self):
+        self.cache.set('k', b'png')
+        self.cache.get('k')
+        self.cache.get('missing')
+        self.cache.peek('k')
+        self.cache.peek('missing')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_render_locks_are_per_key_and_dropped_after_use(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with self.cache.render_lock('a'):
+                entered.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.assertTrue(entered.wait(1))
+        with self.cache.render_lock('b'):
+            # Another picture is not held up
+            pass
+        release.set()
+        thread.join()
+        self.assertEqual(self.cache._render_locks, {})
+
+
+class FakeOutbox:
+    """Stands in for bot.outbox: photos are 'sent' after ``delay`` unless they hang."""
+
+    def __init__(self, delay=0.05, hang=False):
+        self.delay = delay
+        self.hang = hang
+        self.photos = []
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            self.photos.append((chat_id, photo))
+        if not self.hang:
+            timer = threading.Timer(self.delay, future.set_result, [sent_photo('FID')])
+            timer.start()
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+
+class SendComparisonImageTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = ComparisonImageCache()
+        self.outbox = FakeOutbox()
+        self.renders = []
+        for name, value in [
+            ('get_image_cache', lambda: self.cache),
+            ('outbox', self.outbox),
+            ('render_html_to_image', self.render),
+            ('SHARED_UPLOAD_WAIT', 0.3),
+        ]:
+            patcher = mock.patch.object(views, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def render(self, html):
+        self.renders.append(html)
+        time.sleep(0.05)
+        return b'png'
+
+    def send_from(self, chat_ids):
+        threads = [threading.Thread(target=views.send_comparison_image, args=(chat_id, '<html>x</html>'))
+                   for chat_id in chat_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    def test_one_render_and_upload_for_many_chats(self):
+        self.send_from(range(5))
+        self.assertEqual(len(self.renders), 1)
+        uploads = [chat_id for chat_id, photo in self.outbox.photos if photo == b'png']
+        resent = sorted(chat_id for chat_id, photo in self.outbox.photos if photo == 'FID')
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(sorted(uploads + resent), [0, 1, 2, 3, 4])
+        self.assertEqual(self.outbox.messages, [])
+        # Each request is one lookup
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 5)
+        self.assertEqual(self.cache._render_locks, {})
+
+    def test_waits_briefly_for_another_chats_upload(self):
+        self.cache.set(self.cache.make_key('<html>x</html>'), b'png')
+        # Another chat's upload that never finishes
+        self.cache.set_upload(self.cache.make_key('<html>x</html>'), concurrent.futures.Future())
+        started = time.monotonic()
+        self.send_from([1])
+        self.assertLess(time.monotonic() - started, 1)
+        # Uploaded its own copy instead of waiting the whole send timeout
+        self.assertEqual(self.outbox.photos, [(1, b'png')])
+        self.assertEqual(self.renders, [])
+
+
+def upstream_device(generated_id, name, parent_name='Armenia'):
+    return {'generated_id': generated_id, 'name': name, 'parent_name': parent_name,
+            'latitude': 40.1, 'longitude': 44.5}
+
+
+class DeviceRegistryTestCase(TestCase):
+
+    def refresh(self, registry, devices):
+        with mock.patch('bot.registry.fetch_device_list', return_value=devices):
+            return registry.refresh()
+
+    def test_refresh_adds_and_updates(self):
+        registry = DeviceRegistry()
+        self.assertTrue(self.refresh(registry, [upstream_device('1', 'Yerevan')]))
+        self.assertEqual(registry.locations, {'Armenia': ['Yerevan']})
+        self.assertFalse(self.refresh(registry, [upstream_device('1', 'Yerevan')]))
+
+        version = registry.version
+        self.assertTrue(self.refresh(registry, [upstream_device('1', 'Yerevan'), upstream_device('2', 'Gyumri')]))
+        self.assertEqual(registry.device_ids, {'Gyumri': '2', 'Yerevan': '1'})
+        self.assertEqual(registry.version, version + 1)
+
+    def test_missing_station_is_hidden_in_every_process(self):
+        registry = DeviceRegistry()
+        self.refresh(registry, [upstream_device('1', 'Yerevan'), upstream_device('2', 'Gyumri')])
+        self.assertTrue(self.refresh(registry, [upstream_device('1', 'Yerevan')]))
+        self.assertEqual(registry.device_ids, {'Yerevan': '1'})
+        # Kept in the backend's table
+        self.assertTrue(Device.objects.get(generated_id='2').missing_upstream)
+
+        # A webhook process never asks upstream, it only reloads the table
+        webhook = DeviceRegistry()
+        webhook.reload()
+        self.assertEqual(webhook.device_ids, {'Yerevan': '1'})
+
+    def test_returning_station_is_shown_again(self):
+        registry = DeviceRegistry()
+        self.refresh(registry, [upstream_device('1', 'Yerevan'), upstream_device('2', 'Gyumri')])
+        self.refresh(registry, [upstream_device('1', 'Yerevan')])
+        self.assertTrue(self.refresh(registry, [upstream_device('1', 'Yerevan'), upstream_device('2', 'Gyumri')]))
+        self.assertEqual(registry.device_ids, {'Gyumri': '2', 'Yerevan': '1'})
+
+    def test_failed_or_empty_upstream_keeps_the_catalog(self):
+        registry = DeviceRegistry()
+        self.refresh(registry, [upstream_device('1', 'Yerevan')])
+        self.assertFalse(self.refresh(registry, []))
+        with mock.patch('bot.registry.fetch_device_list', side_effect=ValueError('not json')):
+            self.assertFalse(registry.refresh())
+        self.assertEqual(registry.device_ids, {'Yerevan': '1'})
+        self.assertFalse(Device.objects.filter(missing_upstream=True).exists())
+
+
+class MeasurementCacheTestCase(SimpleTestCase):
+
+    def test_boundary_is_the_next_quarter_hour_plus_grace(self):
+        self.assertEqual(next_measurement_boundary(900 * 4 + 10), 900 * 5)
+        self.assertEqual(next_measurement_boundary(900 * 4 + 100, grace=90), 900 * 5 + 90)
+        # Inside the grace window the entry lives until this boundary's grace ends
+        self.assertEqual(next_measurement_boundary(900 * 4 + 30, grace=90), 900 * 4 + 90)
+
+    def test_local_backend_expires_and_evicts(self):
+        backend = LocalMeasurementBackend(max_entries=2)
+        backend.set('a', 1, time.time() + 60)
+        backend.set('b', 2, time.time() + 60)
+        backend.get('a')
+        backend.set('c', 3, time.time() + 60)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), (1, None, 3))
+
+        backend.set('old', 4, time.time() - 1)
+        self.assertIsNone(backend.get('old'))
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = MeasurementCache(LocalMeasurementBackend())
+        fetched = []
+
+        def fetch(device_id):
+            fetched.append(device_id)
+            time.sleep(0.05)
+            return {'temperature': 20}
+
+        threads = [threading.Thread(target=cache.get_or_fetch, args=('1', fetch)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetched, ['1'])
+        self.assertEqual(cache.stats(), {'hits': 4, 'misses': 1, 'hit_ratio': 0.8})
+
+    def test_failed_fetch_is_not_cached(self):
+        cache = MeasurementCache(LocalMeasurementBackend())
+        self.assertIsNone(cache.get_or_fetch('1', lambda device_id: None))
+        self.assertEqual(cache.get_or_fetch('1', lambda device_id: {'temperature': 20}), {'temperature': 20})
+        self.assertEqual(cache.get('1'), {'temperature': 20})
+
+    def test_django_backend_is_shared(self):
+        first = MeasurementCache(DjangoMeasurementBackend(key_prefix='test-measurement'))
+        second = MeasurementCache(DjangoMeasurementBackend(key_prefix='test-measurement'))
+        first.set('1', {'temperature': 20})
+        self.addCleanup(first.invalidate, '1')
+        self.assertEqual(second.get('1'), {'temperature': 20})
+        second.invalidate('1')
+        self.assertIsNone(first.get('1'))
+
+
+class FetchLatestMeasurementsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.fetched = []
+        patcher = mock.patch.object(views, 'fetch_latest_measurement', self.fetch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, device_id):
+        self.fetched.append(device_id)
+        if device_id.startswith('slow'):
+            self.release.wait(5)
+        if device_id == 'broken':
+            raise ValueError('bad response')
+        if device_id == 'empty':
+            return None
+        return {'timestamp': '2025-01-01 10:00', 'device': device_id}
+
+    def test_slow_stations_share_one_deadline(self):
+        started = time.monotonic()
+        measurements, errors = views.fetch_latest_measurements(['1', 'slow-a', 'slow-b', 'slow-c'], timeout=0.2)
+        # Not one timeout per slow station
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(list(measurements), ['1'])
+        self.assertEqual(sorted(errors), ['slow-a', 'slow-b', 'slow-c'])
+        self.assertIn('Timed out', errors['slow-a'])
+
+    def test_failures_only_lose_their_own_entry(self):
+        measurements, errors = views.fetch_latest_measurements(['1', 'broken', 'empty', '1'], timeout=1)
+        self.assertEqual(sorted(self.fetched), ['1', 'broken', 'empty'])
+        self.assertEqual(list(measurements), ['1'])
+        self.assertEqual(errors, {'broken': 'bad response', 'empty': 'No data'})
+
+    def test_comparison_keeps_device_order_with_gaps(self):
+        devices = [{'name': 'A', 'id': '2'}, {'name': 'B', 'id': 'broken'}, {'name': 'C', 'id': '1'}]
+        columns = views.fetch_comparison_measurements(devices)
+        self.assertEqual([column.get('device') for column in columns], ['2', None, '1'])
+
+        with self.assertRaises(Exception):
+            views.fetch_comparison_measurements([{'name': 'B', 'id': 'broken'}])
+
+
+class SnapshotPollerTestCase(SimpleTestCase):
+
+    def fetch(self, device_id):
+        if device_id == 'broken':
+            raise ValueError('bad response')
+        return {'device': device_id} if device_id != 'empty' else None
+
+    def test_sweep_publishes_every_station(self):
+        seen = []
+        poller = SnapshotPoller(lambda: ['1', '2', 'broken', 'empty', '1'], self.fetch,
+                                on_measurement=lambda device_id, measurement: seen.append(device_id))
+        poller.sweep()
+        self.assertEqual(poller.get('1'), {'device': '1'})
+        self.assertIsNone(poller.get('broken'))
+        self.assertEqual(sorted(seen), ['1', '2'])
+        stats = poller.stats()
+        self.assertEqual((stats['sweeps'], stats['devices'], stats['stale']), (1, 2, False))
+        self.assertEqual(stats['last_failed'], ['broken', 'empty'])
+
+        poller.sweep()
+        self.assertEqual(poller.stats()['failures'], {'broken': 2, 'empty': 2})
+
+    def test_stale_snapshot_is_ignored(self):
+        poller = SnapshotPoller(lambda: ['1'], self.fetch, max_age=60)
+        self.assertIsNone(poller.get('1'))
+        poller.sweep()
+        poller.snapshot.taken_at -= 61
+        self.assertIsNone(poller.get('1'))
+        self.assertTrue(poller.stats()['stale'])
+
+    def test_snapshot_cannot_be_changed_by_readers(self):
+        poller = SnapshotPoller(lambda: ['1'], self.fetch)
+        snapshot = poller.sweep()
+        with self.assertRaises(TypeError):
+            snapshot.measurements['2'] = {}
+
+
+class CatalogRouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = SimpleNamespace(catalog=DeviceCatalog([
+            ('Yerevan', '1', 'Armenia'), ('Gyumri', '2', 'Armenia'), ('Georgia', '3', 'Georgia'),
+        ], version=1))
+        self.router = CatalogRouter(self.registry)
+        self.handled = []
+        self.router.register(REGION, lambda message: self.handled.append((REGION, message.text)))
+        self.router.register(DEVICE, lambda message: self.handled.append((DEVICE, message.text)))
+
+    def test_buttons_are_routed_by_kind(self):
+        self.assertEqual(self.router.resolve('Yerevan'), (DEVICE, 'Yerevan'))
+        # A region wins over a device of the same name
+        self.assertEqual(self.router.resolve('Georgia'), (REGION, 'Georgia'))
+        self.assertFalse(self.router.matches(SimpleNamespace(text='/start')))
+        self.assertFalse(self.router.matches(SimpleNamespace(text=None)))
+        self.router.dispatch(SimpleNamespace(text='Armenia'))
+        self.assertEqual(self.handled, [(REGION, 'Armenia')])
+
+    def test_index_follows_the_published_catalog(self):
+        index = self.router.index
+        self.assertIs(self.router.index, index)
+        self.registry.catalog = DeviceCatalog([('Dilijan', '4', 'Armenia')], version=2)
+        self.assertEqual(self.router.resolve('Dilijan'), (DEVICE, 'Dilijan'))
+        self.assertIsNone(self.router.resolve('Yerevan'))
+
+
+class SessionStoreTestCase(SimpleTestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        store = SessionStore(max_sessions=2)
+        first = store.get(1)
+        store.get(2)
+        store.get(1)
+        store.get(3)
+        self.assertEqual(store.stats()['evictions'], 1)
+        self.assertIs(store.get(1), first)
+        # Chat 2 was evicted and starts over
+        self.assertEqual(store.stats()['sessions'], 2)
+        self.assertNotIn(2, store._sessions)
+
+    def test_idle_sessions_expire(self):
+        store = SessionStore(idle_ttl=60)
+        session = store.get(1)
+        session.select_device('Yerevan', '42')
+        session.touched_at -= 61
+        store.get(2)
+        self.assertIsNone(store.get(1).selected_device)
+        self.assertEqual(store.stats()['evictions'], 1)
+
+
+class SessionStoreFlushTestCase(TestCase):
+
+    def test_flush_writes_dirty_sessions_once(self):
+        store = SessionStore(persist=True)
+        session = store.get(7)
+        session.select_device('Yerevan', '42')
+        session.start_compare()
+        session.compare_devices.append({'name': 'Gyumri', 'id': '3'})
+        store.save(session)
+
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(store.flush(), 0)
+        record = ChatSessionRecord.objects.get(chat_id=7)
+        self.assertEqual((record.selected_device, record.device_id), ('Yerevan', '42'))
+        self.assertEqual(record.compare_devices, [{'name': 'Gyumri', 'id': '3'}])
+
+        # A fresh store (another process, or after a restart) picks it up
+        loaded = SessionStore(persist=True).get(7)
+        self.assertEqual(loaded.selected_device, 'Yerevan')
+        self.assertTrue(loaded.compare_mode)
+
+    def test_evicted_dirty_session_is_still_flushed(self):
+        store = SessionStore(persist=True, max_sessions=1)
+        session = store.get(1)
+        session.select_country('Armenia')
+        store.save(session)
+        store.get(2)
+        # Served from the unflushed copy, not the database
+        self.assertEqual(store.get(1).selected_country, 'Armenia')
+        store.flush()
+        self.assertEqual(ChatSessionRecord.objects.get(chat_id=1).selected_country, 'Armenia')
+
+
+class LaneExecutorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.executor = LaneExecutor(lanes=4)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_messages_of_a_chat_run_in_order(self):
+        handled = {chat_id: [] for chat_id in range(6)}
+
+        def handle(message):
+            # Earlier messages sleep longer, so any reordering would show
+            time.sleep((20 - message.seq) / 2000)
+            handled[message.chat.id].append(message.seq)
+
+        for seq in range(20):
+            for chat_id in handled:
+                self.executor.put(handle, update(chat_id, seq=seq))
+        self.assertTrue(wait_for(lambda: self.executor.stats()['queued'] == 0 and all(
+            len(seqs) == 20 for seqs in handled.values())))
+        for chat_id, seqs in handled.items():
+            self.assertEqual(seqs, list(range(20)), chat_id)
+
+    def test_chats_run_in_parallel(self):
+        # Two chats on different lanes: the second must not wait for the first
+        first = 0
+        second = next(chat_id for chat_id in range(1, 10)
+                      if self.executor.lane_for(chat_id) is not self.executor.lane_for(first))
+        release = threading.Event()
+        done = threading.Event()
+        self.executor.put(lambda message: release.wait(5), update(first))
+        self.executor.put(lambda message: done.set(), update(second))
+        self.assertTrue(done.wait(1))
+        release.set()
+
+    def test_failing_task_sets_exception_event(self):
+        def fail(message):
+            raise ValueError('boom')
+
+        self.executor.put(fail, update(1))
+        self.assertTrue(self.executor.exception_event.wait(1))
+        with self.assertRaises(ValueError):
+            self.executor.raise_exceptions()
+        self.executor.clear_exceptions()
+        self.assertFalse(self.executor.exception_event.is_set())
+
+
+class CoalesceTestCase(SimpleTestCase):
+
+    def test_plain_texts_are_joined(self):
+        first = Outgoing('send_message', 1, 'a', {})
+        second = Outgoing('send_message', 1, 'b', {})
+        merged = coalesce(first, second)
+        self.assertEqual(merged.payload, 'a\n\nb')
+        self.assertEqual(merged.kwargs, {})
+        # Both callers are answered with the one sent message
+        self.assertEqual(merged.futures, first.futures + second.futures)
+        self.assertEqual(merged.queued_at, first.queued_at)
+
+    def test_plain_text_is_escaped_next_to_html(self):
+        first = Outgoing('send_message', 1, '1 < 2', {})
+        second = Outgoing('send_message', 1, '<b>bold</b>', {'parse_mode': 'HTML'})
+        merged = coalesce(first, second)
+        self.assertEqual(merged.payload, '1 &lt; 2\n\n<b>bold</b>')
+        self.assertEqual(merged.kwargs, {'parse_mode': 'HTML'})
+
+    def test_single_markup_is_kept(self):
+        markup = object()
+        first = Outgoing('send_message', 1, 'a', {})
+        second = Outgoing('send_message', 1, 'b', {'reply_markup': markup})
+        self.assertIs(coalesce(first, second).kwargs['reply_markup'], markup)
+
+    def test_unmergeable_pairs(self):
+        text = Outgoing('send_message', 1, 'a', {})
+        cases = [
+            Outgoing('send_photo', 1, b'png', {}),
+            Outgoing('send_message', 1, 'b', {'parse_mode': 'Markdown'}),
+            Outgoing('send_message', 1, 'b', {'disable_notification': True}),
+            Outgoing('send_message', 1, 'b' * MAX_MESSAGE_LENGTH, {}),
+        ]
+        for second in cases:
+            with self.subTest(second=second.kwargs or second.method):
+                self.assertIsNone(coalesce(text, second))
+
+        with_markup = Outgoing('send_message', 1, 'a', {'reply_markup': object()})
+        self.assertIsNone(coalesce(with_markup, Outgoing('send_message', 1, 'b', {'reply_markup': object()})))
+
+
+class FakeBot:
+    """Records sends; ``errors`` are raised, in order, before anything succeeds."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+class OutboxTestCase(SimpleTestCase):
+
+    def outbox(self, bot):
+        return Outbox(bot, workers=2, global_rate=1000, per_chat_rate=1000, per_chat_burst=100)
+
+    def test_texts_of_a_chat_go_out_together_in_order(self):
+        bot = FakeBot()
+        outbox = self.outbox(bot)
+        futures = [outbox.send_message(1, text) for text in ('a', 'b', 'c')]
+        for future in futures:
+            self.assertEqual(future.result(1).text, 'a\n\nb\n\nc')
+        self.assertEqual(bot.sent, [(1, 'a\n\nb\n\nc')])
+        self.assertEqual(outbox.stats()['coalesced'], 2)
+
+    def test_flood_control_waits_and_resends(self):
+        flood = ApiTelegramException('sendMessage', None, {
+            'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 0.05}})
+        bot = FakeBot([flood])
+        outbox = self.outbox(bot)
+        started = time.monotonic()
+        outbox.send_message(1, 'a').result(2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(bot.sent, [(1, 'a')])
+        self.assertEqual(outbox.stats()['throttled'], 1)
+
+    def test_only_undelivered_sends_are_retried(self):
+        bot = FakeBot([requests.ConnectionError('reset')])
+        outbox = self.outbox(bot)
+        outbox.send_message(1, 'a').result(2)
+        self.assertEqual(outbox.stats()['retried'], 1)
+
+        bot.errors = [requests.ReadTimeout('may have been delivered')]
+        with self.assertRaises(requests.ReadTimeout):
+            outbox.send_message(1, 'b').result(2)
+        self.assertEqual(bot.sent, [(1, 'a')])
+        self.assertEqual(outbox.stats()['failed'], 1)
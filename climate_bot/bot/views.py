@@ -1,25 +1,30 @@
 from django.http import JsonResponse
 from django.views import View
-import requests
+from climate_bot.http_client import get_http_client
 import telebot
 from telebot import types
 import threading
 import time
 import os
 from dotenv import load_dotenv
-from bot.models import Device
-from collections import defaultdict
 import django
 from django.conf import settings
 from users.utils import save_telegram_user, save_users_locations
 from BotAnalytics.views import log_command_decorator, save_selected_device_to_db
-import uuid
+from BotAnalytics.tracing import stage
+from bot.cache import get_measurement_cache, get_image_cache
+from bot.renderer import get_renderer
+from bot.poller import get_poller, start_poller
+from bot.registry import get_device_registry
+from bot.dispatch import CatalogRouter, REGION, DEVICE
+from bot.sessions import get_session_store
+from bot.executor import install_priority_executor
+from bot.outbox import get_outbox
 from string import Template
 import math
 import logging
-import asyncio
-from playwright.async_api import async_playwright
 import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
 
 
 # Setup logging
@@ -37,39 +42,121 @@ if not TELEGRAM_BOT_TOKEN:
 
 
 bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+# Replies are queued and paced per chat and globally; calls return futures
+outbox = get_outbox(bot)
+# Comparison images wait for their upload to remember the file_id, and at
+# most SHARED_UPLOAD_WAIT for another chat's upload of the same picture
+PHOTO_SEND_TIMEOUT = 60
+SHARED_UPLOAD_WAIT = 5
 
 
-def get_device_data():
-    url = "https://climatenet.am/device_inner/list/"
-    logger.debug(f"Fetching device data from {url}")
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        devices = response.json()
-        locations = defaultdict(list)
-        device_ids = {}
-        for device in devices:
-            device_ids[device["name"]] = device["generated_id"]
-            locations[device.get("parent_name", "Unknown")].append(device["name"])
-        logger.debug(f"Loaded {len(device_ids)} devices")
-        return locations, device_ids
-    except requests.RequestException as e:
-        logger.error(f"Error fetching device data: {e}")
-        return {}, {}
+# Station catalog is read from the database and refreshed in the background
+device_registry = get_device_registry()
+catalog_router = CatalogRouter(device_registry)
+# Per-chat selections and comparison state, bounded and persisted behind the handlers
+sessions = get_session_store()
+
+
+def classify_update(message):
+    """Priority class of an update, see BOT_EXECUTOR.
+
+    Decided from the text alone on the receiving thread: earlier updates
+    of the chat may not have run yet, so the session can't be trusted here.
+    """
+    text = getattr(message, 'text', None) or ''
+    command = text.split()[0].split('@')[0] if text.startswith('/') else None
+    if command == '/Start_Comparing':
+        return 'compare'
+    if command == '/Current':
+        return 'network'
+    resolved = catalog_router.resolve(text) if text else None
+    if resolved is not None and resolved[0] == DEVICE:
+        # A pick that completes a comparison claims 'compare' once it runs
+        return 'network'
+    return 'light'
+
+
+def reject_busy(message):
+    chat = getattr(message, 'chat', None)
+    if chat is not None:
+        outbox.send_message(chat.id, "⏳ The bot is busy right now, please try again in a moment.")
+
+
+# Handlers run on a pool per priority class, one update per chat at a time,
+# also across webhook processes when sessions are shared
+update_executor = install_priority_executor(
+    bot, classify_update, on_rejected=reject_busy, chat_context=sessions.locked,
+)
 
 
-locations, device_ids = get_device_data()
-user_context = {}
+# Comparisons fetch all selected devices in parallel with a shared deadline
+MEASUREMENT_BATCH_TIMEOUT = 12
+measurement_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="measurement-fetch")
 
 
 devices_with_issues = ["Berd", "Ashotsk", "Gavar", "Artsvaberd", "Chambarak", "Areni", "Amasia"]
 
 
 def fetch_latest_measurement(device_id):
+    # The background sweep normally has every station already
+    poller = get_poller()
+    if poller is not None:
+        measurement = poller.get(device_id)
+        if measurement:
+            return measurement
+    # Stations report every 15 minutes, so repeated requests are served from cache
+    return get_measurement_cache().get_or_fetch(device_id, request_latest_measurement)
+
+
+def fetch_latest_measurements(device_ids, timeout=None):
+    """Fetch several devices concurrently under one shared deadline.
+
+    Returns ``(measurements, errors)``, both keyed by device id, so a slow
+    or dead station only loses its own entry.
+    """
+    timeout = MEASUREMENT_BATCH_TIMEOUT if timeout is None else timeout
+    futures = {}
+    for device_id in dict.fromkeys(device_ids):
+        futures[measurement_pool.submit(fetch_latest_measurement, device_id)] = device_id
+    done, not_done = wait(futures, timeout=timeout)
+
+    measurements = {}
+    errors = {}
+    for future in done:
+        device_id = futures[future]
+        try:
+            measurement = future.result()
+        except Exception as e:
+            errors[device_id] = str(e)
+            continue
+        if measurement:
+            measurements[device_id] = measurement
+        else:
+            errors[device_id] = "No data"
+    for future in not_done:
+        future.cancel()
+        errors[futures[future]] = f"Timed out after {timeout}s"
+    if errors:
+        logger.warning(f"Batch fetch errors: {errors}")
+    return measurements, errors
+
+
+def fetch_comparison_measurements(compare_devices):
+    measurements, errors = fetch_latest_measurements([device['id'] for device in compare_devices])
+    if not measurements:
+        raise Exception("Failed to fetch data for all selected devices")
+    for device in compare_devices:
+        if device['id'] in errors:
+            logger.error(f"Failed to fetch data for {device['name']} (ID: {device['id']}): {errors[device['id']]}")
+    # Devices without data are rendered as N/A columns
+    return [measurements.get(device['id'], {}) for device in compare_devices]
+
+
+def request_latest_measurement(device_id):
     url = f"https://climatenet.am/device_inner/{device_id}/latest/"
     logger.debug(f"Fetching measurement for device ID: {device_id}, URL: {url}")
     try:
-        response = requests.get(url, timeout=10)
+        response = get_http_client().get(url, timeout=10)
         logger.debug(f"API response status: {response.status_code}, content: {response.text}")
         if response.status_code == 200:
             data = response.json()
@@ -105,6 +192,8 @@ def fetch_latest_measurement(device_id):
 
 def start_bot():
     logger.info("Starting bot polling")
+    # getUpdates is refused while a webhook is registered
+    bot.remove_webhook()
     bot.polling(none_stop=True)
 
 
@@ -117,27 +206,45 @@ def run_bot():
             time.sleep(15)
 
 
+def start_bot_services():
+    """What every process that handles updates needs, in polling and webhook mode."""
+    load_comparison_template()
+    sessions.start()
+
+
+def start_background_services():
+    """Upstream catalog sync and the measurement sweep, run by exactly one process."""
+    device_registry.start()
+    start_poller(
+        lambda: device_registry.device_ids.values(),
+        request_latest_measurement,
+        on_measurement=get_measurement_cache().set,
+    )
+
+
 def start_bot_thread():
+    start_bot_services()
+    start_background_services()
     bot_thread = threading.Thread(target=run_bot)
     bot_thread.start()
 
 
 def send_location_selection(chat_id):
     location_markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    for country in locations.keys():
+    for country in device_registry.locations.keys():
         location_markup.add(types.KeyboardButton(country))
-    bot.send_message(chat_id, 'Please choose a location: 📍', reply_markup=location_markup)
+    outbox.send_message(chat_id, 'Please choose a location: 📍', reply_markup=location_markup)
 
 
 @bot.message_handler(commands=['start'])
 @log_command_decorator
 def start(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         '🌤️ Welcome to ClimateNet! 🌧️'
     )
     save_telegram_user(message.from_user)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         f'''Hello {message.from_user.first_name}! 👋 I am your personal climate assistant.
 With me, you can:
@@ -153,34 +260,38 @@ def start_compare(message):
     chat_id = message.chat.id
     logger.debug(f"/Compare triggered for chat_id: {chat_id}")
     try:
-        if chat_id not in user_context:
-            user_context[chat_id] = {}
-        user_context[chat_id]['compare_mode'] = True
-        user_context[chat_id]['compare_devices'] = []
+        session = sessions.get(chat_id)
+        session.start_compare()
+        sessions.save(session)
         send_location_selection_for_compare(chat_id, device_number=1)
     except Exception as e:
         logger.error(f"Error starting comparison: {e}")
-        bot.send_message(chat_id, f"Error starting comparison: {e}")
+        outbox.send_message(chat_id, f"Error starting comparison: {e}")
+
+
+@bot.message_handler(func=catalog_router.matches)
+def route_catalog_selection(message):
+    # Region and device buttons are resolved with one lookup in the dispatch index
+    catalog_router.dispatch(message)
 
 
-@bot.message_handler(func=lambda message: message.text in locations.keys())
 @log_command_decorator
 def handle_country_selection(message):
     selected_country = message.text
     chat_id = message.chat.id
     logger.debug(f"Country selected: {selected_country} for chat_id: {chat_id}")
-    if chat_id in user_context and user_context[chat_id].get('compare_mode'):
-        compare_devices = user_context[chat_id].get('compare_devices', [])
-        device_number = len(compare_devices) + 1
-        user_context[chat_id][f'compare_country_{device_number}'] = selected_country
+    session = sessions.get(chat_id)
+    if session.compare_mode:
+        device_number = len(session.compare_devices) + 1
         send_device_selection_for_compare(chat_id, selected_country, device_number)
         return
-    user_context[chat_id] = {'selected_country': selected_country}
+    session.select_country(selected_country)
+    sessions.save(session)
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    for device in locations[selected_country]:
+    for device in device_registry.locations.get(selected_country, []):
         markup.add(types.KeyboardButton(device))
     markup.add(types.KeyboardButton('/Change_location'))
-    bot.send_message(chat_id, 'Please choose a device: ✅', reply_markup=markup)
+    outbox.send_message(chat_id, 'Please choose a device: ✅', reply_markup=markup)
 
 
 def uv_index(uv):
@@ -272,14 +383,8 @@ def get_comparison_formatted_data(devices, measurements):
         return ""
 
 
-    # Load HTML template
-    template_path = os.path.join(settings.BASE_DIR,'bot', 'templates','bot', 'comparison.html')
-    logger.debug(f"Template path: {os.path.abspath(template_path)}, Exists: {os.path.exists(template_path)}")
-    try:
-        with open(template_path, 'r', encoding='utf-8') as f:
-            template = Template(f.read())
-    except FileNotFoundError as e:
-        logger.error(f"Error: {template_path} not found: {e}")
+    template = load_comparison_template()
+    if template is None:
         return None
 
 
@@ -349,151 +454,173 @@ def get_comparison_formatted_data(devices, measurements):
         return None
 
 
-async def render_html_to_image(html_content, output_path):
-    logger.debug(f"Rendering HTML to image at {output_path}")
+COMPARISON_TEMPLATE_DIR = os.path.join(settings.BASE_DIR, 'bot', 'templates', 'bot')
+CSS_PLACEHOLDER = '<link rel="stylesheet" href="INLINE_CSS_HERE">'
+
+
+_comparison_template = None
+
+
+def load_comparison_template():
+    # Read once and inline the stylesheet, so rendering never touches the disk.
+    # Only a successful read is kept, a missing file is tried again next time
+    global _comparison_template
+    if _comparison_template is not None:
+        return _comparison_template
+    template_path = os.path.join(COMPARISON_TEMPLATE_DIR, 'comparison.html')
+    css_path = os.path.join(COMPARISON_TEMPLATE_DIR, 'comparison.css')
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
-            # Save HTML to a temporary file to ensure CSS is applied correctly
-            temp_html_path = f"temp_comparison_{uuid.uuid4()}.html"
-            with open(temp_html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
-            css_path = os.path.join(settings.BASE_DIR, 'bot', 'templates', 'bot', 'comparison.css')
-            logger.debug(f"CSS path: {os.path.abspath(css_path)}, Exists: {os.path.exists(css_path)}")
-            if not os.path.exists(css_path):
-                raise FileNotFoundError(f"CSS file {css_path} not found")
-            # Load HTML file with file:// protocol
-            await page.goto(f"file://{os.path.abspath(temp_html_path)}")
-            # Set viewport size
-            await page.set_viewport_size({"width": 1000, "height": 800})
-            # Take screenshot
-            await page.screenshot(path=output_path, full_page=True)
-            await browser.close()
-            logger.debug(f"Screenshot saved to {output_path}")
-            # Clean up temporary HTML file
-            os.remove(temp_html_path)
+        with open(template_path, 'r', encoding='utf-8') as f:
+            html = f.read()
+        with open(css_path, 'r', encoding='utf-8') as f:
+            css = f.read()
+    except FileNotFoundError as e:
+        logger.error(f"Comparison template file not found: {e}")
+        return None
+    logger.debug(f"Comparison template loaded from {template_path}")
+    _comparison_template = Template(html.replace(CSS_PLACEHOLDER, f"<style>{css}</style>"))
+    return _comparison_template
+
+
+def render_html_to_image(html_content):
+    try:
+        # Rendering runs on the shared browser pool instead of a fresh Chromium per request
+        return get_renderer().render(html_content)
     except Exception as e:
         logger.error(f"Playwright rendering error: {e}")
         raise
-#BRO IDK WHAT IS THIS 
-def inline_css_into_html(html, css_path):
-    with open(css_path, 'r', encoding='utf-8') as f:
-        css = f.read()
-    return html.replace('<link rel="stylesheet" href="INLINE_CSS_HERE">', f"<style>{css}</style>")
 
-"""def send_comparison_image(chat_id, html_content):
+
+def send_comparison_image(chat_id, html_content, devices=(), measurements=()):
     if html_content is None:
         logger.error("HTML content is None")
-        bot.send_message(chat_id, "⚠️ Error generating comparison table. Please try again.")
+        outbox.send_message(chat_id, "⚠️ Error generating comparison table. Please try again.")
         return
+    image_cache = get_image_cache()
+    key = image_cache.make_key(html_content)
+    # One bound for both looks at another chat's upload
+    shared_wait_until = time.monotonic() + SHARED_UPLOAD_WAIT
     try:
-        # 🔧 FIX: Set a new event loop because we're in a worker thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        temp_image_path = f"temp_comparison_{uuid.uuid4()}.png"
-        loop.run_until_complete(render_html_to_image(html_content, temp_image_path))
-
-        # Send image to Telegram
-        with open(temp_image_path, 'rb') as photo:
-            bot.send_photo(chat_id, photo)
-
-        # Clean up temporary file
-        os.remove(temp_image_path)
-        logger.debug(f"Image sent and temporary file {temp_image_path} removed")
-
-    except FileNotFoundError as e:
-        logger.error(f"File error: {e}")
-        bot.send_message(chat_id, "⚠️ CSS file missing. Please contact the administrator.")
+        entry = image_cache.get(key)
+        if entry and send_cached_image(chat_id, key, entry, shared_wait_until):
+            return
+        upload = None
+        # Held for the cache check, the render and queueing the first upload,
+        # never while waiting on Telegram
+        with image_cache.render_lock(key):
+            entry = image_cache.peek(key)
+            if entry is None:
+                with stage('render'):
+                    image = render_html_to_image(html_content)
+                image_cache.set(
+                    key,
+                    image,
+                    device_ids=[device['id'] for device in devices],
+                    timestamps=[measurement.get('timestamp') for measurement in measurements],
+                )
+            else:
+                image = entry['image']
+            if entry is None or not (entry['file_id'] or entry['upload']):
+                upload = outbox.send_photo(chat_id, image)
+                image_cache.set_upload(key, upload)
+        if upload is None:
+            # Another chat uploaded it while we waited for the lock
+            if send_cached_image(chat_id, key, entry, shared_wait_until):
+                return
+            upload = outbox.send_photo(chat_id, image)
+        try:
+            with stage('send'):
+                upload.result(timeout=PHOTO_SEND_TIMEOUT)
+        except FutureTimeout:
+            # Still queued (e.g. behind flood control) and goes out on its own;
+            # uploading again or apologising would only add a second message
+            logger.warning(f"Comparison image for chat_id {chat_id} not sent within {PHOTO_SEND_TIMEOUT}s, left queued")
+            return
+        logger.debug(f"Comparison image sent to chat_id: {chat_id} ({len(image)} bytes)")
     except Exception as e:
         logger.error(f"Error generating/sending image: {e}")
         traceback.print_exc()
-        bot.send_message(chat_id, "⚠️ Error generating comparison image. Please try again.")"""
+        outbox.send_message(chat_id, "⚠️ Error generating comparison image. Please try again.")
 
-def send_comparison_image(chat_id, html_content):
-    if html_content is None:
-        logger.error("HTML content is None")
-        bot.send_message(chat_id, "⚠️ Error generating comparison table. Please try again.")
-        return
-    try:
-        # Inject CSS before rendering
-        css_path = os.path.join(os.path.dirname(__file__), 'templates', 'bot', 'comparison.css')
-        html_content = inline_css_into_html(html_content, css_path)
 
-        # Set a new event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+def send_cached_image(chat_id, key, entry, shared_wait_until):
+    """Send an already uploaded comparison by file_id; False if it has to be uploaded again.
 
-        temp_image_path = f"temp_comparison_{uuid.uuid4()}.png"
-        loop.run_until_complete(render_html_to_image(html_content, temp_image_path))
-
-        # Send image to Telegram
-        with open(temp_image_path, 'rb') as photo:
-            bot.send_photo(chat_id, photo)
-
-        # Clean up temporary file
-        os.remove(temp_image_path)
-        logger.debug(f"Image sent and temporary file {temp_image_path} removed")
-
-    except FileNotFoundError as e:
-        logger.error(f"File error: {e}")
-        bot.send_message(chat_id, "⚠️ CSS file missing. Please contact the administrator.")
+    True once the send is queued and hasn't failed, even if it is still waiting.
+    Another chat's upload in flight is waited for until ``shared_wait_until``.
+    """
+    image_cache = get_image_cache()
+    file_id = entry.get('file_id')
+    if not file_id and entry.get('upload') is not None:
+        try:
+            # Another chat is uploading the same picture, reuse its file_id
+            sent = entry['upload'].result(timeout=max(0, shared_wait_until - time.monotonic()))
+            file_id = sent.photo[-1].file_id if sent and sent.photo else None
+        except Exception as e:
+            logger.warning(f"Shared comparison upload failed: {e}")
+    if not file_id:
+        return False
+    try:
+        with stage('send'):
+            outbox.send_photo(chat_id, file_id).result(timeout=PHOTO_SEND_TIMEOUT)
+    except FutureTimeout:
+        # Left queued, it is sent once the outbox gets to it
+        logger.warning(f"Cached comparison for chat_id {chat_id} not sent within {PHOTO_SEND_TIMEOUT}s, left queued")
+        return True
     except Exception as e:
-        logger.error(f"Error generating/sending image: {e}")
-        traceback.print_exc()
-        bot.send_message(chat_id, "⚠️ Error generating comparison image. Please try again.")
+        logger.warning(f"Re-sending cached file_id failed, uploading again: {e}")
+        image_cache.forget_file_id(key)
+        return False
+    logger.debug(f"Comparison image re-sent by file_id to chat_id: {chat_id}")
+    return True
 
 
-@bot.message_handler(func=lambda message: message.text in [device for devices in locations.values() for device in devices])
 @log_command_decorator
 def handle_device_selection(message):
     selected_device = message.text
     chat_id = message.chat.id
     logger.debug(f"Device selected: {selected_device} for chat_id: {chat_id}")
+    session = sessions.get(chat_id)
    
-    if chat_id not in user_context:
-        user_context[chat_id] = {}
-   
-    device_id = device_ids.get(selected_device)
+    device_id = device_registry.device_ids.get(selected_device)
     if not device_id:
         logger.error(f"Device ID not found for {selected_device}")
-        bot.send_message(chat_id, "⚠️ Device not found. ❌")
+        outbox.send_message(chat_id, "⚠️ Device not found. ❌")
         return
    
-    if user_context[chat_id].get('compare_mode'):
-        compare_devices = user_context[chat_id].get('compare_devices', [])
+    if session.compare_mode:
+        compare_devices = session.compare_devices
 
 
         if any(device['name'] == selected_device for device in compare_devices):
-            bot.send_message(chat_id, f"Device {selected_device} is already selected.")
+            outbox.send_message(chat_id, f"Device {selected_device} is already selected.")
+            return
+        if len(compare_devices) >= 4 and not update_executor.claim('compare'):
+            # This pick renders the comparison, which only the session tells
+            reject_busy(message)
             return
        
         compare_devices.append({
             'name': selected_device,
             'id': device_id
         })
-        user_context[chat_id]['compare_devices'] = compare_devices
+        sessions.save(session)
         device_number = len(compare_devices)
         logger.debug(f"Added device {selected_device} (number {device_number}) to comparison")        
          
         if device_number >=5:
             try:
                 logger.debug(f"comparing {len(compare_devices)} devices: {[d['name'] for d in compare_devices]}")
-                measurements = []
-                for device in compare_devices:
-                    measurement = fetch_latest_measurement(device['id'])
-                    if not measurement:
-                        logger.error(f"Failed to fetch data for {device['name']} (ID: {device['id']})")
-                        raise Exception ("Failed to fetch data for {device['name']} (ID: {device['id']})")
-                    measurements.append(measurement)
-                html_content = get_comparison_formatted_data(compare_devices, measurements)
+                with stage('fetch'):
+                    measurements = fetch_comparison_measurements(compare_devices)
+                with stage('format'):
+                    html_content = get_comparison_formatted_data(compare_devices, measurements)
                 if html_content is None:
                     logger.error("Failed to generate HTML content")
                     raise Exception ("Failed to generate HTML content")
-                send_comparison_image(chat_id, html_content)
+                send_comparison_image(chat_id, html_content, compare_devices, measurements)
                 command_markup = get_command_menu()
-                bot.send_message(
+                outbox.send_message(
                         chat_id,
                         "Comparision table sent as image above",
                         reply_markup = command_markup
@@ -503,13 +630,10 @@ def handle_device_selection(message):
                 traceback.print_exc()
                 error_msg = f"Error during comparison: {str(e)}"
                 command_markup = get_command_menu()
-                bot.send_message(chat_id, error_msg, reply_markup = command_markup)
+                outbox.send_message(chat_id, error_msg, reply_markup = command_markup)
             finally:
-                user_context[chat_id].pop('compare_mode', None)
-                user_context[chat_id].pop('compare_devices', None)
-                for key in list(user_context[chat_id].keys()):
-                    if key.startswith('compare_'):
-                        user_context[chat_id].pop(key, None)
+                session.clear_compare()
+                sessions.save(session)
                 logger.debug(f"Cleared comparision context for chat_id: {chat_id}")
         
         elif device_number >=2:
@@ -520,7 +644,7 @@ def handle_device_selection(message):
             markup.add(types.KeyboardButton('/Start_Comparing ✅'))
             markup.add(types.KeyboardButton('/Cancel_Compare ❌'))
             
-            bot.send_message(
+            outbox.send_message(
                 chat_id,
                 f"Device {device_number} ({selected_device}) added. Want to add another device?",
                 reply_markup=markup
@@ -529,23 +653,28 @@ def handle_device_selection(message):
             send_location_selection_for_compare(chat_id, device_number=device_number + 1)
         return
    
-    user_context[chat_id]['selected_device'] = selected_device
-    user_context[chat_id]['device_id'] = device_id
+    session.select_device(selected_device, device_id)
+    sessions.save(session)
    
-    save_selected_device_to_db(user_id=message.from_user.id, context=user_context[chat_id], device_id=device_id)
+    save_selected_device_to_db(user_id=message.from_user.id, context=session.as_context(), device_id=device_id)
 
 
     command_markup = get_command_menu(cur=selected_device)
-    measurement = fetch_latest_measurement(device_id)
+    with stage('fetch'):
+        measurement = fetch_latest_measurement(device_id)
    
     if measurement:
         formatted_data = get_formatted_data(measurement=measurement, selected_device=selected_device)
-        bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
-        bot.send_message(chat_id, '''For the next measurement, select\t
+        outbox.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
+        outbox.send_message(chat_id, '''For the next measurement, select\t
 /Current 📍 every quarter of the hour. 🕒''')
     else:
         logger.error(f"Failed to fetch measurement for {selected_device}")
-        bot.send_message(chat_id, "⚠️ Error retrieving data. Please try again later.", reply_markup=command_markup)
+        outbox.send_message(chat_id, "⚠️ Error retrieving data. Please try again later.", reply_markup=command_markup)
+
+
+catalog_router.register(REGION, handle_country_selection)
+catalog_router.register(DEVICE, handle_device_selection)
 
 
 @bot.message_handler(commands=['One_More'])
@@ -553,10 +682,11 @@ def handle_device_selection(message):
 def add_one_more_device(message):
     chat_id = message.chat.id
     logger.debug(f"/One_More triggered for chat_id: {chat_id}")
-    if chat_id not in user_context or not user_context[chat_id].get('compare_mode'):
-        bot.send_message(chat_id, "⚠️ Please start comparison with /Compare first.")
+    session = sessions.get(chat_id)
+    if not session.compare_mode:
+        outbox.send_message(chat_id, "⚠️ Please start comparison with /Compare first.")
         return
-    compare_devices = user_context[chat_id].get('compare_devices', [])
+    compare_devices = session.compare_devices
     if len(compare_devices) >= 5:
         return
 
@@ -569,31 +699,28 @@ def add_one_more_device(message):
 def start_comparing(message):
     chat_id = message.chat.id
     logger.debug(f"/Start_Comparing triggered for chat_id: {chat_id}")
-    if chat_id not in user_context or not user_context[chat_id].get('compare_mode'):
-        bot.send_message(chat_id, "⚠️ Please start comparison with /Compare first.")
+    session = sessions.get(chat_id)
+    if not session.compare_mode:
+        outbox.send_message(chat_id, "⚠️ Please start comparison with /Compare first.")
         return
-    compare_devices = user_context[chat_id].get('compare_devices', [])
+    compare_devices = session.compare_devices
     if len(compare_devices) < 2:
-        bot.send_message(chat_id, "⚠️ Please select at least two devices to compare.")
+        outbox.send_message(chat_id, "⚠️ Please select at least two devices to compare.")
         return
     try:
         logger.debug(f"Comparing {len(compare_devices)} devices: {[d['name'] for d in compare_devices]}")
-        measurements = []
-        for device in compare_devices:
-            measurement = fetch_latest_measurement(device['id'])
-            if not measurement:
-                logger.error(f"Failed to fetch data for {device['name']} (ID: {device['id']})")
-                raise Exception(f"Failed to fetch data for {device['name']} (ID: {device['id']})")
-            measurements.append(measurement)
+        with stage('fetch'):
+            measurements = fetch_comparison_measurements(compare_devices)
        
-        html_content = get_comparison_formatted_data(compare_devices, measurements)
+        with stage('format'):
+            html_content = get_comparison_formatted_data(compare_devices, measurements)
         if html_content is None:
             logger.error("Failed to generate HTML content")
             raise Exception("Failed to generate HTML content")
        
-        send_comparison_image(chat_id, html_content)
+        send_comparison_image(chat_id, html_content, compare_devices, measurements)
         command_markup = get_command_menu()
-        bot.send_message(
+        outbox.send_message(
             chat_id,
             "Comparison table sent as image above.",
             reply_markup=command_markup
@@ -603,13 +730,10 @@ def start_comparing(message):
         traceback.print_exc()
         error_msg = f"⚠️ Error during comparison: {str(e)}. Please try again."
         command_markup = get_command_menu()
-        bot.send_message(chat_id, error_msg, reply_markup=command_markup)
+        outbox.send_message(chat_id, error_msg, reply_markup=command_markup)
     finally:
-        user_context[chat_id].pop('compare_mode', None)
-        user_context[chat_id].pop('compare_devices', None)
-        for key in list(user_context[chat_id].keys()):
-            if key.startswith('compare_'):
-                user_context[chat_id].pop(key, None)
+        session.clear_compare()
+        sessions.save(session)
         logger.debug(f"Cleared comparison context for chat_id: {chat_id}")
 
 
@@ -635,29 +759,31 @@ def get_current_data(message):
     chat_id = message.chat.id
     command_markup = get_command_menu()
     save_telegram_user(message.from_user)
-    logger.debug(f"/Current triggered for chat_id: {chat_id}, User context: {user_context.get(chat_id, 'No context')}")
-    if chat_id in user_context and 'device_id' in user_context[chat_id]:
-        device_id = user_context[chat_id]['device_id']
-        selected_device = user_context[chat_id].get('selected_device')
+    session = sessions.get(chat_id)
+    logger.debug(f"/Current triggered for chat_id: {chat_id}, Session: {session!r}")
+    if session.device_id:
+        device_id = session.device_id
+        selected_device = session.selected_device
         logger.debug(f"Device ID: {device_id}, Selected Device: {selected_device}")
         command_markup = get_command_menu(cur=selected_device)
-        measurement = fetch_latest_measurement(device_id)
+        with stage('fetch'):
+            measurement = fetch_latest_measurement(device_id)
         if measurement:
             formatted_data = get_formatted_data(measurement=measurement, selected_device=selected_device)
-            bot.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
-            bot.send_message(chat_id, '''For the next measurement, select\t
+            outbox.send_message(chat_id, formatted_data, reply_markup=command_markup, parse_mode='HTML')
+            outbox.send_message(chat_id, '''For the next measurement, select\t
 /Current 📍 every quarter of the hour. 🕒''')
         else:
             logger.error(f"Failed to fetch measurement for {selected_device}")
-            bot.send_message(chat_id, "⚠️ Error retrieving data. Please try again later.", reply_markup=command_markup)
+            outbox.send_message(chat_id, "⚠️ Error retrieving data. Please try again later.", reply_markup=command_markup)
     else:
-        bot.send_message(chat_id, "⚠️ Please select a device first using /Change_device 🔄.", reply_markup=command_markup)
+        outbox.send_message(chat_id, "⚠️ Please select a device first using /Change_device 🔄.", reply_markup=command_markup)
 
 
 @bot.message_handler(commands=['Help'])
 @log_command_decorator
 def help(message):
-    bot.send_message(message.chat.id, '''
+    outbox.send_message(message.chat.id, '''
 <b>/Current 📍:</b> Get the latest climate data in selected location.\n
 <b>/Change_device 🔄:</b> Change to another climate monitoring device.\n
 <b>/Help ❓:</b> Show available commands.\n
@@ -672,9 +798,9 @@ def help(message):
 @log_command_decorator
 def change_device(message):
     chat_id = message.chat.id
-    if chat_id in user_context:
-        user_context[chat_id].pop('selected_device', None)
-        user_context[chat_id].pop('device_id', None)
+    session = sessions.get(chat_id)
+    session.clear_device()
+    sessions.save(session)
     send_location_selection(chat_id)
 
 
@@ -691,7 +817,7 @@ def website(message):
     markup = types.InlineKeyboardMarkup()
     button = types.InlineKeyboardButton('Visit Website', url='https://climatenet.am/en/')
     markup.add(button)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         'For more information, click the button below to visit our official website: 🖥️',
         reply_markup=markup
@@ -703,36 +829,36 @@ def website(message):
 def map(message):
     chat_id = message.chat.id
     image = 'https://images-in-website.s3.us-east-1.amazonaws.com/Bot/map.png'
-    bot.send_photo(chat_id, photo=image)
-    bot.send_message(chat_id,
+    outbox.send_photo(chat_id, photo=image)
+    outbox.send_message(chat_id,
 '''📌 The highlighted locations indicate the current active climate devices. 🗺️ ''')
 
 
 def send_location_selection_for_compare(chat_id, device_number):
     location_markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    if not locations:
+    if not device_registry.locations:
         logger.error("No locations available")
-        bot.send_message(chat_id, "⚠️ No locations available. Please try again later.")
+        outbox.send_message(chat_id, "⚠️ No locations available. Please try again later.")
         return
-    for country in locations.keys():
+    for country in device_registry.locations.keys():
         location_markup.add(types.KeyboardButton(country))
     location_markup.add(types.KeyboardButton('/Cancel_Compare ❌'))
     if device_number <=5:
-        bot.send_message(
+        outbox.send_message(
             chat_id,
             f"Please choose a location for Device {device_number} 📍:",
             reply_markup=location_markup
         )
     else:
-        bot.send_message(chat_id, "Maximum 5 devices is reached.")
+        outbox.send_message(chat_id, "Maximum 5 devices is reached.")
 
 
 def send_device_selection_for_compare(chat_id, selected_country, device_number):
     markup = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-    for device in locations[selected_country]:
+    for device in device_registry.locations.get(selected_country, []):
         markup.add(types.KeyboardButton(device))
     markup.add(types.KeyboardButton('/Cancel_Compare ❌'))
-    bot.send_message(
+    outbox.send_message(
         chat_id,
         f'Please choose Device {device_number}: ✅',
         reply_markup=markup
@@ -743,14 +869,11 @@ def send_device_selection_for_compare(chat_id, selected_country, device_number):
 @log_command_decorator
 def cancel_compare(message):
     chat_id = message.chat.id
-    if chat_id in user_context:
-        user_context[chat_id].pop('compare_mode', None)
-        user_context[chat_id].pop('compare_devices', None)
-        for key in list(user_context[chat_id].keys()):
-            if key.startswith('compare_'):
-                user_context[chat_id].pop(key, None)
+    session = sessions.get(chat_id)
+    session.clear_compare()
+    sessions.save(session)
     command_markup = get_command_menu()
-    bot.send_message(
+    outbox.send_message(
         chat_id,
         "Comparison cancelled. Back to the main menu.",
         reply_markup=command_markup
@@ -760,7 +883,7 @@ def cancel_compare(message):
 @bot.message_handler(content_types=['audio', 'document', 'photo', 'sticker', 'video', 'video_note', 'voice', 'contact', 'venue', 'animation'])
 @log_command_decorator
 def handle_media(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         '''❗ Please use a valid command.
 You can see all available commands by typing /Help❓
@@ -771,7 +894,7 @@ You can see all available commands by typing /Help❓
 @bot.message_handler(func=lambda message: not message.text.startswith('/'))
 @log_command_decorator
 def handle_text(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         '''❗ Please use a valid command.
 You can see all available commands by typing /Help❓
@@ -786,7 +909,7 @@ def request_location(message):
     markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True, one_time_keyboard=True)
     back_to_menu_button = types.KeyboardButton("/back 🔙")
     markup.add(location_button, back_to_menu_button)
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "Click the button below to share your location 🔽",
         reply_markup=markup
@@ -795,7 +918,7 @@ def request_location(message):
 
 @bot.message_handler(commands=['back'])
 def go_back_to_menu(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "You are back to the main menu. How can I assist you?",
         reply_markup=get_command_menu()
@@ -812,14 +935,14 @@ def handle_location(message):
         res = f"{longitude},{latitude}"
         save_users_locations(from_user=message.from_user.id, location=res)
         command_markup = get_command_menu()
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "Select other commands to continue ▶️",
             reply_markup=command_markup
         )
     else:
         logger.error("Failed to receive location")
-        bot.send_message(
+        outbox.send_message(
             message.chat.id,
             "Failed to get your location. Please try again."
         )
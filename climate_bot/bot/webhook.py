@@ -0,0 +1,167 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from telebot import types
+
+
+logger = logging.getLogger(__name__)
+
+
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class UpdateQueue:
+    """Bounded queue of webhook updates drained by a fixed set of worker threads."""
+
+    def __init__(self, process, workers=1, max_queue=1000):
+        self.process = process
+        self.workers = workers
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"webhook-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, update):
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def _run(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self.process([update])
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to handle update {update.update_id}: {e}")
+            finally:
+                close_old_connections()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'received': self.received,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+
+async def _respond(send, status, body=b''):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_SIZE:
+            return None
+        more_body = message.get('more_body', False)
+    return body
+
+
+class WebhookApplication:
+    """ASGI app that takes Telegram updates on ``path`` and passes everything else to Django.
+
+    Updates are acknowledged as soon as they are queued; Telegram retries
+    the ones answered with 503 because the queue was full.
+    """
+
+    def __init__(self, django_app, updates, path, secret_token):
+        self.django_app = django_app
+        self.updates = updates
+        self.path = path
+        self.secret_token = (secret_token or '').encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != self.path:
+            return await self.django_app(scope, receive, send)
+        if scope['method'] != 'POST':
+            return await _respond(send, 405)
+
+        token = dict(scope['headers']).get(SECRET_HEADER, b'')
+        if not self.secret_token or not hmac.compare_digest(token, self.secret_token):
+            logger.warning("Rejected webhook call with a wrong secret token")
+            return await _respond(send, 403)
+
+        body = await _read_body(receive)
+        if body is None:
+            return await _respond(send, 413)
+        try:
+            update = types.Update.de_json(json.loads(body))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Malformed webhook update: {e}")
+            return await _respond(send, 400)
+        if not self.updates.put(update):
+            return await _respond(send, 503)
+        return await _respond(send, 200)
+
+
+def webhook_config():
+    return getattr(settings, 'TELEGRAM_WEBHOOK', {})
+
+
+def register_webhook(bot):
+    """Point Telegram at our webhook URL, done once per deploy by start_bot."""
+    config = webhook_config()
+    if not config.get('URL') or not config.get('SECRET_TOKEN'):
+        raise ValueError("TELEGRAM_WEBHOOK needs URL and SECRET_TOKEN in webhook mode")
+    url = config['URL'].rstrip('/') + config.get('PATH', '/telegram/webhook/')
+    bot.set_webhook(
+        url=url,
+        secret_token=config['SECRET_TOKEN'],
+        max_connections=config.get('MAX_CONNECTIONS', 40),
+    )
+    return url
+
+
+def webhook_application(django_app):
+    """Wrap the Django ASGI app and start handling updates in this process.
+
+    Any number of these processes can run; upstream sync and the
+    measurement sweep run once, in the start_bot process.
+    """
+    from bot.views import bot, device_registry, start_bot_services
+
+    config = webhook_config()
+    start_bot_services()
+    # Pick up stations start_bot added to the table
+    device_registry.start(sync_upstream=False)
+    updates = UpdateQueue(
+        bot.process_new_updates,
+        workers=config.get('WORKERS', 1),
+        max_queue=config.get('MAX_QUEUE', 1000),
+    )
+    updates.start()
+    return WebhookApplication(
+        django_app,
+        updates,
+        path=config.get('PATH', '/telegram/webhook/'),
+        secret_token=config.get('SECRET_TOKEN'),
+    )
@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'climate_bot.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402 (needs the settings module set above)
+
+if settings.BOT_MODE == 'webhook':
+    # Telegram updates are served here next to the admin instead of by start_bot
+    from bot.webhook import webhook_application
+    application = webhook_application(application)
@@ -0,0 +1,145 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class HostMetrics:
+    __slots__ = ('requests', 'errors', 'retries', 'total_latency', 'max_latency')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_latency': round(self.total_latency / self.requests, 4) if self.requests else 0.0,
+            'max_latency': round(self.max_latency, 4),
+        }
+
+
+class HttpClient:
+    """Shared keep-alive HTTP client for climatenet.am and the Telegram API.
+
+    One ``requests.Session`` with a connection pool per configured host,
+    consistent timeouts, retries with jittered exponential backoff on 5xx
+    and connection errors, and per-host latency/error counters.
+    Only idempotent methods are retried unless ``retries`` is passed.
+    """
+
+    def __init__(self, hosts=None, pool_maxsize=10, timeout=10, retries=2, backoff=0.3):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        default_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', default_adapter)
+        self.session.mount('https://', default_adapter)
+        for host, size in (hosts or {}).items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            self.session.mount(f'https://{host}/', adapter)
+            self.session.mount(f'http://{host}/', adapter)
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def _record(self, host, latency, error=False, retried=False):
+        with self._metrics_lock:
+            metrics = self._metrics.get(host)
+            if metrics is None:
+                metrics = self._metrics[host] = HostMetrics()
+            if retried:
+                metrics.retries += 1
+                return
+            metrics.requests += 1
+            metrics.total_latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+            if error:
+                metrics.errors += 1
+
+    def _sleep_before_retry(self, attempt):
+        # Full jitter keeps many workers from retrying in lockstep
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, retries=None, **kwargs):
+        method = method.upper()
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        kwargs.setdefault('timeout', self.timeout)
+        host = urlsplit(url).hostname or ''
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(host, time.perf_counter() - start, error=True)
+                if attempt >= retries:
+                    raise
+                logger.warning(f"{method} {host} failed ({e}), retrying")
+            else:
+                server_error = response.status_code >= 500
+                self._record(host, time.perf_counter() - start, error=server_error)
+                if not server_error or attempt >= retries:
+                    return response
+                logger.warning(f"{method} {host} returned {response.status_code}, retrying")
+            self._record(host, 0, retried=True)
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {host: metrics.as_dict() for host, metrics in self._metrics.items()}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = getattr(settings, 'HTTP_CLIENT', {})
+                _client = HttpClient(
+                    hosts=config.get('HOSTS'),
+                    pool_maxsize=config.get('POOL_MAXSIZE', 10),
+                    timeout=config.get('TIMEOUT', 10),
+                    retries=config.get('RETRIES', 2),
+                    backoff=config.get('BACKOFF', 0.3),
+                )
+    return _client
+
+
+def install_telebot_sender():
+    """Route pyTelegramBotAPI requests through the shared client."""
+    from telebot import apihelper
+
+    def send(method, url, **kwargs):
+        return get_http_client().request(method, url, **kwargs)
+
+    apihelper.CUSTOM_REQUEST_SENDER = send
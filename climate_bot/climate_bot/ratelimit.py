@@ -0,0 +1,116 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """Thread-safe token bucket.
+
+    ``acquire`` reserves a token and sleeps until it is due, so concurrent
+    callers are spaced out at ``rate`` per second after an initial burst of
+    ``capacity``. ``pause`` stops all callers for a while, e.g. for a
+    Telegram 429 ``retry_after``.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def _reserve(self, timeout):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # While paused _updated lies in the future and nothing refills
+            wait = max(0.0, self._updated - now)
+            self._tokens -= 1
+            if self._tokens < 0:
+                wait += -self._tokens / self.rate
+            if timeout is not None and wait > timeout:
+                self._tokens += 1
+                return None
+            return wait
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting at most ``timeout`` seconds. Returns False on timeout."""
+        wait = self._reserve(timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def try_acquire(self):
+        return self._reserve(0) is not None
+
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = max(self._updated, now + seconds)
+
+
+class KeyedTokenBuckets:
+    """One TokenBucket per key (e.g. per chat), least recently used evicted."""
+
+    def __init__(self, rate, capacity=None, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def acquire(self, key, timeout=None):
+        return self.get(key).acquire(timeout)
+
+    def pause(self, key, seconds):
+        self.get(key).pause(seconds)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def telegram_retry_after(exc):
+    """Seconds Telegram asked us to wait for a 429, or None for other errors."""
+    if getattr(exc, 'error_code', None) != 429:
+        return None
+    result = getattr(exc, 'result_json', None) or {}
+    return float(result.get('parameters', {}).get('retry_after', 1))
+
+
+_telegram_bucket = None
+_telegram_bucket_lock = threading.Lock()
+
+
+def get_telegram_bucket():
+    """This process's share of Telegram's bot-wide message rate, see TELEGRAM_RATE."""
+    global _telegram_bucket
+    if _telegram_bucket is None:
+        with _telegram_bucket_lock:
+            if _telegram_bucket is None:
+                config = getattr(settings, 'TELEGRAM_RATE', {})
+                processes = max(1, config.get('SENDING_PROCESSES', 1))
+                _telegram_bucket = TokenBucket(config.get('GLOBAL_RATE', 25) / processes)
+    return _telegram_bucket
@@ -387,3 +387,166 @@ def badge_callback(request):
 
 def permission_callback(request):
     return request.user.has_perm("sample_app.change_model")
+
+
+# Bot performance settings
+
+# Latest measurements are cached until the next quarter-hour boundary.
+# Use "local" for a single bot worker, "django" to share the entry through
+# CACHES between processes.
+MEASUREMENT_CACHE = {
+    "BACKEND": os.getenv("MEASUREMENT_CACHE_BACKEND", "local"),
+    "CACHE_ALIAS": "default",
+    "MAX_ENTRIES": 512,
+    "GRACE_SECONDS": 90,
+}
+
+# Comparison images are rendered by one long-lived Chromium. The browser is
+# relaunched after MAX_RENDERS_PER_BROWSER screenshots or when it crashes.
+COMPARISON_RENDERER = {
+    "MAX_CONCURRENCY": int(os.getenv("COMPARISON_RENDER_CONCURRENCY", 2)),
+    "MAX_RENDERS_PER_BROWSER": 200,
+    "RENDER_TIMEOUT": 30,
+}
+
+# Rendered comparison images (and their Telegram file_id) keyed by HTML hash
+COMPARISON_IMAGE_CACHE = {
+    "MAX_ENTRIES": 128,
+}
+
+# Shared keep-alive HTTP client used for all climatenet.am and Telegram calls.
+# HOSTS maps a hostname to the size of its connection pool.
+HTTP_CLIENT = {
+    "HOSTS": {
+        "climatenet.am": 16,
+        "api.telegram.org": 16,
+    },
+    "POOL_MAXSIZE": 10,
+    "TIMEOUT": 10,
+    "RETRIES": 2,
+    "BACKOFF": 0.3,
+}
+
+# Background sweep of every station shortly after each quarter-hour boundary.
+# Handlers read the published snapshot and only hit upstream when it is stale.
+MEASUREMENT_POLLER = {
+    "ENABLED": os.getenv("MEASUREMENT_POLLER_ENABLED", "1") == "1",
+    "CONCURRENCY": 8,
+    "OFFSET_SECONDS": 60,
+}
+
+# Station catalog: served from the backend_device table, synced from upstream
+DEVICE_REGISTRY = {
+    "REFRESH_SECONDS": 3600,
+}
+
+# Command analytics are queued in memory and bulk-written by a background
+# thread. OVERFLOW is "drop" or "spill" (append to SPILL_PATH, replayed later).
+ANALYTICS_WRITER = {
+    "BATCH_SIZE": 100,
+    "FLUSH_INTERVAL_MS": 500,
+    "MAX_QUEUE": 10000,
+    "OVERFLOW": os.getenv("ANALYTICS_OVERFLOW", "drop"),
+    "SPILL_PATH": os.path.join(BASE_DIR, 'analytics_spill.jsonl'),
+}
+
+# Share of handled updates that record per-stage timings (0 disables tracing)
+ANALYTICS_TRACING = {
+    "SAMPLE_RATE": float(os.getenv("ANALYTICS_TRACE_SAMPLE_RATE", 1.0)),
+}
+
+# Users Analytics dashboard statistics are cached this long and then
+# refreshed in the background while the previous values are served
+ANALYTICS_DASHBOARD_CACHE_SECONDS = 60
+
+# Telegram allows about 30 messages per second per bot over all chats. The
+# GLOBAL_RATE budget is split explicitly, not shared over the network: each
+# process that sends gets GLOBAL_RATE / SENDING_PROCESSES per second, used by
+# its outbox and broadcasts together. In webhook mode set SENDING_PROCESSES to
+# the number of webhook workers plus one for start_bot
+TELEGRAM_RATE = {
+    "GLOBAL_RATE": 25,
+    "SENDING_PROCESSES": int(os.getenv("TELEGRAM_SENDING_PROCESSES", 1)),
+}
+
+# Admin broadcasts: sends per second over all chats (also drawn from the
+# process's TELEGRAM_RATE share, keep it below that share so replies still go
+# out) and per chat, sender threads, recipients saved per progress chunk,
+# first retry delay (doubled per attempt), and after how many seconds without
+# progress a running job counts as abandoned and is resumed
+BROADCAST = {
+    "GLOBAL_RATE": 15,
+    "PER_CHAT_RATE": 1,
+    "WORKERS": 8,
+    "CHUNK_SIZE": 50,
+    "MAX_ATTEMPTS": 3,
+    "BACKOFF": 1.0,
+    "STALE_AFTER": 120,
+}
+
+# getChat lookups for the admin "update username" actions: parallel
+# requests, requests per second and how long answers are cached (seconds)
+USERNAME_RESOLVER = {
+    "WORKERS": 8,
+    "RATE": 20,
+    "TTL": 3600,
+}
+
+# Per-chat bot sessions: dropped after IDLE_TTL seconds without messages or
+# beyond MAX_SESSIONS (least recently used first). With PERSIST sessions are
+# written to the database every FLUSH_INTERVAL seconds. SHARED (default on in
+# webhook mode) keeps nothing in memory and reads/writes the database on every
+# update, so any worker can handle a chat's next message; a chat's updates then
+# take turns through a lease on its row, held for at most LOCK_TIMEOUT seconds
+# (should its process die) and waited for at most LOCK_WAIT seconds
+CHAT_SESSIONS = {
+    "IDLE_TTL": 86400,
+    "MAX_SESSIONS": 10000,
+    "PERSIST": True,
+    "FLUSH_INTERVAL": 5,
+    "LOCK_TIMEOUT": 120,
+    "LOCK_WAIT": 30,
+}
+
+# How the bot receives updates: "polling" (start_bot, one process, fine for
+# development) or "webhook" (Telegram posts to climate_bot.asgi, any number
+# of workers; start_bot registers the webhook and keeps running as the one
+# process that syncs the station catalog and sweeps measurements, so set
+# MEASUREMENT_CACHE_BACKEND=django with a shared cache for the workers to see them)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+TELEGRAM_WEBHOOK = {
+    "URL": os.getenv("TELEGRAM_WEBHOOK_URL"),  # Public base URL, e.g. https://climatenet.am
+    "PATH": "/telegram/webhook/",
+    "SECRET_TOKEN": os.getenv("TELEGRAM_WEBHOOK_SECRET"),
+    "MAX_CONNECTIONS": 40,
+    # Workers only hand updates to BOT_EXECUTOR, one keeps a chat's updates in order
+    "WORKERS": 1,
+    "MAX_QUEUE": 1000,
+}
+
+# Update handling per priority class (see bot.views.classify_update): each
+# class runs on its own pool of WORKERS threads, so light commands never wait
+# behind renders or slow fetches, and admits at most MAX_PENDING updates
+# queued or running (0 = unbounded) before replying "busy, try again". A
+# chat's updates are still handled one at a time and in order
+BOT_EXECUTOR = {
+    "DEFAULT_CLASS": "light",
+    "CLASSES": {
+        "light": {"WORKERS": int(os.getenv("BOT_EXECUTOR_WORKERS", 8)), "MAX_PENDING": 0},
+        "network": {"WORKERS": 4, "MAX_PENDING": 25},
+        "compare": {"WORKERS": 2, "MAX_PENDING": 5},
+    },
+}
+
+# Outbound Telegram queue: sends per second per chat (with a small burst; the
+# rate over all chats is TELEGRAM_RATE), sender threads, attempts on
+# connection errors, and how long to wait for a follow-up text to merge into
+# one message
+BOT_OUTBOX = {
+    "WORKERS": 8,
+    "PER_CHAT_RATE": 1,
+    "PER_CHAT_BURST": 3,
+    "MAX_ATTEMPTS": 3,
+    "COALESCE_WINDOW_MS": 20,
+}
@@ -0,0 +1,143 @@
+from unittest import mock
+
+import requests
+from django.test import SimpleTestCase
+
+from .http_client import HttpClient
+from .ratelimit import KeyedTokenBuckets, TokenBucket, telegram_retry_after
+
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep in climate_bot.ratelimit."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('climate_bot.ratelimit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_paced(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        bucket.acquire()
+        self.assertAlmostEqual(self.clock.slept[-1], 0.1)
+
+    def test_pause_blocks_until_it_ends(self):
+        bucket = TokenBucket(rate=10)
+        bucket.pause(5)
+        self.assertFalse(bucket.try_acquire())
+        self.assertFalse(bucket.acquire(timeout=4))
+        self.assertEqual(self.clock.slept, [])
+
+        bucket.acquire()
+        # The pause, plus the spacing of one token since the bucket was emptied
+        self.assertAlmostEqual(self.clock.slept[-1], 5.1)
+
+    def test_pause_does_not_shorten_a_longer_one(self):
+        bucket = TokenBucket(rate=10)
+        bucket.pause(5)
+        bucket.pause(1)
+        self.clock.now += 2
+        self.assertFalse(bucket.try_acquire())
+        self.clock.now += 3.5
+        self.assertTrue(bucket.try_acquire())
+
+    def test_refills_after_pause(self):
+        bucket = TokenBucket(rate=10, capacity=3)
+        bucket.pause(1)
+        self.clock.now += 10
+        for _ in range(3):
+            self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+
+class KeyedTokenBucketsTestCase(SimpleTestCase):
+
+    def test_pause_is_per_key(self):
+        buckets = KeyedTokenBuckets(rate=1, max_keys=10)
+        buckets.pause('a', 60)
+        self.assertFalse(buckets.get('a').try_acquire())
+        self.assertTrue(buckets.get('b').try_acquire())
+
+    def test_least_recently_used_key_is_dropped(self):
+        buckets = KeyedTokenBuckets(rate=1, max_keys=2)
+        first = buckets.get('a')
+        buckets.get('b')
+        buckets.get('a')
+        buckets.get('c')
+        self.assertEqual(len(buckets), 2)
+        self.assertIs(buckets.get('a'), first)
+
+
+class RetryAfterTestCase(SimpleTestCase):
+
+    def test_only_429_has_retry_after(self):
+        flood = mock.Mock(error_code=429, result_json={'parameters': {'retry_after': 7}})
+        self.assertEqual(telegram_retry_after(flood), 7.0)
+        self.assertIsNone(telegram_retry_after(mock.Mock(error_code=400)))
+        self.assertIsNone(telegram_retry_after(ValueError()))
+
+
+class HttpClientTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.client = HttpClient(retries=2)
+        self.client._sleep_before_retry = lambda attempt: None
+
+    def respond(self, *outcomes):
+        """Make the session answer each request with the next status code or exception."""
+        def request(method, url, **kwargs):
+            outcome = next(results)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return mock.Mock(status_code=outcome)
+
+        results = iter(outcomes)
+        self.client.session.request = mock.Mock(side_effect=request)
+        return self.client.session.request
+
+    def test_get_retries_server_and_connection_errors(self):
+        request = self.respond(502, requests.ConnectionError('reset'), 200)
+        self.assertEqual(self.client.get('https://climatenet.am/x').status_code, 200)
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(self.client.metrics()['climatenet.am'], {
+            'requests': 3, 'errors': 2, 'retries': 2,
+            'avg_latency': mock.ANY, 'max_latency': mock.ANY,
+        })
+
+    def test_last_answer_is_returned_or_raised(self):
+        self.respond(503, 503, 503)
+        self.assertEqual(self.client.get('https://climatenet.am/x').status_code, 503)
+        self.respond(*[requests.Timeout('slow')] * 3)
+        with self.assertRaises(requests.Timeout):
+            self.client.get('https://climatenet.am/x')
+
+    def test_post_is_not_retried_unless_asked(self):
+        request = self.respond(502)
+        self.assertEqual(self.client.post('https://api.telegram.org/x').status_code, 502)
+        self.assertEqual(request.call_count, 1)
+
+        request = self.respond(502, 200)
+        self.assertEqual(self.client.post('https://api.telegram.org/x', retries=1).status_code, 200)
+        self.assertEqual(request.call_count, 2)
+
+    def test_default_timeout(self):
+        request = self.respond(200)
+        self.client.get('https://climatenet.am/x')
+        self.assertEqual(request.call_args.kwargs['timeout'], 10)
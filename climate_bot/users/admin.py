@@ -3,13 +3,13 @@ from django.contrib import messages
 from django import forms
 from django.http import JsonResponse
 from django.shortcuts import render
-from .models import TelegramUser
-import telebot
+from .models import TelegramUser, BroadcastJob
 import os
-from django.urls import path
-from .views import send_message_to_users_view
+from django.urls import path, reverse
+from .views import send_message_to_users_view, broadcast_progress_view
+from .broadcast import start_broadcast
 from unfold.admin import ModelAdmin
-import requests
+from .usernames import get_username_resolver
 
 # Assuming you have your Telegram Bot Token stored in an environment variable
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -18,20 +18,6 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 class SendMessageForm(forms.Form):
     message = forms.CharField(widget=forms.Textarea)
 
-def get_username(user_id):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getChat?chat_id={user_id}"
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        data = response.json()
-        if data.get("ok"):
-            return data["result"].get("username", "hidden")  # Return None if no username
-        return "Not Active"
-    return "Not Active" 
-
-
-
-
 @admin.register(TelegramUser)
 class TelegramUserAdmin(ModelAdmin):
     list_display = ('telegram_id','user_name', 'first_name', 'last_name', 'location', 'joined_at')
@@ -40,6 +26,8 @@ class TelegramUserAdmin(ModelAdmin):
         urls = super().get_urls()
         custom_urls = [
             path('hello/', self.admin_site.admin_view(send_message_to_users_view), name='analytics_data'),
+            path('broadcast/<int:job_id>/', self.admin_site.admin_view(broadcast_progress_view),
+                 name='users_broadcast_progress'),
         ]
         return custom_urls + urls
    
@@ -47,13 +35,14 @@ class TelegramUserAdmin(ModelAdmin):
     
     
     def update_username(modeladmin, request, queryset):
+        users = [user for user in queryset if not user.user_name]  # Only update users with no username
+        usernames = get_username_resolver().resolve(user.telegram_id for user in users)
         users_to_update = []
-        for user in queryset:
-            if not user.user_name:  # Only update users with no username
-                username = get_username(user.telegram_id)
-                if username:
-                    user.user_name = username
-                    users_to_update.append(user)
+        for user in users:
+            username = usernames.get(str(user.telegram_id))
+            if username:
+                user.user_name = username
+                users_to_update.append(user)
 
         if users_to_update:
             TelegramUser.objects.bulk_update(users_to_update, ["user_name"])
@@ -72,25 +61,13 @@ class TelegramUserAdmin(ModelAdmin):
             form = SendMessageForm(request.POST)
 
             if form.is_valid():
-                print("Form is valid")
                 message = form.cleaned_data['message']
-                bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
-
-                success_count = 0
-                failure_count = 0
-
-                for user in queryset:
-                    try:
-                        bot.send_message(chat_id=user.telegram_id, text=message)
-                        print(f"Message sent to {user.telegram_id}")
-                        success_count += 1
-                    except Exception as e:
-                        failure_count += 1
-                        print(f"Failed to send message to {user.telegram_id}: {e}")
-
+                job = start_broadcast(message, queryset.values_list('telegram_id', flat=True))
                 return JsonResponse({
                     "success": True,
-                    "message": f"Successfully sent message to {success_count} users. Failed: {failure_count}"
+                    "job_id": job.pk,
+                    "progress_url": reverse('admin:users_broadcast_progress', args=[job.pk]),
+                    "message": f"Broadcast #{job.pk} started for {job.total} users"
                 })
 
             print("Form is invalid:", form.errors)
@@ -106,3 +83,10 @@ class TelegramUserAdmin(ModelAdmin):
     send_message_to_users.short_description = "Send a message to selected users"
 
 # Register the model with the custom admin class
+
+
+@admin.register(BroadcastJob)
+class BroadcastJobAdmin(ModelAdmin):
+    list_display = ('id', 'status', 'total', 'sent', 'failed', 'created_at', 'finished_at')
+    list_filter = ['status']
+    readonly_fields = ('status', 'total', 'sent', 'failed', 'created_at', 'heartbeat_at', 'finished_at')
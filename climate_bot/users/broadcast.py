@@ -0,0 +1,249 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+import requests
+import telebot
+from telebot.apihelper import ApiTelegramException
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from climate_bot.ratelimit import KeyedTokenBuckets, TokenBucket, get_telegram_bucket, telegram_retry_after
+from .models import BroadcastJob, BroadcastRecipient
+
+
+logger = logging.getLogger(__name__)
+
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+# Telegram answers these for blocked bots, deleted accounts and unknown chats
+PERMANENT_ERRORS = {400, 403}
+
+
+class BroadcastEngine:
+    """Sends broadcast jobs in the background.
+
+    Recipients are sent concurrently by a thread pool, paced by a global
+    and a per-chat token bucket and, when given, the ``shared_bucket``
+    the rest of the process sends through; a 429 pauses the global buckets for the
+    ``retry_after`` Telegram returned, other transient errors are retried
+    with exponential backoff. Progress is saved per chunk of recipients,
+    so a job picked up again after a crash re-sends at most one chunk; the
+    heartbeat is also refreshed while a chunk is still sending, so a slow
+    chunk is not mistaken for a crash. A watchdog thread resumes pending
+    jobs and jobs whose heartbeat went stale every ``stale_after`` seconds.
+    """
+
+    def __init__(self, bot, workers=8, global_rate=25, per_chat_rate=1, chunk_size=50,
+                 max_attempts=3, stale_after=120, backoff=1.0, shared_bucket=None):
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.backoff = backoff
+        self._global = TokenBucket(global_rate)
+        self._shared = shared_bucket
+        self._per_chat = KeyedTokenBuckets(per_chat_rate)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+        self._running = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        if self._watchdog is not None:
+            return
+        self._watchdog = threading.Thread(target=self._watch, name="broadcast-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while True:
+            try:
+                close_old_connections()
+                self.resume()
+            except Exception as e:
+                logger.error(f"Failed to resume broadcasts: {e}")
+            if self._stop.wait(self.stale_after):
+                return
+
+    def create(self, message, telegram_ids):
+        telegram_ids = list(dict.fromkeys(telegram_ids))
+        with transaction.atomic():
+            job = BroadcastJob.objects.create(message=message, total=len(telegram_ids))
+            BroadcastRecipient.objects.bulk_create(
+                [BroadcastRecipient(job=job, telegram_id=telegram_id) for telegram_id in telegram_ids],
+                batch_size=500,
+            )
+        self.submit(job.pk)
+        return job
+
+    def _claim(self, job_id):
+        # A running job whose worker stopped saving progress was left by a crashed process
+        stale = timezone.now() - timedelta(seconds=self.stale_after)
+        return BroadcastJob.objects.filter(
+            Q(status=BroadcastJob.PENDING) | Q(status=BroadcastJob.RUNNING, heartbeat_at__lt=stale),
+            pk=job_id,
+        ).update(status=BroadcastJob.RUNNING, heartbeat_at=timezone.now())
+
+    def submit(self, job_id):
+        with self._lock:
+            if job_id in self._running or not self._claim(job_id):
+                return False
+            self._running.add(job_id)
+        threading.Thread(target=self._run, args=(job_id,), name=f"broadcast-{job_id}", daemon=True).start()
+        return True
+
+    def resume(self):
+        """Pick up pending jobs and jobs abandoned by a crashed process."""
+        stale = timezone.now() - timedelta(seconds=self.stale_after)
+        job_ids = BroadcastJob.objects.filter(
+            Q(status=BroadcastJob.PENDING) | Q(status=BroadcastJob.RUNNING, heartbeat_at__lt=stale)
+        ).values_list('pk', flat=True)
+        return [job_id for job_id in job_ids if self.submit(job_id)]
+
+    def is_idle(self):
+        return not self._running
+
+    def _run(self, job_id):
+        close_old_connections()
+        try:
+            job = BroadcastJob.objects.get(pk=job_id)
+            while True:
+                chunk = list(
+                    job.recipients.filter(status=BroadcastRecipient.PENDING).order_by('pk')[:self.chunk_size]
+                )
+                if not chunk:
+                    break
+                # Workers only talk to Telegram; the results are saved here in one go
+                futures = [self._pool.submit(self._deliver, job.message, recipient) for recipient in chunk]
+                while wait(futures, timeout=self.stale_after / 4).not_done:
+                    # Flood control pauses and retry backoff can outlast stale_after
+                    self._beat(job_id)
+                for future in futures:
+                    future.result()
+                with transaction.atomic():
+                    BroadcastRecipient.objects.bulk_update(chunk, ['status', 'attempts', 'error', 'sent_at'])
+                    self._save_progress(job)
+            job.status = BroadcastJob.DONE
+            job.finished_at = timezone.now()
+            job.save(update_fields=['status', 'finished_at'])
+            logger.info(f"Broadcast #{job_id} finished: {job.sent} sent, {job.failed} failed")
+        except Exception as e:
+            logger.error(f"Broadcast #{job_id} stopped: {e}")
+            try:
+                # Hand it back to the watchdog; if even this fails, the stale heartbeat does
+                BroadcastJob.objects.filter(pk=job_id, status=BroadcastJob.RUNNING).update(status=BroadcastJob.PENDING)
+            except Exception as e:
+                logger.error(f"Failed to release broadcast #{job_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+            close_old_connections()
+
+    def _beat(self, job_id):
+        BroadcastJob.objects.filter(pk=job_id, status=BroadcastJob.RUNNING).update(heartbeat_at=timezone.now())
+
+    def _save_progress(self, job):
+        counts = job.recipients.aggregate(
+            sent=Count('pk', filter=Q(status=BroadcastRecipient.SENT)),
+            failed=Count('pk', filter=Q(status=BroadcastRecipient.FAILED)),
+        )
+        job.sent = counts['sent']
+        job.failed = counts['failed']
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=['sent', 'failed', 'heartbeat_at'])
+
+    def _deliver(self, message, recipient):
+        while recipient.attempts < self.max_attempts:
+            self._per_chat.acquire(recipient.telegram_id)
+            self._global.acquire()
+            if self._shared is not None:
+                self._shared.acquire()
+            try:
+                self.bot.send_message(chat_id=recipient.telegram_id, text=message)
+            except ApiTelegramException as e:
+                retry_after = telegram_retry_after(e)
+                if retry_after is not None:
+                    # Flood control is not the recipient's fault, so it doesn't count as an attempt
+                    logger.warning(f"Telegram flood control, pausing broadcasts for {retry_after}s")
+                    self._global.pause(retry_after)
+                    if self._shared is not None:
+                        self._shared.pause(retry_after)
+                    continue
+                recipient.attempts += 1
+                recipient.error = str(e.description)[:255]
+                if e.error_code in PERMANENT_ERRORS:
+                    break
+                self._wait_before_retry(recipient)
+            except requests.ConnectionError as e:
+                # Telegram never saw the request, so it is safe to send again
+                recipient.attempts += 1
+                recipient.error = str(e)[:255]
+                self._wait_before_retry(recipient)
+            except requests.RequestException as e:
+                # E.g. a read timeout: the message may have been delivered, don't send it twice
+                recipient.attempts += 1
+                recipient.error = str(e)[:255]
+                break
+            else:
+                recipient.attempts += 1
+                recipient.status = BroadcastRecipient.SENT
+                recipient.error = ''
+                recipient.sent_at = timezone.now()
+                return True
+        recipient.status = BroadcastRecipient.FAILED
+        return False
+
+    def _wait_before_retry(self, recipient):
+        if recipient.attempts < self.max_attempts:
+            time.sleep(self.backoff * 2 ** (recipient.attempts - 1))
+
+
+def broadcast_progress(job):
+    pending = job.total - job.sent - job.failed
+    return {
+        'job_id': job.pk,
+        'status': job.status,
+        'total': job.total,
+        'sent': job.sent,
+        'failed': job.failed,
+        'pending': max(pending, 0),
+    }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_broadcast_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                config = getattr(settings, 'BROADCAST', {})
+                _engine = BroadcastEngine(
+                    telebot.TeleBot(TELEGRAM_BOT_TOKEN, threaded=False),
+                    workers=config.get('WORKERS', 8),
+                    global_rate=config.get('GLOBAL_RATE', 25),
+                    per_chat_rate=config.get('PER_CHAT_RATE', 1),
+                    chunk_size=config.get('CHUNK_SIZE', 50),
+                    max_attempts=config.get('MAX_ATTEMPTS', 3),
+                    stale_after=config.get('STALE_AFTER', 120),
+                    backoff=config.get('BACKOFF', 1.0),
+                    shared_bucket=get_telegram_bucket(),
+                )
+                _engine.start()
+    return _engine
+
+
+def start_broadcast(message, telegram_ids):
+    return get_broadcast_engine().create(message, telegram_ids)
@@ -0,0 +1,19 @@
+# users/management/commands/resume_broadcasts.py
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.broadcast import get_broadcast_engine
+
+
+class Command(BaseCommand):
+    help = 'Resumes pending and abandoned broadcast jobs and waits for them to finish'
+
+    def handle(self, *args, **options):
+        engine = get_broadcast_engine()
+        # The engine's watchdog does this too, but asynchronously
+        engine.resume()
+        while not engine.is_idle():
+            time.sleep(1)
+        self.stdout.write('No broadcast jobs left to send')
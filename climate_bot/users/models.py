@@ -14,3 +14,44 @@ class TelegramUser(models.Model):
 
     def __str__(self):
         return f"{self.first_name} {self.last_name} ({self.telegram_id})"
+
+
+class BroadcastJob(models.Model):
+    # An admin mass message; recipients are sent by users.broadcast
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done')]
+
+    message = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last progress save of the running worker
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Broadcast #{self.pk} ({self.status}, {self.sent}/{self.total})"
+
+
+class BroadcastRecipient(models.Model):
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    job = models.ForeignKey(BroadcastJob, on_delete=models.CASCADE, related_name='recipients')
+    telegram_id = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('job', 'telegram_id')
+        indexes = [models.Index(fields=['job', 'status'], name='broadcast_job_status_idx')]
+
+    def __str__(self):
+        return f"{self.job_id} -> {self.telegram_id} ({self.status})"
@@ -99,4 +99,204 @@ def get_username(id):
         print("Failed to reach Telegram API")
         
         
-# get_username(user_id)
\ No newline at end of file
+# get_username(user_id)
+
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+from telebot.apihelper import ApiTelegramException
+
+from .broadcast import BroadcastEngine
+from .models import BroadcastJob, BroadcastRecipient
+from .usernames import UsernameResolver, group_by_username
+
+
+def telegram_error(code, description='error', retry_after=None):
+    result_json = {'error_code': code, 'description': description}
+    if retry_after is not None:
+        result_json['parameters'] = {'retry_after': retry_after}
+    return ApiTelegramException('sendMessage', None, result_json)
+
+
+class FakeTelegram:
+    """Answers send_message from a script of errors per chat, then succeeds."""
+
+    def __init__(self, errors=None, delay=0):
+        self.errors = {chat_id: list(script) for chat_id, script in (errors or {}).items()}
+        self.delay = delay
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        time.sleep(self.delay)
+        with self._lock:
+            script = self.errors.get(chat_id)
+            if script:
+                raise script.pop(0)
+            self.sent.append(chat_id)
+        return SimpleNamespace(chat_id=chat_id)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+class BroadcastEngineTestCase(TransactionTestCase):
+
+    def engine(self, telegram, **kwargs):
+        options = dict(workers=4, global_rate=1000, per_chat_rate=1000, chunk_size=2, backoff=0)
+        options.update(kwargs)
+        engine = BroadcastEngine(telegram, **options)
+        self.addCleanup(engine._pool.shutdown)
+        return engine
+
+    def finished(self, job):
+        return wait_for(lambda: BroadcastJob.objects.get(pk=job.pk).status == BroadcastJob.DONE)
+
+    def statuses(self, job):
+        return dict(job.recipients.values_list('telegram_id', 'status'))
+
+    def test_sends_every_recipient_once(self):
+        telegram = FakeTelegram()
+        engine = self.engine(telegram)
+        job = engine.create('hello', [1, 2, 3, 2, 4, 5])
+        self.assertTrue(self.finished(job))
+        job.refresh_from_db()
+        self.assertEqual(sorted(telegram.sent), [1, 2, 3, 4, 5])
+        self.assertEqual((job.total, job.sent, job.failed), (5, 5, 0))
+
+    def test_only_connection_errors_are_retried(self):
+        telegram = FakeTelegram(errors={
+            1: [requests.ConnectionError('reset')],
+            2: [requests.ReadTimeout('read timed out')],
+            3: [telegram_error(403, 'bot was blocked')],
+            4: [telegram_error(429, 'too many requests', retry_after=0)] * 5,
+        })
+        job = self.engine(telegram).create('hello', [1, 2, 3, 4])
+        self.assertTrue(self.finished(job))
+        self.assertEqual(self.statuses(job), {
+            1: BroadcastRecipient.SENT,
+            # May have been delivered already
+            2: BroadcastRecipient.FAILED,
+            3: BroadcastRecipient.FAILED,
+            # Flood control doesn't use up attempts
+            4: BroadcastRecipient.SENT,
+        })
+        attempts = dict(job.recipients.values_list('telegram_id', 'attempts'))
+        self.assertEqual(attempts, {1: 2, 2: 1, 3: 1, 4: 1})
+
+    def test_running_job_is_claimed_only_when_stale(self):
+        telegram = FakeTelegram()
+        engine = self.engine(telegram, stale_after=60)
+        job = BroadcastJob.objects.create(message='hello', total=1, status=BroadcastJob.RUNNING,
+                                          heartbeat_at=timezone.now())
+        BroadcastRecipient.objects.create(job=job, telegram_id=1)
+        self.assertEqual(engine.resume(), [])
+
+        BroadcastJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(engine.resume(), [job.pk])
+        self.assertTrue(self.finished(job))
+        self.assertEqual(telegram.sent, [1])
+
+    def test_resume_skips_recipients_already_saved(self):
+        telegram = FakeTelegram()
+        job = BroadcastJob.objects.create(message='hello', total=3)
+        BroadcastRecipient.objects.bulk_create([
+            BroadcastRecipient(job=job, telegram_id=1, status=BroadcastRecipient.SENT, attempts=1),
+            BroadcastRecipient(job=job, telegram_id=2),
+            BroadcastRecipient(job=job, telegram_id=3),
+        ])
+        self.assertEqual(self.engine(telegram).resume(), [job.pk])
+        self.assertTrue(self.finished(job))
+        self.assertEqual(sorted(telegram.sent), [2, 3])
+        job.refresh_from_db()
+        self.assertEqual(job.sent, 3)
+
+    def test_heartbeat_is_kept_fresh_during_a_slow_chunk(self):
+        telegram = FakeTelegram(delay=0.6)
+        engine = self.engine(telegram, stale_after=0.4, chunk_size=10)
+        job = engine.create('hello', [1, 2])
+        time.sleep(0.5)
+        # Past stale_after since the claim, but the chunk is still sending
+        self.assertEqual(self.engine(FakeTelegram(), stale_after=0.4).resume(), [])
+        self.assertTrue(self.finished(job))
+        self.assertEqual(sorted(telegram.sent), [1, 2])
+
+
+class FakeGetChat:
+    """Answers getChat from ``answers``: chat id -> list of (status, payload), one per call."""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        chat_id = url.rsplit('=', 1)[1]
+        with self._lock:
+            self.calls.append(chat_id)
+            status, payload = self.answers[chat_id].pop(0)
+        if isinstance(payload, Exception):
+            raise payload
+        return SimpleNamespace(status_code=status, json=lambda: payload)
+
+
+class UsernameResolverTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.resolver = UsernameResolver('token', rate=1000)
+
+    def resolve(self, answers, user_ids):
+        client = FakeGetChat(answers)
+        with mock.patch('users.usernames.get_http_client', return_value=client):
+            return self.resolver.resolve(user_ids), client.calls
+
+    def test_distinct_ids_fetched_once_then_cached(self):
+        answers = {
+            '1': [(200, {'ok': True, 'result': {'username': 'one'}})],
+            '2': [(200, {'ok': True, 'result': {}})],
+            '3': [(403, {'ok': False})],
+        }
+        usernames, calls = self.resolve(answers, [1, '1', 2, 3])
+        self.assertEqual(usernames, {'1': 'one', '2': 'hidden', '3': 'Not Active'})
+        self.assertEqual(sorted(calls), ['1', '2', '3'])
+
+        usernames, calls = self.resolve({}, [1, 2, 3])
+        self.assertEqual(usernames, {'1': 'one', '2': 'hidden', '3': 'Not Active'})
+        self.assertEqual(calls, [])
+
+    def test_unsure_answers_are_not_cached(self):
+        answers = {
+            '1': [(502, {'ok': False})],
+            '2': [(200, requests.ConnectionError('reset'))],
+            '3': [(401, {'ok': False})],
+        }
+        usernames, _ = self.resolve(answers, [1, 2, 3])
+        self.assertEqual(usernames, {})
+        self.assertEqual(cache.get_many(['telegram:username:1', 'telegram:username:2', 'telegram:username:3']), {})
+
+    def test_flood_wait_is_retried(self):
+        answers = {'1': [
+            (429, {'ok': False, 'parameters': {'retry_after': 0.01}}),
+            (200, {'ok': True, 'result': {'username': 'one'}}),
+        ]}
+        usernames, calls = self.resolve(answers, [1])
+        self.assertEqual(usernames, {'1': 'one'})
+        self.assertEqual(calls, ['1', '1'])
+
+    def test_group_by_username(self):
+        self.assertEqual(dict(group_by_username({'1': 'one', '2': 'hidden', '3': 'hidden'})),
+                         {'one': ['1'], 'hidden': ['2', '3']})
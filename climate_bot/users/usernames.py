@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from climate_bot.http_client import get_http_client
+from climate_bot.ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+
+CACHE_PREFIX = 'telegram:username'
+
+# getChat answers that are about the user rather than about us or Telegram
+INACTIVE_STATUSES = {400, 403}
+
+
+class UsernameResolver:
+    """Looks up Telegram usernames with getChat.
+
+    Ids are de-duplicated, answered from the cache where possible, and the
+    rest fetched concurrently under a shared rate limit. Only definite
+    answers are cached, for ``ttl`` seconds; network errors, 401, 5xx and
+    exhausted 429 retries leave the id unresolved.
+    """
+
+    def __init__(self, token, workers=8, rate=20, ttl=3600, max_attempts=3):
+        self.token = token
+        self.workers = workers
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(rate)
+
+    def fetch(self, user_id):
+        """Username, "hidden", "Not Active" for chats Telegram refuses, or None when unsure."""
+        url = f"https://api.telegram.org/bot{self.token}/getChat?chat_id={user_id}"
+        for _ in range(self.max_attempts):
+            self._bucket.acquire()
+            try:
+                response = get_http_client().get(url)
+                data = response.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"getChat for {user_id} failed: {e}")
+                return None
+            if response.status_code == 429:
+                self._bucket.pause((data.get('parameters') or {}).get('retry_after', 1))
+                continue
+            if response.status_code == 200 and data.get("ok"):
+                return data["result"].get("username", "hidden")
+            if response.status_code in INACTIVE_STATUSES:
+                # Unknown chat, blocked bot or deactivated account
+                return "Not Active"
+            # A bad token or a Telegram outage says nothing about the user
+            logger.warning(f"getChat for {user_id} returned {response.status_code}")
+            return None
+        return None
+
+    def resolve(self, user_ids):
+        """Map each distinct user id to its username; ids that failed are left out."""
+        user_ids = {str(user_id) for user_id in user_ids}
+        keys = {user_id: f"{CACHE_PREFIX}:{user_id}" for user_id in user_ids}
+        cached = cache.get_many(keys.values())
+        usernames = {user_id: cached[key] for user_id, key in keys.items() if key in cached}
+
+        missing = sorted(user_ids - usernames.keys())
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as pool:
+                fetched = dict(zip(missing, pool.map(self.fetch, missing)))
+            fetched = {user_id: username for user_id, username in fetched.items() if username is not None}
+            cache.set_many({keys[user_id]: username for user_id, username in fetched.items()}, timeout=self.ttl)
+            usernames.update(fetched)
+        return usernames
+
+
+def group_by_username(usernames):
+    """Invert ``{user_id: username}`` into ``{username: [user_id, ...]}``."""
+    groups = defaultdict(list)
+    for user_id, username in usernames.items():
+        groups[username].append(user_id)
+    return groups
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_username_resolver():
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                config = getattr(settings, 'USERNAME_RESOLVER', {})
+                _resolver = UsernameResolver(
+                    TELEGRAM_BOT_TOKEN,
+                    workers=config.get('WORKERS', 8),
+                    rate=config.get('RATE', 20),
+                    ttl=config.get('TTL', 3600),
+                )
+    return _resolver
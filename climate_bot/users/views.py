@@ -1,21 +1,26 @@
 # views.py
 from django.http import JsonResponse
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
 from django.contrib import messages
-from .models import TelegramUser
+from django.urls import reverse
+from .models import TelegramUser, BroadcastJob
+from .broadcast import broadcast_progress, start_broadcast
 # from .forms import SendMessageForm
 from django import forms
 
-import telebot
 import os
 import json
-import requests
 
 class SendMessageForm(forms.Form):
     message = forms.CharField(widget=forms.Textarea)
 # Assuming you have your Telegram Bot Token stored in an environment variable
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+def broadcast_progress_view(request, job_id):
+    job = get_object_or_404(BroadcastJob, pk=job_id)
+    return JsonResponse(broadcast_progress(job))
+
+
 def send_message_to_users_view(request):
     # Check if it's an AJAX request
     if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -36,22 +41,13 @@ def send_message_to_users_view(request):
 
         if form.is_valid():
             message = form.cleaned_data['message']
-            bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
-
-            success_count = 0
-            failure_count = 0
-
-            for user in users:
-                try:
-                    bot.send_message(chat_id=user.telegram_id, text=message)
-                    success_count += 1
-                except Exception as e:
-                    failure_count += 1
-                    print(f"Failed to send message to {user.telegram_id}: {e}")
-
+            # Sending happens in the background, the page polls the progress endpoint
+            job = start_broadcast(message, users.values_list('telegram_id', flat=True))
             return JsonResponse({
                 "success": True,
-                "message": f"Successfully sent message to {success_count} users. Failed: {failure_count}"
+                "job_id": job.pk,
+                "progress_url": reverse('admin:users_broadcast_progress', args=[job.pk]),
+                "message": f"Broadcast #{job.pk} started for {job.total} users"
             })
 
         return JsonResponse({"success": False, "message": "Invalid form data"}, status=400)